@@ -32,6 +32,9 @@ from sflvault.clientqt.images.qicons import *
 
 from sflvault.clientqt.lib.auth import *
 
+# Services per search page, see TreeModel.fetchPage()
+SEARCH_PAGE_SIZE = 500
+
 
 class TreeItem(QtCore.QObject):
     def __init__(self, data, icon=None, parent=None):
@@ -76,34 +79,62 @@ class TreeModel(QtCore.QAbstractItemModel):
         self.research = research
         self.groups_ids = groups_ids
 
-        # Init data item tree
-        parents = []
-        parents.append(self.rootItem)
-
+        # Init data item tree, the rest of the pages are loaded by
+        # fetchMore(), when the view needs them.
+        self.customerItems = {}
+        self.machineItems = {}
         if not self.research:
             self.research = "."
-        search_result = vaultSearch(self.research, 
+        self.nextToken = ''
+        self.fetchPage()
+
+    def fetchPage(self):
+        """Load the next page of search results in the tree"""
+        search_result = vaultSearch(self.research,
                                         {"groups": self.groups_ids,
                                          "machines": [],
                                          "customers": [],
-                                        })
+                                        },
+                                    SEARCH_PAGE_SIZE, self.nextToken)
+        if not search_result or search_result.get("error"):
+            self.nextToken = ''
+            return
+        self.nextToken = search_result.get("next", '')
+
+        # The new rows of the items already in the tree, by parent.  The
+        # items of this page get their children right away, they're not
+        # shown yet.
+        newRows = {}
+        newItems = set()
+        def addChild(parentItem, item):
+            newItems.add(id(item))
+            if id(parentItem) in newItems:
+                parentItem.appendChild(item)
+            else:
+                newRows.setdefault(id(parentItem),
+                                   (parentItem, []))[1].append(item)
+
         for custoid, custo in search_result["results"].items():
-            it = TreeItem([custo["name"],
-                           "c#" + custoid],
-                          Qicons("customer"),
-                          parents[-1])
-            parents[-1].appendChild(it)
-            parents.append(parents[-1].child(parents[-1].childCount() - 1))
+            if custoid not in self.customerItems:
+                it = TreeItem([custo["name"],
+                               "c#" + custoid],
+                              Qicons("customer"),
+                              self.rootItem)
+                addChild(self.rootItem, it)
+                self.customerItems[custoid] = it
+            custoItem = self.customerItems[custoid]
 
             for machineid, machine in custo["machines"].items():
-                it = TreeItem(["%s (%s - %s)" % (machine["name"],
-                                                 machine["fqdn"],
-                                                 machine["ip"]),
-                               "m#" + machineid],
-                              Qicons("machine"),
-                              parents[-1])
-                parents[-1].appendChild(it)
-                parents.append(parents[-1].child(parents[-1].childCount() - 1))
+                if machineid not in self.machineItems:
+                    it = TreeItem(["%s (%s - %s)" % (machine["name"],
+                                                     machine["fqdn"],
+                                                     machine["ip"]),
+                                   "m#" + machineid],
+                                  Qicons("machine"),
+                                  custoItem)
+                    addChild(custoItem, it)
+                    self.machineItems[machineid] = it
+                machineItem = self.machineItems[machineid]
 
                 for serviceid, service in machine["services"].items():
                     if not service["url"]:
@@ -113,12 +144,28 @@ class TreeModel(QtCore.QAbstractItemModel):
                         it = TreeItem([service["url"],
                                        "s#" + serviceid],
                                       Qicons(protocol, "service"),
-                                      parents[-1])
-                        parents[-1].appendChild(it)
-
-                parents.pop()
+                                      machineItem)
+                        addChild(machineItem, it)
 
-            parents.pop()
+        # Tell the views about the rows added under the shown items
+        for parentItem, items in newRows.values():
+            if parentItem is self.rootItem:
+                parent = QtCore.QModelIndex()
+            else:
+                parent = self.createIndex(parentItem.row(), 0, parentItem)
+            first = parentItem.childCount()
+            self.beginInsertRows(parent, first, first + len(items) - 1)
+            for item in items:
+                parentItem.appendChild(item)
+            self.endInsertRows()
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and bool(self.nextToken)
+
+    def fetchMore(self, parent):
+        if not self.canFetchMore(parent):
+            return
+        self.fetchPage()
 
     def columnCount(self, parent):
         if parent.isValid():
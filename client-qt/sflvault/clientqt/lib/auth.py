@@ -156,7 +156,7 @@ def reauth(func):
     def reauth_func(*k, **a):
         status = func(*k, **a)
         if 'error' in status and status["error"]:
-            if status['message'] == 'Permission denied':
+            if status['message'].startswith('Permission denied (session'):
                 getAuth()
                 status = func(*k, **a)
             else:
@@ -234,10 +234,11 @@ def getCustomer(id):
 
 @try_connect
 @reauth
-def vaultSearch(pattern, filters={}):
+def vaultSearch(pattern, filters={}, limit=0, token=''):
     global client
     result = client.vault.search(client.authtok, pattern,
-                                filters.get('groups'), False, filters)
+                                filters.get('groups'), False, filters,
+                                limit, token)
     return result
 
 @return_element("plaintext")
@@ -0,0 +1,97 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""In-memory cache of decrypted group keys, used by the SFLvault client"""
+
+import time
+import hashlib
+from collections import OrderedDict
+
+from Crypto.PublicKey import ElGamal
+
+from sflvault.common.crypto import decrypt_longmsg, unserial_elgamal_privkey
+
+
+__all__ = ['GroupKeyCache']
+
+
+class GroupKeyCache(object):
+    """Keeps the unwrapped group ElGamal objects around for a while.
+
+    Decrypting a ``cryptgroupkey`` is the longest operation of the client
+    (over a second on a 3GHz machine), and the same group key is needed
+    for every service of a group.  Entries are keyed by group_id *and* a
+    hash of the ``cryptgroupkey``, so a re-keyed group never hits a stale
+    entry.
+
+    ttl - seconds an entry stays valid after it was decrypted
+    size - maximum number of entries, least recently used are evicted
+    """
+    def __init__(self, ttl=300, size=64):
+        self.ttl = ttl
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._keys = OrderedDict()
+
+    def _key(self, group_id, cryptgroupkey):
+        return (group_id, hashlib.sha1(cryptgroupkey).hexdigest())
+
+    def get(self, privkey, group_id, cryptgroupkey):
+        """Return the group's ElGamal object, decrypting it with `privkey`
+        only if it's not in the cache already."""
+        key = self._key(group_id, cryptgroupkey)
+        now = time.time()
+
+        if key in self._keys:
+            expires, eg = self._keys.pop(key)
+            if expires > now:
+                # Put it back on top, as most recently used
+                self._keys[key] = (expires, eg)
+                self.hits += 1
+                return eg
+
+        self.misses += 1
+        grouppacked = decrypt_longmsg(privkey, cryptgroupkey)
+
+        eg = ElGamal.ElGamalobj()
+        (eg.p, eg.x, eg.g, eg.y) = unserial_elgamal_privkey(grouppacked)
+        del(grouppacked)
+
+        if self.ttl > 0 and self.size > 0:
+            self._keys[key] = (now + self.ttl, eg)
+            while len(self._keys) > self.size:
+                self._keys.popitem(last=False)
+
+        return eg
+
+    def wipe(self):
+        """Forget about all the decrypted group keys"""
+        self._keys.clear()
+
+    def stats(self):
+        """Return a dict with the cache counters"""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._keys)}
+
+    def __len__(self):
+        return len(self._keys)
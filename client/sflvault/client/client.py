@@ -27,6 +27,9 @@ import sys
 import re
 import os
 import time
+import hashlib
+import inspect
+import urlparse
 
 from subprocess import Popen, PIPE
 
@@ -37,6 +40,9 @@ from sflvault.common import VaultError
 from sflvault.common.crypto import *
 from sflvault.client.utils import *
 from sflvault.client import remoting
+from sflvault.client.cache import GroupKeyCache
+from sflvault.client.jsonrpc import JSONRPCServer
+from sflvault.client.transport import ConnectionPool, PooledTransport
 
 
 
@@ -59,12 +65,9 @@ def vaultReply(rep, errmsg="Error"):
 # authenticate decorator
 #
 def authenticate(keep_privkey=False):
-    def do_authenticate(func, self, *args, **kwargs):
-        """Login decorator
-        
-        self is there because it's called on class elements.
-        """
-
+    def login(self):
+        """Log in and authenticate.  Returns False if the private key
+        couldn't be decrypted."""
         username = self.cfg.get('SFLvault', 'username')
         privkey = None
 
@@ -106,13 +109,19 @@ def authenticate(keep_privkey=False):
 
         # TODO: check also is the privkey (ElGamal obj) has been cached
         #       in self.privkey (when invoked with keep_privkey)
+        started = time.time()
         retval = self.vault.login(username, pkgres.get_distribution('SFLvault_client').version)
         self.authret = retval
         if not retval['error']:
+            if retval.get('jsonrpc'):
+                self._use_jsonrpc(retval['jsonrpc'])
             # try the last token
             retval2 = self.vault.authenticate(username, self.authtok)
             if retval2['error']:
                 print retval2['message']
+                if 'expired' in retval2['message']:
+                    # Don't keep decrypted group keys across sessions.
+                    self.groupkeys.wipe()
                 # decrypt token.
                 cryptok = privkey.decrypt(unserial_elgamal_msg(retval['cryptok']))
                 retval3 = self.vault.authenticate(username, b64encode(cryptok))
@@ -124,16 +133,77 @@ def authenticate(keep_privkey=False):
                     raise AuthenticationError("Authentication failed: %s" % \
                                               retval3['message'])
                 else:
-                    self.authtok = retval3['authtok']
+                    self._set_authtok(retval3, started)
                     print retval3['message']
 
             else:
-                self.authtok = retval2['authtok']
+                self._set_authtok(retval2, started)
                 print retval2['message']
         else:
             raise AuthenticationError("Authentication failed: %s" % \
                                       retval['message'])
 
+        return True
+
+    def fresh(self):
+        """Is the session the vault gave us still valid?"""
+        return self._authtok_fresh() and \
+            (hasattr(self, 'privkey') or not keep_privkey)
+
+    def session_lost(self, error, answered):
+        """Did the vault lose our session (restart, address change...) and
+        refuse the first request, so that nothing was done?  `answered` is
+        the count of the pool's responses before the call."""
+        if 'Permission denied (session' not in str(error) or \
+                self.pool.answered - answered > 1:
+            return False
+        self.authtok_expires = 0
+        self.groupkeys.wipe()
+        return True
+
+    def iter_authenticated(func, self, args, kwargs):
+        """do_authenticate() for the methods yielding their results"""
+        if fresh(self):
+            answered = self.pool.answered
+            results = func(self, *args, **kwargs)
+            try:
+                first = results.next()
+            except StopIteration:
+                return
+            except VaultError, e:
+                if not session_lost(self, e, answered):
+                    raise
+            else:
+                yield first
+                for x in results:
+                    yield x
+                return
+
+        if login(self):
+            for x in func(self, *args, **kwargs):
+                yield x
+
+    def do_authenticate(func, self, *args, **kwargs):
+        """Login decorator
+        
+        self is there because it's called on class elements.
+        """
+        if inspect.isgeneratorfunction(func):
+            return iter_authenticated(func, self, args, kwargs)
+
+        # Skip the login/authenticate round trips while the session the
+        # vault gave us is still valid.  When it was lost, log in and try
+        # again, unless some of the requests went through.
+        if fresh(self):
+            answered = self.pool.answered
+            try:
+                return func(self, *args, **kwargs)
+            except VaultError, e:
+                if not session_lost(self, e, answered):
+                    raise
+
+        if not login(self):
+            return False
         return func(self, *args, **kwargs)
 
     return decorator(do_authenticate)
@@ -420,11 +490,29 @@ class SFLvaultClient(object):
 
         self.shell_mode = shell
         self.authtok = ''
+        # When the vault will expire our authtok, in time.time() seconds
+        self.authtok_expires = 0
         self.authret = None
-        # Set the default route to the Vault
+        # Decrypted group keys, see `_decrypt_service`
+        ttl = 300
+        if self.cfg.has_option('SFLvault', 'groupkey_cache_ttl'):
+            ttl = int(self.cfg.get('SFLvault', 'groupkey_cache_ttl'))
+        self.groupkeys = GroupKeyCache(ttl)
+        # Keep-alive connections to the vault, shared by all the calls
+        pool_size = 4
+        if self.cfg.has_option('SFLvault', 'pool_size'):
+            pool_size = int(self.cfg.get('SFLvault', 'pool_size'))
+        idle_timeout = 20
+        if self.cfg.has_option('SFLvault', 'pool_idle_timeout'):
+            idle_timeout = int(self.cfg.get('SFLvault', 'pool_idle_timeout'))
+        self.pool = ConnectionPool(pool_size, idle_timeout)
+        # Set the default route to the Vault. 'protocol' becomes 'jsonrpc'
+        # when the vault offers it, see _use_jsonrpc().
+        self.vault_url = None
+        self.vault_protocol = 'xmlrpc'
         url = self.cfg.get('SFLvault', 'url')
         if url:
-            self.vault = xmlrpclib.Server(url, allow_none=True).sflvault
+            self._set_vault(url)
 
     def set_getpassfunc(self, func=None):
         """Set the function to ask for passphrase.
@@ -440,10 +528,41 @@ class SFLvaultClient(object):
         
     def _set_vault(self, url, save=False):
         """Set the vault's URL and optionally save it"""
-        self.vault = xmlrpclib.Server(url, allow_none=True).sflvault
+        transport = PooledTransport(self.pool, urlparse.urlsplit(url)[0])
+        self.vault = xmlrpclib.Server(url, transport=transport,
+                                      allow_none=True).sflvault
+        self.vault_url = url
+        self.vault_protocol = 'xmlrpc'
+        # Our authtok, if any, was for the previous vault
+        self.authtok_expires = 0
         if save:
             self.cfg.set('SFLvault', 'url', url)
 
+    def _use_jsonrpc(self, path):
+        """Switch to the JSON-RPC endpoint announced by the vault at login,
+        unless the 'protocol' option is set to 'xmlrpc' in the config."""
+        if self.vault_protocol == 'jsonrpc':
+            return
+        if self.cfg.has_option('SFLvault', 'protocol') and \
+                self.cfg.get('SFLvault', 'protocol') == 'xmlrpc':
+            return
+        url = urlparse.urljoin(self.vault_url, path)
+        self.vault = JSONRPCServer(url, self.pool).sflvault
+        self.vault_protocol = 'jsonrpc'
+
+    def _set_authtok(self, retval, started):
+        """Keep the authtok returned by vault.authenticate, and when it
+        expires if the vault told us (counted from `started`, the time we
+        sent the login, to stay on the safe side)."""
+        self.authtok = retval['authtok']
+        self.authtok_expires = 0
+        if retval.get('timeout'):
+            self.authtok_expires = started + int(retval['timeout'])
+
+    def _authtok_fresh(self):
+        """Return True if our authtok is still valid on the vault"""
+        return bool(self.authtok) and time.time() < self.authtok_expires
+
     def vaultId(self, vid, prefix, check_alias=True):
         """Return an integer value for a given VaultID.
         
@@ -654,6 +773,54 @@ class SFLvaultClient(object):
         return retval
                             
 
+    @authenticate(True)
+    def service_passwd_bulk(self, passwords=None, filters=None, policy=None,
+                            chunk_size=100, progress=None):
+        """Change the passwords of many services, `chunk_size` at a time.
+
+        passwords - list of (service_id, newsecret) pairs, or
+        filters - dict of 'customers', 'machines' and/or 'groups' IDs lists,
+                  selecting the services to give a generated password,
+                  following the `policy` dict ('length' and 'charset').
+        progress - called with (done, total) after each chunk
+
+        Returns a dict with the 'rotated' and 'skipped' service IDs, and the
+        generated 'secrets' as (service_id, newsecret) pairs.
+        """
+        out = {'rotated': [], 'skipped': [], 'secrets': []}
+
+        def step(retval, total):
+            for x in ['rotated', 'skipped', 'secrets']:
+                out[x].extend(retval.get(x, []))
+            if progress:
+                progress(len(out['rotated']) + len(out['skipped']), total)
+
+        if passwords:
+            passwords = [list(x) for x in passwords]
+            for start in range(0, len(passwords), chunk_size):
+                retval = vaultReply(self.vault.service_passwd_bulk(
+                        self.authtok, passwords[start:start + chunk_size],
+                        None, None, chunk_size),
+                                    "Error changing passwords")
+                step(retval, len(passwords))
+        else:
+            after_id = 0
+            while True:
+                retval = vaultReply(self.vault.service_passwd_bulk(
+                        self.authtok, None, filters, policy, chunk_size,
+                        after_id, chunk_size),
+                                    "Error changing passwords")
+                step(retval, len(out['rotated']) + len(out['skipped']) +
+                     len(retval['rotated']) + len(retval['skipped']) +
+                     retval['remaining'])
+                if not retval['remaining']:
+                    break
+                after_id = retval['last_id']
+
+        out['secrets'] = [tuple(x) for x in out['secrets']]
+        return out
+
+
     def _new_passphrase(self):
         """Return a new passphrase after asking arrogantly"""
         while True:
@@ -819,22 +986,42 @@ class SFLvaultClient(object):
 
         return retval
             
+    @authenticate()
+    def search_pages(self, query, filters=None, verbose=False, limit=500):
+        """Search the database, yielding the results a page at a time.
+
+        Same as search(), but each page holds at most `limit` services, and
+        is only fetched when the previous one was consumed.  A customer or
+        machine can show up in many pages.
+        """
+        if filters:
+            filters = dict([(x, filters[x]) for x in filters if filters[x]])
+
+        token = ''
+        while True:
+            retval = vaultReply(self.vault.search(self.authtok, query,
+                     filters.get('groups') if filters else None, verbose,
+                     filters, limit, token),
+                                "Error searching database")
+            yield retval['results']
+            token = retval['next']
+            if not token:
+                break
+
     def _decrypt_service(self, serv, onlysymkey=False, onlygroupkey=False):
         """Decrypt the service object returned from the vault.
 
         onlysymkey - return the plain symkey in the result
         onlygroupkey - return the plain groupkey ElGamal obj in result
         """
-        # First decrypt groupkey
+        # First decrypt groupkey, it's the longest thing to decrypt (over a
+        # second on a 3GHz machine), so it goes through the cache.
         try:
-            # TODO: implement a groupkey cache system, since it's the longest
-            #       thing to decrypt (over a second on a 3GHz machine)
-            grouppacked = decrypt_longmsg(self.privkey, serv['cryptgroupkey'])
+            eg = self.groupkeys.get(self.privkey, serv.get('group_id'),
+                                    serv['cryptgroupkey'])
         except Exception, e:
             raise DecryptError("Unable to decrypt groupkey (%s)" % e)
 
-        eg = ElGamal.ElGamalobj()
-        (eg.p, eg.x, eg.g, eg.y) = unserial_elgamal_privkey(grouppacked)
         groupkey = eg
         
         if onlygroupkey:
@@ -900,6 +1087,33 @@ class SFLvaultClient(object):
         return retval['services']
 
 
+    @authenticate(True)
+    def service_get_many(self, service_ids, with_groups=False):
+        """Get the service trees of several services in one round trip.
+
+        Returns a list with, for each of `service_ids`, the same list as
+        service_get_tree().  Each group key is decrypted only once, and
+        each service only once, even if it's the parent of many others.
+        """
+        retval = vaultReply(self.vault.service_get_many(self.authtok,
+                                                        list(service_ids),
+                                                        with_groups),
+                "Error fetching data for services %s" % list(service_ids))
+
+        decrypted = {}
+        for tree in retval['services']:
+            for x in tree:
+                if not x['cryptsymkey']:
+                    # Don't add a plaintext if we can't.
+                    continue
+                if x['id'] not in decrypted:
+                    self._decrypt_service(x)
+                    decrypted[x['id']] = x['plaintext']
+                x['plaintext'] = decrypted[x['id']]
+
+        return retval['services']
+
+
     @authenticate(True)
     def service_put(self, service_id, data):
         """Save the (potentially modified) service to the Vault"""
@@ -990,10 +1204,11 @@ class SFLvaultClient(object):
         #connection.debug_chain()
 
     @authenticate()
-    def user_list(self, groups=False):
+    def user_list(self, groups=False, group_ids=None):
         """List users
 
         ``groups`` - if True, list groups for each user also
+        ``group_ids`` - list the members of these groups only
         """
         # Receive: [{'id': x.id, 'username': x.username,
         #            'created_time': x.created_time,
@@ -1001,7 +1216,10 @@ class SFLvaultClient(object):
         #            'setup_expired': x.setup_expired()}
         #            {}, {}, ...]
         #    
-        retval = vaultReply(self.vault.user_list(self.authtok, groups),
+        args = [groups]
+        if group_ids:
+            args += [None, group_ids]
+        retval = vaultReply(self.vault.user_list(self.authtok, *args),
                             "Error listing users")
 
         print "User list (with creation date):"
@@ -1098,8 +1316,9 @@ class SFLvaultClient(object):
                             "Error adding user to group")
 
         # Decrypt cryptgroupkey
-        # TODO: make use of a cache
-        grouppacked = decrypt_longmsg(self.privkey, retval['cryptgroupkey'])
+        groupkey = self.groupkeys.get(self.privkey, retval['group_id'],
+                                      retval['cryptgroupkey'])
+        grouppacked = serial_elgamal_privkey(elgamal_bothkeys(groupkey))
         
         # Get userpubkey and unpack
         eg = ElGamal.ElGamalobj()
@@ -1128,6 +1347,70 @@ class SFLvaultClient(object):
         print "Success: %s" % retval['message']
         return retval
     
+    @authenticate(True)
+    def group_rekey(self, group_id, batch_size=100, progress=None):
+        """Replace a group's keypair, re-encrypting all its services' symkeys.
+
+        Do this after removing someone from a group, so that the group key
+        he had doesn't give access to the group's services anymore.  An
+        interrupted re-keying is resumed by calling this again.
+
+        progress - called with (done, total) after each batch of services
+        """
+        retval = vaultReply(self.vault.group_rekey_start(self.authtok,
+                                                         group_id),
+                            "Error starting the re-keying of group %s"
+                            % group_id)
+        oldkey = self.groupkeys.get(self.privkey, retval['group_id'],
+                                    retval['cryptgroupkey'])
+        newkey = ElGamal.ElGamalobj()
+        (newkey.p, newkey.g, newkey.y) = \
+            unserial_elgamal_pubkey(retval['pubkey'])
+        new_cryptgroupkey = retval['new_cryptgroupkey']
+
+        cryptgroupkeys = []
+        while True:
+            while True:
+                retval = vaultReply(self.vault.group_rekey_next(
+                        self.authtok, group_id, batch_size),
+                                    "Error re-keying group %s" % group_id)
+                if not retval['symkeys']:
+                    break
+                symkeys = []
+                for service_id, cryptsymkey in retval['symkeys']:
+                    symkey = decrypt_longmsg(oldkey, cryptsymkey)
+                    symkeys.append([service_id,
+                                    hashlib.sha1(cryptsymkey).hexdigest(),
+                                    encrypt_longmsg(newkey, symkey)])
+                    del(symkey)
+                retval = vaultReply(self.vault.group_rekey_put(
+                        self.authtok, group_id, symkeys),
+                                    "Error re-keying group %s" % group_id)
+                if progress:
+                    progress(retval['total'] - retval['remaining'],
+                             retval['total'])
+
+            retval = self.vault.group_rekey_finish(self.authtok, group_id,
+                                                   cryptgroupkeys)
+            if not retval['error']:
+                break
+            if retval.get('missing_users') and new_cryptgroupkey:
+                # Give the new key to the members who joined meanwhile
+                grouppacked = decrypt_longmsg(self.privkey,
+                                              new_cryptgroupkey)
+                for user_id, userpubkey in retval['missing_users']:
+                    eg = ElGamal.ElGamalobj()
+                    (eg.p, eg.g, eg.y) = unserial_elgamal_pubkey(userpubkey)
+                    cryptgroupkeys.append([user_id,
+                                           encrypt_longmsg(eg, grouppacked)])
+                del(grouppacked)
+                new_cryptgroupkey = None
+            elif not retval.get('remaining'):
+                vaultReply(retval, "Error re-keying group %s" % group_id)
+
+        print "Success: %s" % retval['message']
+        return retval
+
     @authenticate()
     def group_add(self, group_name):
         """Add a named group to the Vault. Return the group id."""
@@ -1154,9 +1437,12 @@ class SFLvaultClient(object):
         return retval
 
     @authenticate()
-    def group_list(self, quiet=False):
-        """Simply list the available groups"""
-        retval = vaultReply(self.vault.group_list(self.authtok),
+    def group_list(self, quiet=False, user_ids=None):
+        """Simply list the available groups, or those of `user_ids`"""
+        args = []
+        if user_ids:
+            args = [False, None, user_ids]
+        retval = vaultReply(self.vault.group_list(self.authtok, *args),
                             "Error listing groups")
 
         print "Groups:"
@@ -82,7 +82,16 @@ class SFLvaultShell(object):
         
         print "Welcome to SFLvault. Type 'help' for help."
         prompt = "SFLvault> "
-        
+
+        try:
+            self._loop(prompt)
+        finally:
+            # Don't leave decrypted group keys behind us.
+            self.vault.groupkeys.wipe()
+            self.vault.pool.clear()
+
+    def _loop(self, prompt):
+        """Read and run commands until the user quits"""
         while True:
             cmd = raw_input(prompt)
             if not cmd:
@@ -115,6 +124,13 @@ class SFLvaultShell(object):
         """Exit command, only available in the shell"""
         raise KeyboardInterrupt()
 
+    def connections(self):
+        """Show how many connections to the vault were opened and reused,
+        only available in the shell"""
+        stats = self.vault.pool.stats()
+        print "Connections opened: %(created)d, reused: %(reused)d, " \
+              "retried: %(retried)d, idle: %(idle)d" % stats
+
 
 class SFLvaultCommand(object):
     """Parse command line arguments, and call SFLvault commands
@@ -601,6 +617,57 @@ class SFLvaultCommand(object):
         self.vault.service_passwd(service_id, newsecret)
 
 
+    def service_passwd_bulk(self):
+        """Generate new passwords for many services.
+
+        The new passwords are printed, so they can be changed on the
+        machines.
+        """
+        self.parser.set_usage("service-passwd-bulk [opts]")
+        self.parser.add_option('-g', '--group', dest="groups",
+                               action="append", type="string",
+                               help="Services in these groups")
+        self.parser.add_option('-m', '--machine', dest="machines",
+                               action="append", type="string",
+                               help="Services on these machines")
+        self.parser.add_option('-c', '--customer', dest="customers",
+                               action="append", type="string",
+                               help="Services of these customers")
+        self.parser.add_option('-l', '--length', dest="length",
+                               type="int", default=16,
+                               help="Length of the new passwords")
+        self.parser.add_option('--charset', dest="charset", default="alnum",
+                               help="alnum, printable, hex, or the "
+                                    "characters to use")
+        self._parse()
+
+        fields = {'groups': 'g',
+                  'machines': 'm',
+                  'customers': 'c'}
+        filters = {}
+        for f in fields.keys():
+            if getattr(self.opts, f):
+                filters[f] = [self.vault.vaultId(x, fields[f])
+                              for x in getattr(self.opts, f)]
+        if not filters:
+            raise SFLvaultParserError("At least one filter is required")
+
+        def progress(done, total):
+            print "%d/%d services" % (done, total)
+
+        retval = self.vault.service_passwd_bulk(
+            filters=filters,
+            policy={'length': self.opts.length,
+                    'charset': self.opts.charset},
+            progress=progress)
+
+        for service_id, secret in retval['secrets']:
+            print "s#%d: %s" % (service_id, secret)
+        if retval['skipped']:
+            print "Skipped (no access): %s" % ', '.join(
+                ['s#%d' % x for x in retval['skipped']])
+
+
     def alias(self):
         """Set an alias, local shortcut to VaultIDs (s#123, m#87, etc..)
 
@@ -664,16 +731,21 @@ class SFLvaultCommand(object):
 
         This option takes no argument, it lists the current users and their
         privileges."""
-        self.parser.set_usage("user-list [-g]")
+        self.parser.set_usage("user-list [-g] [-G group_id ...]")
         self.parser.add_option('-g', '--groups', default=False,
                                action="store_true", dest="groups",
                                help="List user's group infos")
+        self.parser.add_option('-G', '--in-group', dest="group_ids",
+                               action="append", type="string",
+                               help="List the members of these groups only")
         self._parse()
 
         if len(self.args):
             raise SFLvaultParserError("Invalid number of arguments")
 
-        self.vault.user_list(self.opts.groups)
+        group_ids = [self.vault.vaultId(x, 'g')
+                     for x in self.opts.group_ids or []]
+        self.vault.user_list(self.opts.groups, group_ids)
 
 
     def _group_service_options(self):
@@ -736,7 +808,11 @@ class SFLvaultCommand(object):
 
     def group_del_user(self):
         """Remove a user from a group"""
-        self.parser.set_usage("group-del-user -g <group_id> -u <user>")
+        self.parser.set_usage("group-del-user [-r] -g <group_id> -u <user>")
+        self.parser.add_option('-r', '--rekey', action="store_true",
+                               dest='rekey', default=False,
+                               help="Re-key the group afterwards (see "
+                                    "group-rekey)")
         self._group_user_options()
         self._parse()
 
@@ -744,6 +820,30 @@ class SFLvaultCommand(object):
         
         self.vault.group_del_user(self.opts.group_id, self.opts.user)
 
+        if self.opts.rekey:
+            self.vault.group_rekey(self.opts.group_id,
+                                   progress=self._rekey_progress)
+
+    def _rekey_progress(self, done, total):
+        print "%d/%d services re-encrypted" % (done, total)
+
+    def group_rekey(self):
+        """Replace a group's keys, and re-encrypt all its services
+
+        Run this after removing someone from a group, so the group key he
+        had becomes useless.  Run it again to resume an interrupted
+        re-keying."""
+        self.parser.set_usage("group-rekey -g <group_id>")
+        self.parser.add_option('-g', dest="group_id", default=None,
+                               help="Group to be re-keyed")
+        self._parse()
+
+        if not self.opts.group_id:
+            raise SFLvaultParserError("group_id is required")
+
+        group_id = self.vault.vaultId(self.opts.group_id, 'g')
+        self.vault.group_rekey(group_id, progress=self._rekey_progress)
+
     def group_del(self):
         """Remove a group from the vault
 
@@ -780,12 +880,17 @@ class SFLvaultCommand(object):
         self.parser.set_usage("group-list [options]")
         self.parser.add_option('-q', dest='quiet', default=False,
                                action="store_true", help="Hide members")
+        self.parser.add_option('-u', '--user', dest="user_ids",
+                               action="append", type="string",
+                               help="List the groups of these users only")
         self._parse()
 
         if len(self.args):
             raise SFLvaultParserError("Invalid number of arguments")
 
-        self.vault.group_list(self.opts.quiet)
+        user_ids = [self.vault.vaultId(x, 'u')
+                    for x in self.opts.user_ids or []]
+        self.vault.group_list(self.opts.quiet, user_ids)
 
 
     def machine_list(self):
@@ -0,0 +1,78 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""JSON-RPC transport, used instead of XML-RPC when the vault offers it.
+
+JSONRPCServer has the same interface as xmlrpclib.Server, so that
+``JSONRPCServer(url).sflvault.search(...)`` works like the XML-RPC call,
+and returns the same values (ASCII strings as str, dates as
+xmlrpclib.DateTime, faults as xmlrpclib.Fault).  Requests go through a
+transport.ConnectionPool, which can be shared with the XML-RPC proxy.
+"""
+
+import json
+import xmlrpclib
+
+from sflvault.common.jsonrpc import default, decode
+from sflvault.client.transport import ConnectionPool
+
+
+__all__ = ['JSONRPCServer']
+
+
+class _Method(object):
+    def __init__(self, send, name):
+        self._send = send
+        self._name = name
+
+    def __getattr__(self, name):
+        return _Method(self._send, "%s.%s" % (self._name, name))
+
+    def __call__(self, *args):
+        return self._send(self._name, args)
+
+
+class JSONRPCServer(object):
+    """JSON-RPC 2.0 server proxy"""
+    def __init__(self, url, pool=None):
+        self._url = url
+        self._pool = pool or ConnectionPool()
+        self._id = 0
+
+    def _request(self, method, params):
+        self._id += 1
+        body = json.dumps({'jsonrpc': '2.0', 'id': self._id,
+                           'method': method, 'params': list(params)},
+                          default=default)
+        (status, reason, data) = self._pool.post(self._url, body,
+                                          {'Content-Type': 'application/json'})
+        if status != 200:
+            raise xmlrpclib.ProtocolError(self._url, status, reason, {})
+        response = json.loads(data)
+
+        if response.get('error'):
+            error = response['error']
+            raise xmlrpclib.Fault(error.get('code', -32603),
+                                  error.get('message', ''))
+        return decode(response.get('result'))
+
+    def __getattr__(self, name):
+        return _Method(self._request, name)
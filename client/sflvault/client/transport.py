@@ -0,0 +1,201 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Keep-alive HTTP connections to the vault, shared by the RPC proxies.
+
+xmlrpclib.Transport opens a new connection (and does a new TLS handshake)
+for each call, and @authenticate makes a few calls before the real one.
+The ConnectionPool keeps the connections open between calls, so that a
+command pays for the handshake once.  The vault must speak HTTP/1.1 for
+the connections to be kept open (``protocol_version = HTTP/1.1`` in the
+[server:main] section of its .ini file), and idle_timeout should be below
+the server's ``socket_timeout``.
+"""
+
+import time
+import errno
+import socket
+import httplib
+import urlparse
+import xmlrpclib
+import threading
+
+
+__all__ = ['ConnectionPool', 'PooledTransport']
+
+
+def _closed_by_server(error):
+    """Return True if `error` shows that the server had closed the
+    connection before our request: it didn't get it, we can send it again.
+    A timeout, or anything after the status line, could be from a request
+    the server did process."""
+    if isinstance(error, httplib.BadStatusLine):
+        # Nothing received, the connection was closed (the message changed
+        # across python versions)
+        return error.line in ('', "''") or \
+            error.line.startswith('No status line')
+    if isinstance(error, socket.error):
+        return error.errno in (errno.ECONNRESET, errno.EPIPE)
+    return False
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of idle HTTP(S) connections, per host.
+
+    size - maximum number of idle connections kept for each host, 0 closes
+           the connections after each request
+    idle_timeout - seconds after which an idle connection is not reused
+                   anymore (the server has most probably closed it)
+    timeout - socket timeout of the connections, in seconds
+    """
+    def __init__(self, size=4, idle_timeout=20, timeout=None):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+        self.created = 0
+        self.reused = 0
+        self.retried = 0
+        # Complete responses
+        self.answered = 0
+
+    def _connect(self, scheme, host):
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=self.timeout)
+        return httplib.HTTPConnection(host, timeout=self.timeout)
+
+    def _get(self, scheme, host):
+        """Return (connection, reused), taking the most recently used idle
+        connection to `host` if there is one still fresh."""
+        now = time.time()
+        conn = None
+        self._lock.acquire()
+        try:
+            idle = self._idle.get((scheme, host), [])
+            stale = [c for t, c in idle if now - t >= self.idle_timeout]
+            idle[:] = [(t, c) for t, c in idle if now - t < self.idle_timeout]
+            if idle:
+                conn = idle.pop()[1]
+                self.reused += 1
+            else:
+                self.created += 1
+        finally:
+            self._lock.release()
+
+        for c in stale:
+            c.close()
+        if conn:
+            return (conn, True)
+        return (self._connect(scheme, host), False)
+
+    def _put(self, scheme, host, conn):
+        """Give back a connection after a complete response"""
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault((scheme, host), [])
+            if len(idle) < self.size:
+                idle.append((time.time(), conn))
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def post(self, url, body, headers):
+        """POST `body` to `url`, return (status, reason, data)"""
+        (scheme, host, path, query, fragment) = urlparse.urlsplit(url)
+        if query:
+            path = "%s?%s" % (path, query)
+
+        while True:
+            (conn, reused) = self._get(scheme, host)
+            response = None
+            try:
+                conn.request('POST', path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                if reused and response is None and _closed_by_server(e):
+                    # The server closed the idle connection in the meantime,
+                    # without reading our request: try again (on a new one
+                    # if there's no other left).
+                    self.retried += 1
+                    continue
+                raise
+
+            self._lock.acquire()
+            try:
+                self.answered += 1
+            finally:
+                self._lock.release()
+            if response.will_close:
+                conn.close()
+            else:
+                self._put(scheme, host, conn)
+            return (response.status, response.reason, data)
+
+    def clear(self):
+        """Close all the idle connections"""
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = {}
+        finally:
+            self._lock.release()
+        for conns in idle.values():
+            for last_used, conn in conns:
+                conn.close()
+
+    def stats(self):
+        """Return a dict with the pool's counters"""
+        self._lock.acquire()
+        try:
+            idle = sum([len(x) for x in self._idle.values()])
+        finally:
+            self._lock.release()
+        return {'created': self.created,
+                'reused': self.reused,
+                'retried': self.retried,
+                'answered': self.answered,
+                'idle': idle}
+
+
+class PooledTransport(xmlrpclib.Transport):
+    """xmlrpclib transport sending its requests through a ConnectionPool"""
+    def __init__(self, pool, scheme='http', use_datetime=0):
+        xmlrpclib.Transport.__init__(self, use_datetime)
+        self.pool = pool
+        self.scheme = scheme
+
+    def request(self, host, handler, request_body, verbose=0):
+        url = "%s://%s%s" % (self.scheme, host, handler)
+        (status, reason, data) = self.pool.post(url, request_body,
+                                                {'Content-Type': 'text/xml',
+                                                 'User-Agent': self.user_agent})
+        if status != 200:
+            raise xmlrpclib.ProtocolError(host + handler, status, reason, {})
+
+        (parser, unmarshaller) = self.getparser()
+        parser.feed(data)
+        parser.close()
+        return unmarshaller.close()
@@ -0,0 +1,71 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""JSON encoding of the vault's JSON-RPC calls, shared by the server's
+/vault/json endpoint and the client.
+
+JSON lacks two things of XML-RPC, which the vault and its clients rely on:
+
+- dates: they're sent as JSON-RPC 1.0 class hints,
+  {"__jsonclass__": ["datetime", "20091231T23:59:59"]}, and decoded as
+  xmlrpclib.DateTime, like XML-RPC's dateTime.iso8601;
+- str: JSON strings are decoded as unicode, while xmlrpclib gives str for
+  ASCII strings, which the crypto functions expect.
+
+So that both transports give the same values, encode with
+json.dumps(value, default=default), and pass the decoded values through
+decode().
+"""
+
+import xmlrpclib
+from datetime import datetime
+
+
+__all__ = ['default', 'decode']
+
+
+def default(obj):
+    """json.dumps() `default` for the dates"""
+    if isinstance(obj, datetime):
+        return {'__jsonclass__': ['datetime',
+                                  obj.strftime('%Y%m%dT%H:%M:%S')]}
+    if isinstance(obj, xmlrpclib.DateTime):
+        return {'__jsonclass__': ['datetime', obj.value]}
+    raise TypeError("%r is not JSON serializable" % obj)
+
+
+def decode(value):
+    """Return the value decoded by json.loads() as xmlrpclib would give
+    it: ASCII strings as str, dates as xmlrpclib.DateTime"""
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeError:
+            return value
+    if isinstance(value, list):
+        return [decode(x) for x in value]
+    if isinstance(value, dict):
+        hint = value.get('__jsonclass__')
+        if len(value) == 1 and isinstance(hint, list) and len(hint) == 2 \
+                and hint[0] == 'datetime':
+            return xmlrpclib.DateTime(str(hint[1]))
+        return dict([(decode(k), decode(v)) for k, v in value.iteritems()])
+    return value
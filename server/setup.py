@@ -61,6 +61,10 @@ setup(name='SFLvault-server',
       entry_points = """\
       [paste.app_factory]
       main = sflvault:main
+      [paste.server_runner]
+      main = sflvault.lib.httpserver:server_runner
+      [console_scripts]
+      sflvault-traces = sflvault.lib.tracing:main
       """,
       paster_plugins=['pyramid'],
 )
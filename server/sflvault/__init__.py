@@ -38,18 +38,112 @@ def main(global_config, **settings):
     import transaction
     print "Global config: %s " % global_config
     print "settings: %s" % settings
-    engine = engine_from_config(settings, 'sqlalchemy.')
+    # The trigram index only sees the changes of its own process.
+    if settings.get('sflvault.search_index', 'like') == 'trigram' and \
+            settings.get('sflvault.vault.session_store', 'memory') != 'memory':
+        raise ValueError("sflvault.search_index = trigram needs a single "
+                         "server process, but sflvault.vault.session_store "
+                         "is for many: use 'like'")
+    # Fork the crypto pool's workers before any thread or connection.
+    from sflvault.lib.cryptopool import cryptopool_from_settings
+    cryptopool = cryptopool_from_settings(settings)
+    # sqlalchemy.replica.* configure the optional read-only replica.
+    primary = dict([(k, v) for k, v in settings.items()
+                    if not k.startswith('sqlalchemy.replica.')])
+    engine = engine_from_config(primary, 'sqlalchemy.')
+    replica = None
+    if settings.get('sqlalchemy.replica.url'):
+        replica = engine_from_config(settings, 'sqlalchemy.replica.')
 #    initialize_sql(engine)
     config = Configurator(settings=settings)
     config.include('pyramid_rpc.xmlrpc')
     config.add_xmlrpc_endpoint('sflvault', '/vault/rpc')
+    # Same methods, JSON-encoded (see sflvault.lib.jsonrpc)
+    from sflvault.lib.jsonrpc import renderer_factory
+    config.include('pyramid_rpc.jsonrpc')
+    config.add_renderer('sflvault-json', renderer_factory)
+    config.add_jsonrpc_endpoint('sflvault-json', '/vault/json',
+                                default_renderer='sflvault-json')
     config.scan('sflvault.views')
 #    config.add_view(SflVaultController,  route_name='xmlrpcvault')
 #    session_factory = session_factory_from_settings(settings)
 #    config.set_session_factory(session_factory)
 
-    init_model(engine)
-    model.meta.metadata.create_all(engine)
+    init_model(engine, replica)
+    # Create the tables, or bring an existing vault's schema up to date.
+    from sflvault.lib import migrations
+    applied = migrations.upgrade(engine)
+    if applied:
+        log.info("Vault schema at version %d" % applied[-1])
+
+    # Fill the access index on vaults created before it, or check it.
+    from sflvault.lib import access
+    if settings.get('sflvault.vault.access_check', 'false').lower() in \
+            ['1', 'true', 't']:
+        diff = access.check()
+        if diff['missing'] or diff['extra'] or diff['stale']:
+            log.warning("Access index out of date (%d missing, %d extra, %d "
+                        "stale rows), rebuilding it" % (len(diff['missing']),
+                                                        len(diff['extra']),
+                                                        len(diff['stale'])))
+            access.rebuild()
+            transaction.commit()
+    elif access.is_empty():
+        access.rebuild()
+        transaction.commit()
+
+    from sflvault import views
+    from sflvault.lib.sessions import session_store_from_settings
+    from sflvault.lib.sessions import SessionSweeper
+    views.vaultSessions = session_store_from_settings(settings)
+    SessionSweeper(views.vaultSessions,
+                   int(settings.get('sflvault.vault.session_sweep_interval',
+                                    60))).start()
+
+    from sflvault.lib.keypool import keypool_from_settings, KeypairFiller
+    views.vault.keypool = keypool_from_settings(settings, cryptopool)
+    if views.vault.keypool:
+        KeypairFiller(views.vault.keypool).start()
+
+    views.vault.cryptopool = cryptopool
+    views.vault.bulk_chunk_size = int(settings.get(
+            'sflvault.vault.bulk_chunk_size', 100))
+    views.replica_lag = int(settings.get('sflvault.vault.replica_lag', 5))
+
+    if settings.get('sflvault.metrics', 'false').lower() in ['1', 'true', 't']:
+        from sflvault.lib import metrics
+        metrics.watch_engine(engine)
+        if replica is not None:
+            metrics.watch_engine(replica)
+        metrics.gauge('sflvault_sessions', 'Open sessions',
+                      lambda: len(views.vaultSessions))
+        if views.vault.keypool:
+            metrics.gauge('sflvault_keypool_size', 'Pre-generated keypairs',
+                          lambda: len(views.vault.keypool))
+        if views.vault.cryptopool:
+            metrics.gauge('sflvault_cryptopool_pending',
+                          'Crypto pool jobs queued or running',
+                          lambda: len(views.vault.cryptopool))
+        config.add_route('metrics', '/metrics')
+        config.add_view(views.sflvault_metrics, route_name='metrics')
+
+    from sflvault.lib import tracing
+    tracing.tracer = tracing.tracer_from_settings(settings)
+    if tracing.tracer:
+        from sflvault.lib import vault, keypool, cryptopool
+        config.add_tween('sflvault.lib.tracing.tween_factory')
+        tracing.watch_engine(engine)
+        if replica is not None:
+            tracing.watch_engine(replica)
+        tracing.trace_methods(vault.SFLvaultAccess)
+        for module in [model, views, vault, keypool, cryptopool]:
+            tracing.trace_functions(module)
+
+    if settings.get('sflvault.search_index', 'like') == 'trigram':
+        from sflvault.lib.search import TrigramIndex
+        views.vault.search_index = TrigramIndex()
+        views.vault.search_index.build()
+        log.info("Search index built")
     #Add admin user if not present
     if not model.query(model.User).filter_by(username='admin').first():
         log.info ("It seems like you are using SFLvault for the first time. An\
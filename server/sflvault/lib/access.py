@@ -0,0 +1,199 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Materialized user -> service access index.
+
+A user can read a service when one of his groups holds the service's
+symkey, which is the users_groups/services_groups join.  The
+``user_service_access`` table keeps, for each (user_id, service_id), the
+row of that join with the lowest group_id: the group, the user's
+cryptgroupkey and the service's cryptsymkey.  Questions like "can u#X
+decrypt s#N" or "what can u#X open" are then a lookup on its primary key.
+
+SFLvaultAccess calls refresh() in the same transaction as each change to
+the users_groups or services_groups rows.  check() compares the table to
+the join, and rebuild() fills it again from scratch.
+
+Two transactions adding u#X to g#Y and s#N to g#Y wouldn't see each
+other's row, and neither would write the (X, N) row.  So refresh() first
+locks the rows of the groups involved (SELECT ... FOR UPDATE), and the
+refreshes of a group run one after the other, each seeing the previous
+one's changes.  That's skipped on SQLite, which has no row locks, but
+only one writer at a time anyway.
+"""
+
+from sqlalchemy import sql
+from zope.sqlalchemy import mark_changed
+
+from sflvault.model import meta, useraccess_table
+from sflvault.model import usergroups_table, servicegroups_table
+from sflvault.model import groups_table
+
+
+__all__ = ['access_get', 'access_list', 'refresh', 'rebuild', 'check',
+           'is_empty']
+
+
+# Stay below SQLite's 999 bound parameters.
+CHUNK_SIZE = 500
+
+def _chunks(ids):
+    ids = sorted(set(ids))
+    for i in range(0, len(ids), CHUNK_SIZE):
+        yield ids[i:i + CHUNK_SIZE]
+
+
+def _join_rows(user_ids=None, service_ids=None):
+    """Compute the index rows from the users_groups/services_groups join,
+    for the given users or services, or for everything.  Returns a dict
+    keyed by (user_id, service_id)."""
+    ug = usergroups_table
+    sg = servicegroups_table
+    sel = sql.select([ug.c.user_id, sg.c.service_id, sg.c.group_id,
+                      ug.c.cryptgroupkey, sg.c.cryptsymkey],
+                     from_obj=[sql.join(sg, ug, sg.c.group_id == ug.c.group_id)])\
+             .order_by(sg.c.group_id)
+    if user_ids is not None:
+        sel = sel.where(ug.c.user_id.in_(user_ids))
+    if service_ids is not None:
+        sel = sel.where(sg.c.service_id.in_(service_ids))
+
+    rows = {}
+    for row in meta.Session.execute(sel):
+        # The first group, by id, wins.
+        rows.setdefault((row.user_id, row.service_id), dict(row))
+    return rows
+
+
+def _insert(rows):
+    if rows:
+        meta.Session.execute(useraccess_table.insert(), rows.values())
+
+
+def access_get(user_id, service_id):
+    """Return the index row giving `user_id` access to `service_id`, or
+    None"""
+    t = useraccess_table
+    return meta.Session.execute(sql.select([t])\
+                                    .where(t.c.user_id == user_id)\
+                                    .where(t.c.service_id == service_id))\
+                       .first()
+
+
+def access_list(user_id, service_ids=None):
+    """Return the index rows of all the services `user_id` can read, or of
+    those in `service_ids`"""
+    t = useraccess_table
+    sel = sql.select([t]).where(t.c.user_id == user_id)
+    if service_ids is None:
+        return list(meta.Session.execute(sel.order_by(t.c.service_id)))
+    out = []
+    for ids in _chunks(service_ids):
+        out.extend(meta.Session.execute(sel.where(t.c.service_id.in_(ids))))
+    return out
+
+
+def _lock_groups(users, services, groups):
+    """Lock the rows of the given groups, and of the groups of the given
+    users and services, until the end of the transaction"""
+    if meta.engine.dialect.name == 'sqlite':
+        return
+    ug = usergroups_table
+    sg = servicegroups_table
+    g = groups_table
+    groups = set(groups)
+    for ids in _chunks(users):
+        groups.update([x[0] for x in meta.Session.execute(
+            sql.select([ug.c.group_id]).where(ug.c.user_id.in_(ids)))])
+    for ids in _chunks(services):
+        groups.update([x[0] for x in meta.Session.execute(
+            sql.select([sg.c.group_id]).where(sg.c.service_id.in_(ids)))])
+    # Always in the same order, so that two refreshes can't deadlock.
+    for ids in _chunks(groups):
+        meta.Session.execute(sql.select([g.c.id], g.c.id.in_(ids),
+                                        for_update=True).order_by(g.c.id))
+
+
+def refresh(users=None, services=None, groups=None, lock=None):
+    """Recompute the rows of the given user, service and group IDs.
+
+    Call in the transaction that modified the users_groups or
+    services_groups rows, before committing.  `lock` are the IDs of the
+    groups that lost users or services: they're not found from the users
+    and services anymore, but must be locked too.
+    """
+    t = useraccess_table
+    # Pending ORM changes must be seen by the queries below.
+    meta.Session.flush()
+    _lock_groups(users or [], services or [],
+                 list(groups or []) + list(lock or []))
+
+    services = set(services or [])
+    if groups:
+        sg = servicegroups_table
+        for ids in _chunks(groups):
+            services.update([x[0] for x in meta.Session.execute(
+                sql.select([sg.c.service_id]).where(sg.c.group_id.in_(ids)))])
+            services.update([x[0] for x in meta.Session.execute(
+                sql.select([t.c.service_id]).where(t.c.group_id.in_(ids)))])
+
+    for ids in _chunks(users or []):
+        meta.Session.execute(t.delete().where(t.c.user_id.in_(ids)))
+        _insert(_join_rows(user_ids=ids))
+    for ids in _chunks(services):
+        meta.Session.execute(t.delete().where(t.c.service_id.in_(ids)))
+        _insert(_join_rows(service_ids=ids))
+
+    mark_changed(meta.Session())
+
+
+def rebuild():
+    """Fill the index again from scratch, in the current transaction.
+    Returns the number of rows."""
+    meta.Session.flush()
+    meta.Session.execute(useraccess_table.delete())
+    rows = _join_rows()
+    _insert(rows)
+    mark_changed(meta.Session())
+    return len(rows)
+
+
+def is_empty():
+    """Return True if the index has no rows at all, as when the table was
+    just created on an existing vault"""
+    return not meta.Session.execute(sql.select([useraccess_table.c.user_id])\
+                                        .limit(1)).first()
+
+
+def check():
+    """Compare the index with the users_groups/services_groups join.
+
+    Returns a dict of (user_id, service_id) lists: 'missing' rows, 'extra'
+    rows, and 'stale' rows that don't have the right group or keys.
+    """
+    expected = _join_rows()
+    actual = dict([((row.user_id, row.service_id), dict(row))
+                   for row in meta.Session.execute(
+                           sql.select([useraccess_table]))])
+    return {'missing': sorted(set(expected) - set(actual)),
+            'extra': sorted(set(actual) - set(expected)),
+            'stale': sorted([k for k in expected
+                             if k in actual and expected[k] != actual[k]])}
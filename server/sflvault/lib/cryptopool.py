@@ -0,0 +1,244 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Process pool for the public-key operations of the requests.
+
+ElGamal encryptions and keypair generations are 1536 bits modular
+exponentiations, which hold the GIL: done in a request thread, they stall
+every other request of the server process.  With a CryptoPool, they run on
+worker processes instead, and the request thread only waits for them:
+
+- login encrypts its challenge with the user's pubkey (encrypt_challenge());
+- group_add() and group_rekey_start() generate the group's keypair
+  (generate_keypair()), unless the keypool has one, and encrypt it for
+  each member (encrypt());
+- service_add(), service_passwd() and group_add_service() encrypt the
+  service's symmetric key for each of its groups (encrypt());
+- the KeypairFiller generates the keypool's keypairs.
+
+The jobs submitted and not finished yet are bounded (`max_pending`).  When
+that many are pending, the requests wait up to `queue_timeout` seconds for
+a slot, then fail with CryptoPoolBusy, instead of piling up.  A request
+waits up to `job_timeout` seconds for each job, then fails with
+CryptoPoolTimeout.  A job gives up its slot when it's done, or when its
+request stops waiting for it, so that a stuck job or a dead worker can't
+hold it forever.  The vault methods turn those errors into messages.
+
+Create the pool before starting any thread: its workers are forked, and
+would inherit the locks held by the other threads at that time.
+
+The pool is enabled with ``sflvault.vault.crypto_workers`` in the .ini
+file (0, the default, does it all in the request thread).
+"""
+
+import time
+import logging
+import threading
+import multiprocessing
+
+from Crypto import Random
+from Crypto.PublicKey import ElGamal
+
+from sflvault.common.crypto import *
+from sflvault.model import cached_elgamal
+from sflvault.lib import metrics
+
+
+__all__ = ['CryptoPool', 'CryptoPoolError', 'CryptoPoolBusy',
+           'CryptoPoolTimeout', 'encrypt_for_pubkeys',
+           'cryptopool_from_settings']
+
+log = logging.getLogger(__name__)
+
+
+class CryptoPoolError(Exception):
+    pass
+
+class CryptoPoolBusy(CryptoPoolError):
+    """Too many jobs pending, for too long"""
+
+class CryptoPoolTimeout(CryptoPoolError):
+    """A job took longer than the job timeout"""
+
+
+#
+# Jobs, run on the workers
+#
+def _encrypt(args):
+    """Encrypt `message` with a serialized ElGamal pubkey"""
+    (pubkey, message) = args
+    return encrypt_longmsg(cached_elgamal(pubkey, pubkey), message)
+
+
+def _encrypt_challenge(args):
+    """Encrypt the login challenge with a serialized ElGamal pubkey"""
+    (pubkey, message) = args
+    e = cached_elgamal(pubkey, pubkey)
+    return serial_elgamal_msg(e.encrypt(message, randfunc(32)))
+
+
+def _generate_keypair(args):
+    """Return a new keypair, serialized with serial_elgamal_privkey()"""
+    return serial_elgamal_privkey(elgamal_bothkeys(generate_elgamal_keypair()))
+
+
+def _call(job):
+    """Run the job (function, args), returning (True, result), or (False,
+    error) if it raised: the pool only calls back on success."""
+    (func, args) = job
+    try:
+        return (True, func(args))
+    except Exception, e:
+        return (False, '%s: %s' % (e.__class__.__name__, e))
+
+
+def encrypt_for_pubkeys(pubkeys, message):
+    """Encrypt `message` for each of the serialized pubkeys, in the calling
+    thread.  Returns the list of ciphertexts, in the same order."""
+    return [_encrypt((pubkey, message)) for pubkey in pubkeys]
+
+
+class CryptoPool(object):
+    """Pool of worker processes running the public-key operations, with a
+    bounded number of pending jobs"""
+    def __init__(self, workers, min_jobs=1, max_pending=None,
+                 queue_timeout=5, job_timeout=30):
+        self.workers = workers
+        # Batches smaller than this are encrypted in the calling thread
+        self.min_jobs = min_jobs
+        self.max_pending = max_pending or workers * 4
+        self.queue_timeout = queue_timeout
+        self.job_timeout = job_timeout
+        self.pending = 0
+        self.cond = threading.Condition()
+        # Re-seed the RNG in the children, or pycrypto refuses to run.
+        self.pool = multiprocessing.Pool(workers, initializer=Random.atfork)
+
+    def __len__(self):
+        """Number of pending jobs"""
+        return self.pending
+
+    def _reserve(self):
+        deadline = time.time() + self.queue_timeout
+        with self.cond:
+            while self.pending >= self.max_pending:
+                left = deadline - time.time()
+                if left <= 0:
+                    metrics.crypto_rejected.inc(('busy',))
+                    raise CryptoPoolBusy("The vault is busy, try again later "
+                                         "(%d crypto jobs pending)" %
+                                         self.pending)
+                self.cond.wait(left)
+            self.pending += 1
+
+    def _release(self, job):
+        """Give up the job's slot, once"""
+        with self.cond:
+            if job['released']:
+                return
+            job['released'] = True
+            self.pending -= 1
+            self.cond.notify()
+
+    def _submit(self, func, args, timeout=None):
+        """Queue a job, waiting for a slot.  Returns the job, for _wait()"""
+        self._reserve()
+        job = {'released': False,
+               'timeout': timeout or self.job_timeout}
+        job['deadline'] = time.time() + job['timeout']
+        try:
+            job['result'] = self.pool.apply_async(
+                _call, [(func, args)], callback=lambda ret: self._release(job))
+        except:
+            self._release(job)
+            raise
+        return job
+
+    def _wait(self, job):
+        try:
+            ok, value = job['result'].get(max(job['deadline'] - time.time(),
+                                              0))
+        except multiprocessing.TimeoutError:
+            metrics.crypto_rejected.inc(('timeout',))
+            raise CryptoPoolTimeout("Crypto job timed out after %s seconds" %
+                                    job['timeout'])
+        finally:
+            # The callback never comes if the worker died.
+            self._release(job)
+        if not ok:
+            raise CryptoPoolError(value)
+        return value
+
+    def run(self, func, args, timeout=None):
+        """Run func(args) on a worker, and return its result.  Waits up to
+        `timeout` seconds, job_timeout by default."""
+        return self._wait(self._submit(func, args, timeout))
+
+    def map(self, func, argslist):
+        """Run func(args) for each args on the workers, and return the
+        results in order"""
+        jobs = []
+        try:
+            for args in argslist:
+                jobs.append(self._submit(func, args))
+            return [self._wait(job) for job in jobs]
+        finally:
+            # Those left behind by an error
+            for job in jobs:
+                self._release(job)
+
+    def encrypt(self, pubkeys, message):
+        """Same as encrypt_for_pubkeys(), on the workers"""
+        pubkeys = list(pubkeys)
+        if len(pubkeys) < self.min_jobs:
+            return encrypt_for_pubkeys(pubkeys, message)
+        return self.map(_encrypt, [(pubkey, message) for pubkey in pubkeys])
+
+    def encrypt_challenge(self, pubkey, message):
+        """Encrypt the login challenge `message` with a serialized pubkey.
+        Returns it serialized with serial_elgamal_msg()."""
+        return self.run(_encrypt_challenge, (pubkey, message))
+
+    def generate_keypair(self, timeout=None):
+        """Return a new ElGamal keypair, generated on a worker"""
+        eg = ElGamal.ElGamalobj()
+        (eg.p, eg.x, eg.g, eg.y) = unserial_elgamal_privkey(
+            self.run(_generate_keypair, None, timeout))
+        return eg
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def cryptopool_from_settings(settings):
+    """Create the pool configured in the .ini file, or return None if it's
+    not enabled"""
+    workers = int(settings.get('sflvault.vault.crypto_workers', 0))
+    if workers <= 0:
+        return None
+    max_pending = int(settings.get('sflvault.vault.crypto_max_pending',
+                                   workers * 4))
+    queue_timeout = float(settings.get('sflvault.vault.crypto_queue_timeout',
+                                       5))
+    job_timeout = float(settings.get('sflvault.vault.crypto_job_timeout', 30))
+    return CryptoPool(workers, max_pending=max_pending,
+                      queue_timeout=queue_timeout, job_timeout=job_timeout)
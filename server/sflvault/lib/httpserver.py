@@ -0,0 +1,49 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Paste's HTTP server, with keep-alive connections on its thread pool.
+
+With HTTP/1.1, a worker of the pool serves a connection until the client
+closes it or it stays idle for ``socket_timeout`` seconds.  Paste sets the
+timeout when it accepts the connection, but its thread pool resets it
+when queuing the connection, so that idle clients would hold their worker
+forever.  WSGIHandler sets it again from the worker.
+
+Use it with ``use = egg:SFLvault_server`` in the [server:main] section.
+"""
+
+from paste import httpserver
+
+
+__all__ = ['WSGIHandler', 'server_runner']
+
+
+class WSGIHandler(httpserver.WSGIHandler):
+    """Paste's handler, applying the server's socket_timeout"""
+    def setup(self):
+        self.timeout = self.server.wsgi_socket_timeout
+        httpserver.WSGIHandler.setup(self)
+
+
+def server_runner(wsgi_app, global_conf, **kwargs):
+    """paste.server_runner taking the same options as egg:Paste#http"""
+    kwargs.setdefault('handler', WSGIHandler)
+    httpserver.server_runner(wsgi_app, global_conf, **kwargs)
@@ -0,0 +1,56 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""JSON encoding of the /vault/json endpoint.
+
+The JSON-RPC endpoint serves the same methods as the XML-RPC one.  JSON is
+more compact and much faster to (un)marshal than XML, especially for the
+big nested search results.  sflvault.common.jsonrpc encodes the dates and
+decodes the ASCII strings like xmlrpclib, which the crypto functions rely
+on: the ascii_args view decorator decodes the JSON-RPC arguments with it.
+"""
+
+import json
+
+from sflvault.common.jsonrpc import default, decode
+
+
+__all__ = ['dumps', 'renderer_factory', 'ascii_args']
+
+
+def ascii_args(view):
+    """View decorator converting the ASCII strings of the JSON-RPC
+    arguments to str"""
+    def wrapper(context, request):
+        request.rpc_args = decode(request.rpc_args)
+        return view(context, request)
+    return wrapper
+
+
+def dumps(value):
+    return json.dumps(value, default=default, separators=(',', ':'))
+
+
+def renderer_factory(info):
+    """Pyramid renderer for the JSON-RPC responses"""
+    def _render(value, system):
+        return dumps(value)
+    return _render
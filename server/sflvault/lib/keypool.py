@@ -0,0 +1,174 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Pool of pre-generated ElGamal keypairs, for group_add().
+
+Generating a 1536 bits keypair takes from seconds to tens of seconds, so
+a KeypairFiller thread keeps between `low` and `high` fresh keypairs in
+the ``keypairs`` table.  They are encrypted with the
+``sflvault.vault.keypool_key`` AES key (32 random bytes, base64-encoded)
+of the .ini file.  The pool is disabled when no key is configured.
+
+When the pool is empty, take() returns None and the caller generates its
+keypair inline.
+
+With a crypto pool (see sflvault.lib.cryptopool), the keypairs are
+generated on its workers, out of the server process' GIL.
+"""
+
+import time
+import logging
+import threading
+from datetime import datetime
+
+from Crypto.PublicKey import ElGamal
+from sqlalchemy import sql
+
+from sflvault.common.crypto import *
+from sflvault.model import meta, keypairs_table
+from sflvault.lib import metrics
+
+
+__all__ = ['KeypairPool', 'KeypairFiller', 'keypool_from_settings']
+
+log = logging.getLogger(__name__)
+
+# Seconds to wait for a keypair from the crypto pool
+GENERATE_TIMEOUT = 600
+
+
+class KeypairPool(object):
+    """Encrypted-at-rest pool of ElGamal keypairs"""
+    def __init__(self, key, low=2, high=5, engine=None, cryptopool=None):
+        self.key = key
+        self.low = low
+        self.high = high
+        self.engine = engine or meta.engine
+        self.cryptopool = cryptopool
+        keypairs_table.create(self.engine, checkfirst=True)
+        # Woken up when the pool needs to be refilled
+        self.wanted = threading.Event()
+
+        # Metrics
+        self.taken = 0
+        self.empty = 0
+        self.generated = 0
+        self.generation_time = 0.0
+
+    def __len__(self):
+        return self.engine.execute(sql.select([sql.func.count()])\
+                                       .select_from(keypairs_table)).scalar()
+
+    def take(self):
+        """Return an ElGamal object from the pool, or None if it's empty"""
+        while True:
+            row = self.engine.execute(sql.select([keypairs_table])\
+                                          .order_by(keypairs_table.c.id)\
+                                          .limit(1)).first()
+            if not row:
+                self.empty += 1
+                self.wanted.set()
+                return None
+
+            res = self.engine.execute(keypairs_table.delete()\
+                                  .where(keypairs_table.c.id == row.id))
+            if res.rowcount != 1:
+                # Another process took it first
+                continue
+
+            self.taken += 1
+            if len(self) < self.low:
+                self.wanted.set()
+
+            try:
+                packed = decrypt_secret(self.key, row.cryptkeypair)
+            except DecryptError, e:
+                log.error("Dropping undecryptable pooled keypair (was "
+                          "keypool_key changed?): %s" % e)
+                continue
+
+            eg = ElGamal.ElGamalobj()
+            (eg.p, eg.x, eg.g, eg.y) = unserial_elgamal_privkey(packed)
+            return eg
+
+    def put(self, eg):
+        """Encrypt and add a keypair to the pool"""
+        packed = serial_elgamal_privkey(elgamal_bothkeys(eg))
+        (seckey, ciphertext) = encrypt_secret(packed, self.key)
+        self.engine.execute(keypairs_table.insert(),
+                            cryptkeypair=ciphertext,
+                            created_time=datetime.now())
+
+    def fill(self):
+        """Generate keypairs until the pool holds `high` of them"""
+        while len(self) < self.high:
+            start = time.time()
+            with metrics.timed('elgamal_generate'):
+                if self.cryptopool:
+                    # No hurry, unlike the requests.
+                    eg = self.cryptopool.generate_keypair(GENERATE_TIMEOUT)
+                else:
+                    eg = generate_elgamal_keypair()
+            self.generation_time += time.time() - start
+            self.generated += 1
+            self.put(eg)
+
+    def stats(self):
+        """Return a dict with the pool's metrics"""
+        return {'size': len(self),
+                'low': self.low,
+                'high': self.high,
+                'taken': self.taken,
+                'empty': self.empty,
+                'generated': self.generated,
+                'generation_time': self.generation_time}
+
+
+class KeypairFiller(threading.Thread):
+    """Daemon thread refilling the pool when it goes below the low
+    watermark, and at least every `interval` seconds"""
+    def __init__(self, pool, interval=60):
+        threading.Thread.__init__(self, name='KeypairFiller')
+        self.setDaemon(True)
+        self.pool = pool
+        self.interval = interval
+
+    def run(self):
+        while True:
+            try:
+                if len(self.pool) < self.pool.low:
+                    self.pool.fill()
+            except Exception, e:
+                log.error("Error filling the keypair pool: %s" % e)
+            self.pool.wanted.wait(self.interval)
+            self.pool.wanted.clear()
+
+
+def keypool_from_settings(settings, cryptopool=None):
+    """Create the keypair pool configured in the .ini file, or return None
+    if it's not enabled"""
+    key = settings.get('sflvault.vault.keypool_key')
+    if not key:
+        return None
+    return KeypairPool(key,
+                       int(settings.get('sflvault.vault.keypool_low', 2)),
+                       int(settings.get('sflvault.vault.keypool_high', 5)),
+                       cryptopool=cryptopool)
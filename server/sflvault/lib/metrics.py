@@ -0,0 +1,276 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Server metrics, served by /metrics in the Prometheus text format.
+
+The metrics are kept in the server process:
+
+- the RPC calls, their errors and latency, by method (rpc_call wraps the
+  views of both RPC endpoints);
+- the SQL statements and the time spent in them, by RPC method (see
+  watch_engine());
+- the ElGamal operations and their time (timed(), around the crypto
+  calls);
+- gauges read when scraped, like the number of sessions (see gauge()).
+
+Recording costs a lock and a few additions, a few microseconds per call.
+Enable the endpoint with ``sflvault.metrics = true`` in the .ini file.
+"""
+
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+from decorator import decorator
+from sqlalchemy import event
+
+from sflvault.lib import tracing
+
+
+__all__ = ['Counter', 'Histogram', 'Registry', 'registry', 'rpc_call',
+           'watch_engine', 'timed', 'gauge', 'render']
+
+
+# In seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+
+# Shared by all the metrics, so that a call's metrics are recorded under
+# a single acquisition.
+_lock = threading.Lock()
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (n, str(v).replace('"', '\\"'))
+                              for n, v in zip(names, values)])
+
+
+class Counter(object):
+    """Counter, by the values of its labels"""
+    type = 'counter'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, labels=(), amount=1):
+        with _lock:
+            self._inc(labels, amount)
+
+    def _inc(self, labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return self.values.get(labels, 0)
+
+    def samples(self):
+        with _lock:
+            items = sorted(self.values.items())
+        return [(self.name, _labels(self.labels, k), v) for k, v in items]
+
+
+class Histogram(Counter):
+    """Histogram of durations, by the values of its labels"""
+    type = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=BUCKETS):
+        Counter.__init__(self, name, doc, labels)
+        self.buckets = buckets
+
+    def observe(self, labels, value):
+        with _lock:
+            self._observe(labels, value)
+
+    def _observe(self, labels, value):
+        if labels not in self.values:
+            # [count per bucket (the last one is +Inf), sum]
+            self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        counts = self.values[labels]
+        counts[0][bisect.bisect_left(self.buckets, value)] += 1
+        counts[1] += value
+
+    def get(self, labels=()):
+        """Return the (count, sum) of the observations"""
+        counts = self.values.get(labels)
+        return (sum(counts[0]), counts[1]) if counts else (0, 0.0)
+
+    def samples(self):
+        with _lock:
+            items = sorted([(k, (list(v[0]), v[1]))
+                            for k, v in self.values.items()])
+        out = []
+        names = self.labels + ('le',)
+        for k, (counts, total) in items:
+            acc = 0
+            for le, count in zip(self.buckets + ('+Inf',), counts):
+                acc += count
+                out.append((self.name + '_bucket',
+                            _labels(names, k + (le,)), acc))
+            out.append((self.name + '_sum', _labels(self.labels, k), total))
+            out.append((self.name + '_count', _labels(self.labels, k), acc))
+        return out
+
+
+class Gauge(object):
+    """Value read from a function when scraped"""
+    type = 'gauge'
+
+    def __init__(self, name, doc, func):
+        self.name = name
+        self.doc = doc
+        self.func = func
+
+    def samples(self):
+        return [(self.name, '', self.func())]
+
+
+class Registry(object):
+    """The metrics rendered by /metrics"""
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Return the metrics in the Prometheus text format"""
+        out = []
+        for metric in self.metrics:
+            try:
+                samples = metric.samples()
+            except Exception, e:
+                out.append('# %s: %s' % (metric.name, e))
+                continue
+            out.append('# HELP %s %s' % (metric.name, metric.doc))
+            out.append('# TYPE %s %s' % (metric.name, metric.type))
+            for name, labels, value in samples:
+                out.append('%s%s %s' % (name, labels, repr(float(value))))
+        return '\n'.join(out) + '\n'
+
+
+registry = Registry()
+
+rpc_calls = registry.add(Counter('sflvault_rpc_calls_total',
+                                 'RPC calls, by method', ('method',)))
+rpc_errors = registry.add(Counter('sflvault_rpc_errors_total',
+                                  'RPC calls that returned an error or '
+                                  'raised, by method', ('method',)))
+rpc_seconds = registry.add(Histogram('sflvault_rpc_duration_seconds',
+                                     'RPC call latency, by method',
+                                     ('method',)))
+db_queries = registry.add(Counter('sflvault_db_queries_total',
+                                  'SQL statements, by RPC method',
+                                  ('method',)))
+db_seconds = registry.add(Counter('sflvault_db_seconds_total',
+                                  'Time spent in SQL statements, by RPC '
+                                  'method', ('method',)))
+crypto_ops = registry.add(Counter('sflvault_crypto_operations_total',
+                                  'ElGamal operations, by operation',
+                                  ('operation',)))
+crypto_seconds = registry.add(Counter('sflvault_crypto_seconds_total',
+                                      'Time spent in ElGamal operations, '
+                                      'by operation', ('operation',)))
+crypto_rejected = registry.add(Counter('sflvault_crypto_rejected_total',
+                                       'Crypto pool jobs refused because it '
+                                       'was full (busy), or that timed out, '
+                                       'by reason', ('reason',)))
+
+
+# The statements of the RPC call running in the thread, as [count,
+# seconds], added to db_queries and db_seconds when the call returns, to
+# keep the locks out of the statements' path.
+_current = threading.local()
+
+
+@decorator
+def rpc_call(func, request, *args, **kwargs):
+    """Decorator recording the calls, errors, latency and statements of an
+    RPC view"""
+    method = (getattr(request, 'rpc_method', None) or 'none',)
+    db = _current.db = [0, 0.0]
+    error = True
+    start = time.time()
+    try:
+        res = func(request, *args, **kwargs)
+        error = isinstance(res, dict) and bool(res.get('error'))
+        return res
+    finally:
+        spent = time.time() - start
+        _current.db = None
+        with _lock:
+            rpc_seconds._observe(method, spent)
+            rpc_calls._inc(method)
+            if error:
+                rpc_errors._inc(method)
+            db_queries._inc(method, db[0])
+            db_seconds._inc(method, db[1])
+
+
+def watch_engine(engine):
+    """Count the statements sent to `engine`, and their time, by RPC
+    method"""
+    def before(conn, cursor, statement, *args):
+        _current.query_start = time.time()
+
+    def after(conn, cursor, statement, *args):
+        spent = time.time() - _current.query_start
+        db = getattr(_current, 'db', None)
+        if db is not None:
+            db[0] += 1
+            db[1] += spent
+        else:
+            with _lock:
+                db_queries._inc(('none',))
+                db_seconds._inc(('none',), spent)
+
+    event.listen(engine, 'before_cursor_execute', before)
+    event.listen(engine, 'after_cursor_execute', after)
+
+
+@contextmanager
+def timed(operation, count=1):
+    """Record `count` `operation`s, and the time spent in the block, also
+    traced as the span crypto.`operation`"""
+    start = time.time()
+    try:
+        with tracing.span('crypto.' + operation, count=count):
+            yield
+    finally:
+        spent = time.time() - start
+        with _lock:
+            crypto_seconds._inc((operation,), spent)
+            crypto_ops._inc((operation,), count)
+
+
+def gauge(name, doc, func):
+    """Add a gauge, whose value is func() when scraped"""
+    return registry.add(Gauge(name, doc, func))
+
+
+def render():
+    return registry.render()
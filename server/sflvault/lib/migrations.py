@@ -0,0 +1,147 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Versioned schema migrations.
+
+metadata.create_all() creates the missing tables, with their indexes, but
+doesn't touch the tables that already exist.  The changes to those go in
+MIGRATIONS, as (version, description, function(connection)).  The
+schema_version table has a row for each version applied to the vault.
+
+upgrade() is called by main() on startup: a new vault is created at the
+latest version, an existing one gets the migrations it hasn't had yet,
+in order, each in its own transaction.  The migrations use plain
+SQLAlchemy DDL, so they work on SQLite as well as on PostgreSQL.
+
+Several server processes can start at once.  On PostgreSQL, each migration
+locks schema_version, so that the others wait for it and then skip it.
+Elsewhere, a migration failing because another process applied it at the
+same time (its version is recorded once it's rolled back) is skipped too.
+"""
+
+import logging
+
+from sqlalchemy import sql
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.engine.reflection import Inspector
+
+from sflvault.model import metadata, users_table, schemaversion_table
+
+
+__all__ = ['MIGRATIONS', 'LATEST', 'LOOKUP_INDEXES', 'version', 'upgrade']
+
+log = logging.getLogger(__name__)
+
+
+def _create_indexes(*names):
+    """Return a migration creating the model's indexes `names`, skipping
+    those already there"""
+    def migrate(conn):
+        inspector = Inspector.from_engine(conn)
+        for table in metadata.sorted_tables:
+            existing = set([x['name'] for x in
+                            inspector.get_indexes(table.name)])
+            for index in table.indexes:
+                if index.name in names and index.name not in existing:
+                    log.info("Creating index %s" % index.name)
+                    index.create(conn)
+    return migrate
+
+
+# Declared in sflvault.model
+LOOKUP_INDEXES = ['ix_services_machine_id', 'ix_services_parent_service_id',
+                  'ix_machines_customer_id',
+                  'ix_services_groups_service_id_group_id',
+                  'ix_users_groups_user_id_group_id', 'ix_users_username']
+
+MIGRATIONS = [
+    (1, u"Indexes on the foreign keys, memberships and usernames",
+     _create_indexes(*LOOKUP_INDEXES)),
+    ]
+
+LATEST = MIGRATIONS[-1][0]
+
+
+def version(conn):
+    """Return the vault's schema version, 0 if none was recorded"""
+    t = schemaversion_table
+    return conn.execute(sql.select([sql.func.max(t.c.version)])).scalar() \
+        or 0
+
+
+def _record(conn, ver, description):
+    conn.execute(schemaversion_table.insert(), version=ver,
+                 description=description)
+
+
+def _lock(conn):
+    """Make the other processes wait for the end of the transaction to
+    read or write schema_version, where the database can"""
+    if conn.dialect.name == 'postgresql':
+        conn.execute("LOCK TABLE %s IN ACCESS EXCLUSIVE MODE" %
+                     schemaversion_table.name)
+
+
+def upgrade(engine):
+    """Create the missing tables, and apply the pending migrations.
+
+    Returns the list of the versions applied, by this call: those applied
+    by another process meanwhile aren't.
+    """
+    new = not engine.has_table(users_table.name)
+    try:
+        metadata.create_all(engine)
+    except DBAPIError:
+        # Another process created some of them meanwhile, create the others
+        metadata.create_all(engine)
+
+    conn = engine.connect()
+    try:
+        applied = []
+        for ver, description, migrate in MIGRATIONS:
+            if ver <= version(conn):
+                continue
+            trans = conn.begin()
+            try:
+                _lock(conn)
+                if ver <= version(conn):
+                    trans.commit()
+                    continue
+                # New vaults got everything from create_all().
+                if not new:
+                    log.info("Migrating the vault to version %d: %s" %
+                             (ver, description))
+                    migrate(conn)
+                _record(conn, ver, description)
+                trans.commit()
+            except DBAPIError:
+                trans.rollback()
+                if ver > version(conn):
+                    raise
+                log.info("Version %d was applied by another process" % ver)
+                continue
+            except:
+                trans.rollback()
+                raise
+            applied.append(ver)
+        return applied
+    finally:
+        conn.close()
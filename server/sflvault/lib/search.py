@@ -0,0 +1,207 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Search indexes, used by model.search_query().
+
+Without an index, each search word is matched with ILIKE '%word%' on all
+the searchable columns, which is a full scan of the
+customers/machines/services join.
+
+The TrigramIndex keeps an inverted index of the trigrams of those columns
+in memory, so the database is only asked for the matching rows.  It is
+kept up-to-date by SFLvaultAccess, through refresh(), each time a customer,
+machine or service is added, modified or deleted.  Since it lives in the
+server process, it should only be used when a single process writes to
+the vault: main() refuses it with the session stores made for many
+processes.
+
+Enable it with ``sflvault.search_index = trigram`` in the .ini file.
+"""
+
+import threading
+
+from sqlalchemy import sql
+
+from sflvault.model import meta
+from sflvault.model import customers_table, machines_table, services_table
+from sflvault.model import search_textfields
+
+
+__all__ = ['TrigramIndex', 'trigrams']
+
+
+def trigrams(text):
+    """Return the set of trigrams in the (lowercased) text"""
+    return set([text[i:i + 3] for i in range(len(text) - 2)])
+
+
+class TrigramIndex(object):
+    """In-process inverted index of the searchable text of the vault.
+
+    The indexed rows are the rows of the customers/machines/services outer
+    join, identified by a (customer_id, machine_id, service_id) key.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        # key -> list of lowercased texts
+        self.rows = {}
+        # trigram -> set of keys
+        self.postings = {}
+        # customer_id -> set of keys
+        self.by_customer = {}
+        # customer, machine or service id -> set of keys
+        self.by_id = {}
+
+    def _select(self):
+        cols = [customers_table.c.id, machines_table.c.id,
+                services_table.c.id] + search_textfields
+        return sql.select(cols,
+                          from_obj=[sql.outerjoin(customers_table,
+                                                  machines_table)\
+                                       .outerjoin(services_table)])
+
+    def build(self):
+        """(Re)build the whole index from the database"""
+        res = meta.Session.execute(self._select())
+        with self.lock:
+            self.clear()
+            for row in res:
+                self._add(row)
+
+    def _add(self, row):
+        key = tuple(row[:3])
+        texts = [unicode(x).lower() for x in row[3:] if x]
+        self.rows[key] = texts
+        for text in texts:
+            for tri in trigrams(text):
+                self.postings.setdefault(tri, set()).add(key)
+        self.by_customer.setdefault(key[0], set()).add(key)
+        for x in set(key):
+            if x is not None:
+                self.by_id.setdefault(x, set()).add(key)
+
+    def _remove(self, key):
+        for text in self.rows.pop(key):
+            for tri in trigrams(text):
+                keys = self.postings.get(tri)
+                if keys is None:
+                    continue
+                keys.discard(key)
+                if not keys:
+                    del self.postings[tri]
+        self.by_customer[key[0]].discard(key)
+        if not self.by_customer[key[0]]:
+            del self.by_customer[key[0]]
+        for x in set(key):
+            if x is not None:
+                self.by_id[x].discard(key)
+                if not self.by_id[x]:
+                    del self.by_id[x]
+
+    def refresh(self, customers=(), machines=(), services=()):
+        """Re-index the customers touched by a modification.
+
+        Pass the IDs of the customers, machines and services that were
+        added, modified or deleted.  Call after the transaction is committed.
+        """
+        customers = set([int(x) for x in customers if x])
+        machines = set([int(x) for x in machines if x])
+        services = set([int(x) for x in services if x])
+
+        with self.lock:
+            # Where they were...
+            for x in machines | services:
+                for key in self.by_id.get(x, ()):
+                    if key[1] in machines or key[2] in services:
+                        customers.add(key[0])
+        # ...and where they are now.
+        if machines:
+            sel = sql.select([machines_table.c.customer_id])\
+                     .where(machines_table.c.id.in_(machines))
+            customers.update([x[0] for x in meta.Session.execute(sel)])
+        if services:
+            sel = sql.select([machines_table.c.customer_id],
+                             from_obj=[sql.join(machines_table,
+                                                services_table)])\
+                     .where(services_table.c.id.in_(services))
+            customers.update([x[0] for x in meta.Session.execute(sel)])
+        customers.discard(None)
+
+        if not customers:
+            return
+
+        sel = self._select().where(customers_table.c.id.in_(customers))
+        res = list(meta.Session.execute(sel))
+        with self.lock:
+            for cid in customers:
+                for key in list(self.by_customer.get(cid, [])):
+                    self._remove(key)
+            for row in res:
+                self._add(row)
+
+    def search(self, swords):
+        """Return the set of keys matching all the words, or None if the
+        index can't answer (only words shorter than a trigram)"""
+        words = [unicode(x).lower() for x in swords]
+        longwords = [x for x in words if len(x) >= 3]
+        if not longwords:
+            return None
+
+        with self.lock:
+            candidates = None
+            for word in longwords:
+                # Start with the rarest trigram, to intersect as little as
+                # possible.
+                wordkeys = None
+                for tri in sorted(trigrams(word),
+                                  key=lambda t: len(self.postings.get(t, ()))):
+                    keys = self.postings.get(tri, set())
+                    if wordkeys is None:
+                        wordkeys = set(keys)
+                    else:
+                        wordkeys &= keys
+                    if not wordkeys:
+                        break
+                if word.isdigit():
+                    # Numbers also match the IDs
+                    wordkeys |= self.by_id.get(int(word), set())
+
+                if candidates is None:
+                    candidates = wordkeys
+                else:
+                    candidates &= wordkeys
+                if not candidates:
+                    return set()
+
+            return set([key for key in candidates
+                        if self._match(key, words)])
+
+    def _match(self, key, words):
+        texts = self.rows[key]
+        for word in words:
+            if word.isdigit() and int(word) in key:
+                continue
+            if not [True for text in texts if word in text]:
+                return False
+        return True
@@ -0,0 +1,239 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""XML-RPC session stores.
+
+A session is a dict, saved under its authtok, with at least a 'timeout'
+datetime key.  Everything else in there must be JSON-serializable, so
+that the sessions can be shared by many server processes, and survive a
+restart, with the 'sql' and 'file' stores.
+
+Pick the store with ``sflvault.vault.session_store`` in the .ini file:
+
+memory - a dict in the server process (the default)
+sql - the ``sessions`` table of the vault's database
+file - one file per session in ``sflvault.vault.session_dir``
+
+Expired sessions are removed by a SessionSweeper thread.
+"""
+
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+from base64 import b32encode
+from datetime import datetime
+
+from sqlalchemy import sql
+
+from sflvault.model import meta, sessions_table
+
+
+__all__ = ['MemorySessionStore', 'SQLSessionStore', 'FileSessionStore',
+           'SessionSweeper', 'session_store_from_settings']
+
+log = logging.getLogger(__name__)
+
+
+def _dumps(value):
+    data = dict(value)
+    data['timeout'] = time.mktime(value['timeout'].timetuple())
+    return json.dumps(data)
+
+def _loads(data):
+    value = json.loads(data)
+    value['timeout'] = datetime.fromtimestamp(value['timeout'])
+    return value
+
+
+class MemorySessionStore(object):
+    """Sessions in a dict, only visible to the current process"""
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, authtok):
+        """Return the session, or None"""
+        return self.sessions.get(authtok)
+
+    def set(self, authtok, value):
+        with self.lock:
+            self.sessions[authtok] = value
+
+    def delete(self, authtok):
+        with self.lock:
+            self.sessions.pop(authtok, None)
+
+    def sweep(self, now=None):
+        """Remove the expired sessions, return how many were removed"""
+        now = now or datetime.now()
+        with self.lock:
+            expired = [k for k, v in self.sessions.items()
+                       if v['timeout'] < now]
+            for authtok in expired:
+                del self.sessions[authtok]
+        return len(expired)
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+class SQLSessionStore(object):
+    """Sessions in the `sessions` table.
+
+    This uses its own connections, so that saving a session doesn't
+    interfere with the request's transaction.
+    """
+    def __init__(self, engine=None):
+        self.engine = engine or meta.engine
+        sessions_table.create(self.engine, checkfirst=True)
+
+    def get(self, authtok):
+        row = self.engine.execute(sql.select([sessions_table.c.data])\
+                  .where(sessions_table.c.authtok == authtok)).first()
+        return _loads(row[0]) if row else None
+
+    def set(self, authtok, value):
+        data = _dumps(value)
+        conn = self.engine.connect()
+        try:
+            trans = conn.begin()
+            conn.execute(sessions_table.delete()\
+                             .where(sessions_table.c.authtok == authtok))
+            conn.execute(sessions_table.insert(), authtok=authtok,
+                         data=data, timeout=value['timeout'])
+            trans.commit()
+        finally:
+            conn.close()
+
+    def delete(self, authtok):
+        self.engine.execute(sessions_table.delete()\
+                                .where(sessions_table.c.authtok == authtok))
+
+    def sweep(self, now=None):
+        now = now or datetime.now()
+        res = self.engine.execute(sessions_table.delete()\
+                                      .where(sessions_table.c.timeout < now))
+        return res.rowcount
+
+    def __len__(self):
+        return self.engine.execute(sql.select([sql.func.count()])\
+                                       .select_from(sessions_table)).scalar()
+
+
+class FileSessionStore(object):
+    """Sessions as files in a directory, shared by the processes of a
+    single host.  Files are written atomically, by renaming."""
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path, 0700)
+
+    def _filename(self, authtok):
+        # authtoks are base64, which isn't safe for file names.
+        return os.path.join(self.path, b32encode(authtok))
+
+    def get(self, authtok):
+        try:
+            fp = open(self._filename(authtok))
+        except IOError:
+            return None
+        try:
+            return _loads(fp.read())
+        finally:
+            fp.close()
+
+    def set(self, authtok, value):
+        fd, tmpname = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+        fp = os.fdopen(fd, 'w')
+        try:
+            fp.write(_dumps(value))
+        finally:
+            fp.close()
+        os.rename(tmpname, self._filename(authtok))
+
+    def delete(self, authtok):
+        try:
+            os.unlink(self._filename(authtok))
+        except OSError:
+            pass
+
+    def _files(self):
+        return [os.path.join(self.path, x) for x in os.listdir(self.path)
+                if not x.startswith('.')]
+
+    def sweep(self, now=None):
+        now = now or datetime.now()
+        count = 0
+        for filename in self._files():
+            try:
+                fp = open(filename)
+                try:
+                    value = _loads(fp.read())
+                finally:
+                    fp.close()
+                if value['timeout'] < now:
+                    os.unlink(filename)
+                    count += 1
+            except (IOError, OSError, ValueError):
+                # Removed by someone else meanwhile
+                continue
+        return count
+
+    def __len__(self):
+        return len(self._files())
+
+
+class SessionSweeper(threading.Thread):
+    """Daemon thread removing the expired sessions every `interval`
+    seconds"""
+    def __init__(self, store, interval=60):
+        threading.Thread.__init__(self, name='SessionSweeper')
+        self.setDaemon(True)
+        self.store = store
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                count = self.store.sweep()
+                if count:
+                    log.debug("Swept %d expired sessions" % count)
+            except Exception, e:
+                log.error("Error sweeping sessions: %s" % e)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def session_store_from_settings(settings):
+    """Create the session store configured in the .ini file"""
+    kind = settings.get('sflvault.vault.session_store', 'memory')
+    if kind == 'memory':
+        return MemorySessionStore()
+    elif kind == 'sql':
+        return SQLSessionStore()
+    elif kind == 'file':
+        return FileSessionStore(settings['sflvault.vault.session_dir'])
+    raise ValueError("Invalid sflvault.vault.session_store: %s" % kind)
@@ -0,0 +1,326 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Per-request traces of the RPC calls, with nested spans.
+
+When ``sflvault.trace.file`` is set in the .ini file, main() installs:
+
+- a tween opening the trace of each request.  Its 'rpc.parse' span is
+  the time before the view is called (routing and decoding the XML or
+  JSON request), 'rpc.marshal' the time after it returns (encoding the
+  response);
+- a span for the view, named after the RPC method (see rpc_view());
+- spans for the permission decorators and get_session (see span());
+- a span for each SFLvaultAccess method (see trace_methods());
+- a span for each SQL statement (see watch_engine());
+- a span for each call into sflvault.common.crypto (see
+  trace_functions()), and for each ElGamal operation (metrics.timed()).
+
+A trace is written, as a JSON line, when the request was sampled
+(``sflvault.trace.sample_rate``, 0.01 by default) or was slower than
+``sflvault.trace.slow_ms`` (500 by default).  To see the hottest spans:
+
+    sflvault-traces traces.jsonl    (or python -m sflvault.lib.tracing)
+"""
+
+import sys
+import time
+import json
+import types
+import random
+import logging
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from optparse import OptionParser
+
+from decorator import decorator
+from sqlalchemy import event
+
+
+__all__ = ['Tracer', 'tracer_from_settings', 'span', 'rpc_view',
+           'trace_methods', 'trace_functions', 'watch_engine',
+           'tween_factory', 'summarize']
+
+log = logging.getLogger(__name__)
+
+# Set in main() when tracing is enabled.
+tracer = None
+
+# The trace of the request running in the thread.
+_current = threading.local()
+
+# Characters of a SQL statement kept in its span.
+STATEMENT_LENGTH = 200
+
+
+class Trace(object):
+    """The spans of a request.  Each span is a list:
+    [name, parent index, start, end, attributes]"""
+    def __init__(self):
+        self.spans = []
+        self.stack = []
+        # (statement, start) of the SQL statement running
+        self.statement = None
+
+    def open(self, name, attrs=None, start=None):
+        parent = self.stack[-1] if self.stack else None
+        self.spans.append([name, parent, start or time.time(), None, attrs])
+        self.stack.append(len(self.spans) - 1)
+        return self.spans[-1]
+
+    def close(self, end=None):
+        self.spans[self.stack.pop()][3] = end or time.time()
+
+    def add(self, name, start, end, parent=0, attrs=None):
+        """Add a span that wasn't timed by open() and close()"""
+        self.spans.append([name, parent, start, end, attrs])
+
+    def as_dict(self):
+        root = self.spans[0]
+        start = root[2]
+        return {'start': datetime.fromtimestamp(start).isoformat(),
+                'method': root[4].get('method'),
+                'duration_ms': (root[3] - start) * 1000,
+                'spans': [dict([('name', name), ('parent', parent),
+                                ('start_ms', (s - start) * 1000),
+                                ('duration_ms', (e - s) * 1000)] +
+                               (attrs and [('attrs', attrs)] or []))
+                          for name, parent, s, e, attrs in self.spans]}
+
+
+class Tracer(object):
+    """Write the sampled and the slow traces to a JSON-lines file"""
+    def __init__(self, path, sample_rate=0.01, slow_ms=500):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow = slow_ms / 1000.0
+        self.lock = threading.Lock()
+        self.file = open(path, 'a')
+
+    def keep(self, trace):
+        """Tell if `trace` should be written"""
+        root = trace.spans[0]
+        return root[3] - root[2] >= self.slow or \
+            random.random() < self.sample_rate
+
+    def write(self, trace):
+        line = json.dumps(trace.as_dict()) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def finish(self, trace):
+        if self.keep(trace):
+            try:
+                self.write(trace)
+            except Exception, e:
+                log.warning("Unable to write the trace: %s" % e)
+
+
+def tracer_from_settings(settings):
+    """Create the Tracer configured in the .ini file, or return None if
+    it's not enabled"""
+    path = settings.get('sflvault.trace.file')
+    if not path:
+        return None
+    return Tracer(path,
+                  float(settings.get('sflvault.trace.sample_rate', 0.01)),
+                  float(settings.get('sflvault.trace.slow_ms', 500)))
+
+
+def _trace():
+    return getattr(_current, 'trace', None)
+
+
+@contextmanager
+def span(name, **attrs):
+    """Time the block as a span of the current trace, if any"""
+    trace = _trace()
+    if trace is None:
+        yield
+        return
+    trace.open(name, attrs or None)
+    try:
+        yield
+    finally:
+        trace.close()
+
+
+def traced(name, func):
+    """Return `func`, opening the span `name` around its calls"""
+    def wrapper(func, *args, **kwargs):
+        trace = _trace()
+        if trace is None:
+            return func(*args, **kwargs)
+        trace.open(name)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            trace.close()
+    func = decorator(wrapper, func)
+    func.traced = True
+    return func
+
+
+@decorator
+def rpc_view(func, request, *args, **kwargs):
+    """Decorator opening a span for an RPC view, named after its method.
+    The time before and after it is accounted for by tween_factory()"""
+    trace = _trace()
+    if trace is None:
+        return func(request, *args, **kwargs)
+    trace.open(request.rpc_method)
+    try:
+        return func(request, *args, **kwargs)
+    finally:
+        trace.close()
+
+
+def trace_methods(cls, prefix=None):
+    """Open a span around each call to the public methods of `cls`"""
+    prefix = prefix or cls.__name__
+    for name, value in cls.__dict__.items():
+        if isinstance(value, types.FunctionType) and \
+                not name.startswith('_') and not hasattr(value, 'traced'):
+            setattr(cls, name, traced('%s.%s' % (prefix, name), value))
+
+
+def trace_functions(module, source='sflvault.common.crypto'):
+    """Open a span around the calls made by `module` to the functions it
+    imported from the module `source`"""
+    for name, value in vars(module).items():
+        if isinstance(value, types.FunctionType) and \
+                value.__module__ == source and not hasattr(value, 'traced'):
+            setattr(module, name, traced('crypto.%s' % name, value))
+
+
+def watch_engine(engine):
+    """Add a span for each statement sent to `engine`"""
+    def before(conn, cursor, statement, *args):
+        trace = _trace()
+        if trace is not None:
+            trace.statement = (statement, time.time())
+
+    def after(conn, cursor, statement, *args):
+        trace = _trace()
+        if trace is not None and trace.statement:
+            # Added when it's done: a statement that fails never gets here,
+            # and it mustn't be left open.
+            statement, start = trace.statement
+            trace.statement = None
+            trace.add('sql', start, time.time(), trace.stack[-1],
+                      {'statement': statement[:STATEMENT_LENGTH]})
+
+    event.listen(engine, 'before_cursor_execute', before)
+    event.listen(engine, 'after_cursor_execute', after)
+
+
+def tween_factory(handler, registry):
+    """Pyramid tween tracing each RPC request"""
+    def tween(request):
+        if tracer is None:
+            return handler(request)
+        trace = _current.trace = Trace()
+        root = trace.open('request', {'path': request.path})
+        try:
+            return handler(request)
+        finally:
+            trace.close()
+            _current.trace = None
+            method = root[4]['method'] = getattr(request, 'rpc_method', None)
+            view = [s for s in trace.spans if s[1] == 0 and s[0] == method]
+            if view:
+                view = view[0]
+                trace.add('rpc.parse', root[2], view[2])
+                trace.add('rpc.marshal', view[3], root[3])
+            tracer.finish(trace)
+    return tween
+
+
+#
+# Summary of a traces file
+#
+def summarize(lines, key=None):
+    """Aggregate the spans of the traces in `lines` (JSON strings) by name,
+    or by key(span).  Returns {name: [count, total ms, self ms, max ms]},
+    self being the time not spent in the span's children."""
+    key = key or (lambda s: s['name'])
+    out = {}
+    for line in lines:
+        if not line.strip():
+            continue
+        spans = json.loads(line)['spans']
+        children = [0.0] * len(spans)
+        for s in spans:
+            if s['parent'] is not None:
+                children[s['parent']] += s['duration_ms']
+        for s, child in zip(spans, children):
+            agg = out.setdefault(key(s), [0, 0.0, 0.0, 0.0])
+            agg[0] += 1
+            agg[1] += s['duration_ms']
+            agg[2] += s['duration_ms'] - child
+            agg[3] = max(agg[3], s['duration_ms'])
+    return out
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options] TRACES_FILE...",
+                          description="Show the spans taking the most time "
+                          "in the traces written by the vault.")
+    parser.add_option('-n', '--limit', type='int', default=20,
+                      help="Number of spans shown (20)")
+    parser.add_option('-s', '--statements', action='store_true',
+                      help="Show each SQL statement instead of 'sql'")
+    parser.add_option('-t', '--total', action='store_true',
+                      help="Sort by total time instead of self time")
+    parser.add_option('-m', '--method',
+                      help="Only the traces of this RPC method")
+    opts, args = parser.parse_args(argv)
+    if not args:
+        parser.error("No traces file given")
+
+    def lines():
+        for path in args:
+            for line in open(path):
+                if not opts.method or \
+                        json.loads(line)['method'] == opts.method:
+                    yield line
+
+    key = None
+    if opts.statements:
+        key = lambda s: s['name'] == 'sql' and s['attrs']['statement'] \
+            .replace('\n', ' ') or s['name']
+    res = summarize(lines(), key)
+
+    col = opts.total and 1 or 2
+    print "%10s %12s %12s %10s %10s  %s" % ('count', 'self (ms)',
+                                            'total (ms)', 'mean (ms)',
+                                            'max (ms)', 'span')
+    for name, (count, total, own, top) in sorted(
+            res.items(), key=lambda x: -x[1][col])[:opts.limit]:
+        print "%10d %12.1f %12.1f %10.2f %10.1f  %s" % (count, own, total,
+                                                       total / count, top,
+                                                       name)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -33,17 +33,26 @@ return clean responses to clean queries.
 """
 
 
+import copy
 import xmlrpclib
+import random
+import string
+import hashlib
 
 from sqlalchemy import sql
 from sqlalchemy.exc import InvalidRequestError as InvalidReq
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import eagerload_all
 
 from sflvault import model
 from sflvault.model import *
+from sflvault.lib import access
+from sflvault.lib import metrics
+from sflvault.lib.cryptopool import CryptoPoolError
 from datetime import timedelta
 import logging
 import transaction
+from zope.sqlalchemy import mark_changed
 log = logging.getLogger('sflvault')
 
 
@@ -55,6 +64,29 @@ def vaultMsg(success, message, dict=None):
             ret[x] = dict[x]
     return ret
 
+# Character sets of the service_passwd_bulk() generator policies
+PASSWORD_CHARSETS = {
+    'alnum': string.ascii_letters + string.digits,
+    'printable': string.ascii_letters + string.digits + string.punctuation,
+    'hex': '0123456789abcdef',
+    }
+
+def generate_password(policy=None):
+    """Return a random password following the policy dict:
+
+    length - number of characters (16)
+    charset - one of PASSWORD_CHARSETS ('alnum'), or a string of characters
+    """
+    policy = policy or {}
+    length = int(policy.get('length', 16))
+    charset = policy.get('charset', 'alnum')
+    charset = PASSWORD_CHARSETS.get(charset, charset)
+    if length < 1 or len(charset) < 2:
+        raise ValueError("Invalid password policy: %s" % policy)
+    rnd = random.SystemRandom()
+    return ''.join([rnd.choice(charset) for x in range(length)])
+
+
 class SFLvaultAccess(object):
     def __init__(self):
         """Init obj."""
@@ -68,6 +100,30 @@ class SFLvaultAccess(object):
 
         self.setup_timeout = 300
 
+        # Search index (see sflvault.lib.search), None to scan the tables.
+        self.search_index = None
+
+        # Pre-generated keypairs (see sflvault.lib.keypool), or None
+        self.keypool = None
+
+        # Worker processes for the per-group encryptions
+        # (see sflvault.lib.cryptopool), or None
+        self.cryptopool = None
+
+        # Services per transaction in service_passwd_bulk()
+        self.bulk_chunk_size = 100
+
+    def as_user(self, user_id, username):
+        """Return a copy of this object acting for the given user.
+
+        The copy shares the settings (search index, pools...), so each
+        request can have its own, without the callers changing each
+        other's identity."""
+        vault = copy.copy(self)
+        vault.myself_id = user_id
+        vault.myself_username = username
+        return vault
+
     def _log_any(self, log_func, msg, data):
         # Need to do that for user-setup
         if self.myself_username == None and self.myself_id == None:
@@ -76,6 +132,12 @@ class SFLvaultAccess(object):
             head = "User: u#d%d - %s - " % (self.myself_id, self.myself_username)
         log_func(head + msg % data)
 
+    def _reindex(self, **kwargs):
+        """Tell the search index about modified customers, machines or
+        services.  Call after the transaction is committed."""
+        if self.search_index:
+            self.search_index.refresh(**kwargs)
+
     def log_e(self, msg, data=None):
         self._log_any(log.error, msg, data)
 
@@ -109,6 +171,7 @@ class SFLvaultAccess(object):
         # Ok, let's save the things and reset waiting_setup.
         u.waiting_setup = None
         u.pubkey = pubkey
+        forget_elgamal(('user', u.id))
 
         # Save new informations
         meta.Session.add(u)
@@ -183,24 +246,56 @@ class SFLvaultAccess(object):
         # to a group which holds some passwords.
 
         t1 = model.usergroups_table
+        gids = [x[0] for x in meta.Session.execute(
+                sql.select([t1.c.group_id], t1.c.user_id == usr.id))]
         meta.Session.execute(t1.delete(t1.c.user_id==usr.id))
+        access.refresh(users=[usr.id], lock=gids)
         username = usr.username
         meta.Session.delete(usr)
         transaction.commit()
+        forget_elgamal(('user', usr.id))
         self.log_i('User %(username)s successfully deleted.',
                    {"username": username})
         return vaultMsg(True, "User %s successfully deleted" % username)
 
 
-    def user_list(self, groups=False):
+    def user_list(self, groups=False, user_ids=None, group_ids=None):
         """Return a simple list of the users
 
         groups - return the list of groups for each user, or not
+        user_ids - only list these users
+        group_ids - only list the members of these groups
+
+        This takes two queries (plus one per filter, to validate the IDs),
+        whatever the number of users and groups.
         """
-        req = query(User)
+        ug = usergroups_table
+        req = query(User).order_by(User.id)
+        memberships = sql.select([ug.c.user_id, ug.c.group_id, ug.c.is_admin,
+                                  groups_table.c.name],
+                                 from_obj=[sql.join(ug, groups_table)])\
+                         .order_by(ug.c.id)
+        try:
+            if user_ids:
+                ids = model.get_objects_ids(user_ids, 'users')
+                req = req.filter(User.id.in_(ids))
+                memberships = memberships.where(ug.c.user_id.in_(ids))
+            if group_ids:
+                members = sql.select([ug.c.user_id]).where(ug.c.group_id.in_(
+                    model.get_objects_ids(group_ids, 'groups')))
+                req = req.filter(User.id.in_(members))
+                memberships = memberships.where(ug.c.user_id.in_(members))
+        except ValueError, e:
+            return vaultMsg(False, str(e))
+        lst = req.all()
+
+        user_groups = {}
         if groups:
-            req = req.options(eagerload_all('groups_assoc.group'))
-        lst = query(User).all()
+            for row in meta.Session.execute(memberships):
+                user_groups.setdefault(row.user_id, []).append(
+                    {'is_admin': row.is_admin,
+                     'name': row.name,
+                     'id': row.group_id})
 
         out = []
         for x in lst:
@@ -217,13 +312,7 @@ class SFLvaultAccess(object):
                   'waiting_setup': bool(x.waiting_setup)}
 
             if groups:
-                # Loop group_assocs for that user..
-                nx['groups'] = []
-                for ug in x.groups_assoc:
-                    nxgrp = {'is_admin': ug.is_admin,
-                             'name': ug.group.name,
-                             'id': ug.group_id}
-                    nx['groups'].append(nxgrp)
+                nx['groups'] = user_groups.get(x.id, [])
 
             out.append(nx)
 
@@ -274,6 +363,7 @@ class SFLvaultAccess(object):
             s.metadata = data['metadata']
 
         transaction.commit()
+        self._reindex(services=[service_id])
 
         self.log_i('Service s#(service_id)s saved successfully' ,
                    {"service_id": service_id})
@@ -291,34 +381,20 @@ class SFLvaultAccess(object):
         # unused
         #me = query(User).get(self.myself_id)
 
-        # We need no aliasing, because we'll only use `cryptgroupkey`,
-        # `cryptsymkey` and `group_id` in there.
-        req = sql.join(servicegroups_table, usergroups_table,
-                       ServiceGroup.group_id==UserGroup.group_id) \
-                 .join(users_table, User.id==UserGroup.user_id) \
-                 .select(use_labels=True) \
-                 .where(User.id==self.myself_id) \
-                 .where(ServiceGroup.service_id==s.id) \
-                 .order_by(ServiceGroup.group_id)
-
-        # Deal with group if specified..
         if group_id:
-            req = req.where(ServiceGroup.group_id == group_id)
-
-        res = meta.Session.execute(req)
-
-        # Take the first one
-        uciphers = list(res)
-        if not uciphers:
-            ugcgk = ''
-            sgcsk = ''
-            uggi = ''
+            # Not necessarily the group the access index picked.
+            req = sql.select([ServiceGroup.group_id,
+                              UserGroup.cryptgroupkey,
+                              ServiceGroup.cryptsymkey],
+                             from_obj=[sql.join(servicegroups_table,
+                                                usergroups_table,
+                                  ServiceGroup.group_id==UserGroup.group_id)])\
+                     .where(UserGroup.user_id==self.myself_id) \
+                     .where(ServiceGroup.service_id==s.id) \
+                     .where(ServiceGroup.group_id == group_id)
+            ucipher = meta.Session.execute(req).first()
         else:
-            ucipher = uciphers[0]
-            # WARN: these are table-name dependent!!
-            ugcgk = ucipher.users_groups_cryptgroupkey
-            sgcsk = ucipher.services_groups_cryptsymkey
-            uggi = ucipher.users_groups_group_id
+            ucipher = access.access_get(self.myself_id, s.id)
 
         groups_list = None
         # Load groups too if required
@@ -329,6 +405,23 @@ class SFLvaultAccess(object):
             for grp in res2:
                 groups_list.append((grp.groups_id, grp.groups_name))
 
+        return self._service_data(s, ucipher, groups_list)
+
+    def _service_data(self, s, ucipher, groups_list):
+        """Build the service's dict, as returned by _service_get_data.
+
+        ucipher - a (group_id, cryptgroupkey, cryptsymkey) row giving
+                  access to the service for the current user, or None
+        """
+        if not ucipher:
+            ugcgk = ''
+            sgcsk = ''
+            uggi = ''
+        else:
+            ugcgk = ucipher.cryptgroupkey
+            sgcsk = ucipher.cryptsymkey
+            uggi = ucipher.group_id
+
         out = {'id': s.id,
                'url': s.url,
                'secret': s.secret,
@@ -376,6 +469,84 @@ class SFLvaultAccess(object):
         return vaultMsg(True, "Here are the services", {'services': out})
 
 
+    def service_get_many(self, service_ids, with_groups=False):
+        """Get the service trees for several services at once.
+
+        This returns the same data as service_get_tree() for each of the
+        `service_ids`, in the same order, but uses a fixed number of queries
+        whatever the number of services, plus one per level of the parent
+        chains.
+        """
+        try:
+            service_ids = [int(x) for x in service_ids]
+        except (TypeError, ValueError), e:
+            return vaultMsg(False, "Invalid service IDs: %s" % str(e))
+
+        if not service_ids:
+            return vaultMsg(True, "Here are the services", {'services': []})
+
+        # Walk the parent links on the (id, parent) pairs only, a level at
+        # a time.
+        parents = {}
+        frontier = set(service_ids)
+        while frontier:
+            frontier = sorted(frontier)
+            for i in range(0, len(frontier), access.CHUNK_SIZE):
+                sel = sql.select([services_table.c.id,
+                                  services_table.c.parent_service_id])\
+                         .where(services_table.c.id.in_(
+                        frontier[i:i + access.CHUNK_SIZE]))
+                parents.update(list(meta.Session.execute(sel)))
+            frontier = set([parents[x] for x in frontier if x in parents]) \
+                - set(parents) - set([None])
+
+        invalid = [x for x in service_ids if x not in parents]
+        if invalid:
+            self.log_w('Services not found: %(invalid)s', {"invalid": invalid})
+            return vaultMsg(False, "Services not found: %s" % invalid)
+
+        chains = []
+        for service_id in service_ids:
+            chain = [service_id]
+            while parents.get(chain[-1]):
+                if parents[chain[-1]] in chain:
+                    self.log_e('Circular references of parent services, '
+                               'aborting.', {})
+                    return vaultMsg(False, "Circular references of parent "
+                                           "services, aborting.")
+                chain.append(parents[chain[-1]])
+            chain.reverse()
+            chains.append(chain)
+
+        all_ids = list(set([x for chain in chains for x in chain]))
+        services = query(Service).filter(Service.id.in_(all_ids)).all()
+
+        # The group through which I can read each service.
+        ciphers = dict([(row.service_id, row) for row in
+                        access.access_list(self.myself_id, all_ids)])
+
+        groups_lists = None
+        if with_groups:
+            groups_lists = dict([(x, []) for x in all_ids])
+            req2 = sql.join(groups_table, servicegroups_table) \
+                      .select(use_labels=True) \
+                      .where(ServiceGroup.service_id.in_(all_ids))
+            for grp in meta.Session.execute(req2):
+                groups_lists[grp.services_groups_service_id].append(
+                    (grp.groups_id, grp.groups_name))
+
+        data = {}
+        for s in services:
+            data[s.id] = self._service_data(s, ciphers.get(s.id),
+                                groups_lists[s.id] if with_groups else None)
+
+        out = [[data[x] for x in chain] for chain in chains]
+
+        self.log_i('Services shown: %(service_ids)s',
+                   {"service_ids": service_ids})
+        return vaultMsg(True, "Here are the services", {'services': out})
+
+
     def show(self, service_id, with_groups=False):
         """Get the specified service ID and return the hierarchy to connect
         to it or to show it.
@@ -385,11 +556,16 @@ class SFLvaultAccess(object):
         return self.service_get_tree(service_id, with_groups)
 
 
-    def search(self, search_query, filters=None, verbose=False):
+    def search(self, search_query, filters=None, verbose=False, limit=0,
+               token=''):
         """Do the search, and return the result tree.
 
         filters - must be a dictionary with options on which to constraint
                   results.
+        limit - return only a page of `limit` services (or machines and
+                customers without services).  The result's `next` is the
+                `token` to pass to get the next page, '' after the last one.
+                A customer or machine can show up in many pages.
 
         """
         filter_types = ['groups', 'machines', 'customers']
@@ -414,7 +590,28 @@ class SFLvaultAccess(object):
                     self.log_e('Search error: %(error)s' % {"error": str(e)})
                     return vaultMsg(False, str(e))
 
-        search = model.search_query(search_query, newfilters, verbose)
+        limit = int(limit or 0)
+        after = None
+        if token:
+            try:
+                after = [int(x) for x in token.split(':')]
+                if len(after) != 3:
+                    raise ValueError()
+            except ValueError:
+                return vaultMsg(False, "Invalid search page token: %s" % token)
+
+        search = model.search_query(search_query, newfilters, verbose,
+                                    self.search_index,
+                                    limit + 1 if limit else None, after)
+        next_token = ''
+        if limit:
+            search = search.fetchall()
+            if len(search) > limit:
+                search = search[:limit]
+                last = search[-1]
+                next_token = '%d:%d:%d' % (last.customers_id,
+                                           last.machines_id or 0,
+                                           last.services_id or 0)
 
 
         # Quick helper funcs, to create the hierarchical 'out' structure.
@@ -458,13 +655,14 @@ class SFLvaultAccess(object):
         # Return 'out', in a nicely structured hierarchical form.
         #self.log_i('Search successfull for: %(search)s',
         #            {'search': search_query})
-        return vaultMsg(True, "Here are the search results", {'results': out})
+        return vaultMsg(True, "Here are the search results", {'results': out,
+                                                         'next': next_token})
 
 
     def customer_get(self, customer_id):
         """Get a single customer's data"""
         try:
-            cust = query(Customer).filter_by(id=customer_id).one()
+            cust = query(Customer, 'minimal').filter_by(id=customer_id).one()
         except InvalidReq, e:
             self.log_i('Customer not found: %(error)s', {"error": str(e)})
             return vaultMsg(False, "Customer not found: %s" % str(e))
@@ -477,7 +675,7 @@ class SFLvaultAccess(object):
     def customer_put(self, customer_id, data):
         """Put a single customer's data back to the Vault"""
         try:
-            cust = query(Customer).filter_by(id=customer_id).one()
+            cust = query(Customer, 'minimal').filter_by(id=customer_id).one()
         except InvalidReq, e:
             self.log_w('Customer not found: %(customer_id)s',
                        {"customer_id": customer_id})
@@ -487,6 +685,7 @@ class SFLvaultAccess(object):
             cust.name = data['name']
 
         transaction.commit()
+        self._reindex(customers=[customer_id])
 
         self.log_i('Customer c#%(customer_id)s saved successfully)s',
                   {"customer_id": customer_id})
@@ -508,6 +707,7 @@ class SFLvaultAccess(object):
         meta.Session.flush()
         cid = nc.id
         transaction.commit()
+        self._reindex(customers=[cid])
 #        meta.Session.refresh(nc)
         #self.log_i('Customer add: c#%s' % cid)
         return vaultMsg(True, 'Customer added', {'customer_id': cid})
@@ -517,7 +717,7 @@ class SFLvaultAccess(object):
         transaction.begin()
         """Put a single machine's data back to the vault"""
         try:
-            m = query(Machine).filter_by(id=machine_id).one()
+            m = query(Machine, 'minimal').filter_by(id=machine_id).one()
         except InvalidReq, e:
             self.log_w('Machine m#%(machine_id)s saved successfully',
                    {"machine_id": machine_id})
@@ -530,6 +730,7 @@ class SFLvaultAccess(object):
             if x in data:
                 m.__setattr__(x, data[x])
         transaction.commit()
+        self._reindex(machines=[machine_id])
 
         self.log_i('Machine m#%(machine_id)s saved successfully',
                    {"machine_id": machine_id})
@@ -538,7 +739,7 @@ class SFLvaultAccess(object):
     def machine_get(self, machine_id):
         """Get a single machine's data"""
         try:
-            m = query(Machine).filter_by(id=machine_id).one()
+            m = query(Machine, 'minimal').filter_by(id=machine_id).one()
         except InvalidReq, e:
             return vaultMsg(False, "Machine not found: %s" % str(e))
 
@@ -574,11 +775,42 @@ class SFLvaultAccess(object):
 
 
         transaction.commit()
+        self._reindex(machines=[nmid])
 
         self.log_i('Machine added: m#%(machine_id)s', {"machine_id": nmid})
         return vaultMsg(True, "Machine added.", {'machine_id': nmid})
 
 
+    def _encrypt_for(self, owners, message):
+        """Encrypt `message` with the pubkey of each group or user, on the
+        crypto pool if there is one.  Returns the ciphertexts in the same
+        order.
+
+        Raises CryptoPoolError when the pool is busy or too slow."""
+        with metrics.timed('elgamal_encrypt', len(owners)):
+            if self.cryptopool:
+                return self.cryptopool.encrypt([o.pubkey for o in owners],
+                                               message)
+            return [encrypt_longmsg(o.elgamal(), message) for o in owners]
+
+    def _new_group_keypair(self, users):
+        """Take a pre-generated keypair, or generate one, and encrypt it for
+        each of `users`, on the crypto pool if there is one.  Returns the
+        keypair and the ciphertexts, in the same order as `users`.
+
+        Raises CryptoPoolError when the pool is busy or too slow."""
+        newkeys = self.keypool.take() if self.keypool else None
+        if not newkeys:
+            with metrics.timed('elgamal_generate'):
+                if self.cryptopool:
+                    newkeys = self.cryptopool.generate_keypair()
+                else:
+                    newkeys = generate_elgamal_keypair()
+        grouppacked = serial_elgamal_privkey(elgamal_bothkeys(newkeys))
+        cryptgroupkeys = self._encrypt_for(users, grouppacked)
+        del(grouppacked)
+        return newkeys, cryptgroupkeys
+
     def service_add(self, machine_id, parent_service_id, url,
                     group_ids, secret, notes, metadata):
         # Get groups
@@ -614,12 +846,15 @@ class SFLvaultAccess(object):
         meta.Session.add(ns)
 
         # Encrypt symkey for each group, using it's own ElGamal pubkey
-        for g in groups:
-            eg = g.elgamal()
-
+        try:
+            cryptsymkeys = self._encrypt_for(groups, seckey)
+        except CryptoPoolError, e:
+            transaction.abort()
+            return vaultMsg(False, str(e))
+        for g, cryptsymkey in zip(groups, cryptsymkeys):
             nsg = ServiceGroup()
             nsg.group_id = g.id
-            nsg.cryptsymkey = encrypt_longmsg(eg, seckey)
+            nsg.cryptsymkey = cryptsymkey
 
             ns.groups_assoc.append(nsg)
 
@@ -628,7 +863,9 @@ class SFLvaultAccess(object):
         meta.Session.flush()
         grouplist = [g.name for g in groups]
         nsid = ns.id
+        access.refresh(services=[nsid])
         transaction.commit()
+        self._reindex(services=[nsid])
         return vaultMsg(True, "Service added.", {'service_id': nsid,
                                                  'encrypted_for': grouplist})
 
@@ -695,8 +932,15 @@ class SFLvaultAccess(object):
         me = query(User).get(self.myself_id)
         myeg = me.elgamal()
 
-        # Generate keypair
-        newkeys = generate_elgamal_keypair()
+        # Add myself to the group and all other global admins.
+        admins = set(query(User).filter_by(is_admin=True).all())
+        admins.add(me)
+        admins = list(admins)
+
+        try:
+            newkeys, cryptgroupkeys = self._new_group_keypair(admins)
+        except CryptoPoolError, e:
+            return vaultMsg(False, str(e))
 
         ng = Group()
         ng.name = group_name
@@ -705,23 +949,18 @@ class SFLvaultAccess(object):
 
         meta.Session.add(ng)
 
-        # Add myself to the group and all other global admins.
-        admins = set(query(User).filter_by(is_admin=True).all())
-        admins.add(me)
-
-        for usr in list(admins):
+        for usr, cryptgroupkey in zip(admins, cryptgroupkeys):
             nug = UserGroup()
             # Make sure I'm admin of my newly created group
             if usr == me:
                 nug.is_admin = True
+                key = cryptgroupkey
             nug.user_id = usr.id
-            nug.cryptgroupkey = encrypt_longmsg(usr.elgamal(),
-                                                serial_elgamal_privkey(
-                                                    elgamal_bothkeys(newkeys)))
+            nug.cryptgroupkey = cryptgroupkey
             ng.users_assoc.append(nug)
+        meta.Session.flush()
         name = ng.name
         gid = ng.id
-        key = nug.cryptgroupkey
         transaction.commit()
 
         return vaultMsg(True, "Added group '%s'" % name,
@@ -743,29 +982,68 @@ class SFLvaultAccess(object):
         # Delete UserGroup elements...
         q1 = usergroups_table.delete(UserGroup.group_id==grp.id)
         meta.Session.execute(q1)
+        # ...and any unfinished re-keying.
+        self._rekey_clear(grp.id)
 
         name = grp.name
         # Delete Group and commit..
         meta.Session.delete(grp)
         transaction.commit()
+        forget_elgamal(('group', grp.id))
 
         retval = {'name': name,
                   'group_id': group_id}
         return vaultMsg(True, 'Removed group "%s" successfully' % name, retval)
 
 
-    def group_list(self, show_hidden=False, list_users=False):
-        """Return a simple list of the available groups"""
-        groups = query(Group).options(eagerload_all('users_assoc.user')).all()
+    def group_list(self, show_hidden=False, list_users=False, group_ids=None,
+                   user_ids=None):
+        """Return a simple list of the available groups
+
+        group_ids - only list these groups
+        user_ids - only list the groups of these users
+
+        This takes four queries (plus one per filter, to validate the IDs),
+        whatever the number of users and groups.
+        """
+        ug = usergroups_table
         me = query(User).get(self.myself_id)
 
+        req = sql.select([groups_table.c.id, groups_table.c.name,
+                          groups_table.c.hidden]).order_by(groups_table.c.id)
+        members = sql.select([ug.c.group_id, ug.c.user_id,
+                              users_table.c.username, ug.c.is_admin],
+                             from_obj=[sql.join(ug, users_table)])\
+                     .order_by(ug.c.id)
+        try:
+            if group_ids:
+                ids = model.get_objects_ids(group_ids, 'groups')
+                req = req.where(groups_table.c.id.in_(ids))
+                members = members.where(ug.c.group_id.in_(ids))
+            if user_ids:
+                theirs = sql.select([ug.c.group_id]).where(ug.c.user_id.in_(
+                    model.get_objects_ids(user_ids, 'users')))
+                req = req.where(groups_table.c.id.in_(theirs))
+                members = members.where(ug.c.group_id.in_(theirs))
+        except ValueError, e:
+            return vaultMsg(False, str(e))
+
+        # Only my own cryptgroupkeys are sent.
+        mine = dict([(row.group_id, row) for row in meta.Session.execute(
+            sql.select([ug.c.group_id, ug.c.is_admin, ug.c.cryptgroupkey])\
+               .where(ug.c.user_id == me.id))])
+        group_members = {}
+        for row in meta.Session.execute(members):
+            group_members.setdefault(row.group_id, []).append(
+                (row.user_id, row.username, row.is_admin))
+
         out = []
-        for grp in groups:
-            myug = [ug for ug in grp.users_assoc if ug.user_id == me.id]
+        for grp in meta.Session.execute(req):
+            myug = mine.get(grp.id)
 
             res = {'id': grp.id,
                    'name': grp.name,
-                   'member': me in grp.users,
+                   'member': bool(myug),
                    'hidden': False,
                    'admin': False}
 
@@ -776,13 +1054,12 @@ class SFLvaultAccess(object):
                     continue
                 res['hidden'] = True
 
-            if len(myug):
-                res['cryptgroupkey'] = myug[0].cryptgroupkey
-                if myug[0].is_admin:
+            if myug:
+                res['cryptgroupkey'] = myug.cryptgroupkey
+                if myug.is_admin:
                     res['admin'] = True
 
-            res['members'] = [(u.user_id, u.user.username, u.is_admin)
-                              for u in grp.users_assoc]
+            res['members'] = group_members.get(grp.id, [])
 
             out.append(res)
 
@@ -803,8 +1080,6 @@ class SFLvaultAccess(object):
         except InvalidReq, e:
             return vaultMsg(False, "Group not found: %s" % str(e))
 
-        grpeg = grp.elgamal()
-
         sg = query(ServiceGroup).filter_by(group_id=group_id,
                                            service_id=service_id).all()
         if len(sg):
@@ -814,9 +1089,13 @@ class SFLvaultAccess(object):
         nsg = ServiceGroup()
         nsg.group_id = group_id
         nsg.service_id = service_id
-        nsg.cryptsymkey = encrypt_longmsg(grpeg, symkey)
+        try:
+            nsg.cryptsymkey = self._encrypt_for([grp], symkey)[0]
+        except CryptoPoolError, e:
+            return vaultMsg(False, str(e))
 
         meta.Session.add(nsg)
+        access.refresh(services=[service_id])
         transaction.commit()
 
         return vaultMsg(True, "Added service to group successfully", {})
@@ -844,6 +1123,7 @@ class SFLvaultAccess(object):
 
         # Remove the GroupService from the Group object.
         meta.Session.delete(sg)
+        access.refresh(services=[service_id], lock=[grp.id])
         transaction.commit()
 
         return vaultMsg(True, "Removed service from group successfully")
@@ -909,6 +1189,7 @@ class SFLvaultAccess(object):
         nug.cryptgroupkey = cryptgroupkey
 
         meta.Session.add(nug)
+        access.refresh(users=[usr.id])
         transaction.commit()
 
         return vaultMsg(True, "Added user to group successfully")
@@ -978,26 +1259,255 @@ class SFLvaultAccess(object):
             ohoh = " - WARNING: there are no more group-admins in this group.  Ask a global-admin to elect someone group-admin for further management of this group."
 
         meta.Session.delete(hisug[0])
+        access.refresh(users=[usr.id], lock=[grp.id])
         transaction.commit()
 
         return vaultMsg(True, "Removed user from group successfully" + ohoh, {})
 
 
+    def _rekey_pending(self, group_id):
+        """Select the (service_id, cryptsymkey) of the group's services that
+        were not re-encrypted with the new key yet, or have changed since"""
+        sg = servicegroups_table
+        rk = grouprekeysymkeys_table
+        return sql.select([sg.c.service_id, sg.c.cryptsymkey],
+                          from_obj=[sg.outerjoin(rk, sql.and_(
+                              rk.c.group_id == sg.c.group_id,
+                              rk.c.service_id == sg.c.service_id))])\
+                  .where(sg.c.group_id == group_id)\
+                  .where(sql.or_(rk.c.service_id == None,
+                                 rk.c.old_cryptsymkey != sg.c.cryptsymkey))
+
+    def _rekey_counts(self, group_id):
+        """Return (remaining, total) services to re-key in the group"""
+        pending = self._rekey_pending(group_id).alias()
+        remaining = meta.Session.execute(
+            sql.select([sql.func.count()]).select_from(pending)).scalar()
+        total = meta.Session.execute(
+            sql.select([sql.func.count()])\
+               .where(ServiceGroup.group_id == group_id)).scalar()
+        return remaining, total
+
+    def _rekey_job(self, group_id):
+        return meta.Session.execute(
+            grouprekeys_table.select()\
+                .where(grouprekeys_table.c.group_id == group_id)).first()
+
+    def _rekey_clear(self, group_id):
+        for t in [grouprekeysymkeys_table, grouprekeys_table]:
+            meta.Session.execute(t.delete().where(t.c.group_id == group_id))
+
+    def _rekey_group(self, group_id):
+        """Return the group and my UserGroup, or a vaultMsg if I can't
+        re-key it"""
+        try:
+            grp = model.get_objects_list(group_id, 'groups')[0][0]
+        except ValueError, e:
+            return None, vaultMsg(False, str(e))
+        myug = query(UserGroup).filter_by(group_id=grp.id,
+                                          user_id=self.myself_id).first()
+        if not myug:
+            return None, vaultMsg(False, "You are not part of that group")
+        return (grp, myug), None
+
+    def group_rekey_start(self, group_id):
+        """Start replacing a group's keypair, or resume a started re-keying.
+
+        Removing a user from a group doesn't revoke the group key he had, nor
+        the service symkeys encrypted with it.  Re-keying generates a new
+        group keypair, and encrypts it for each member right away.  Then
+        the client, which can decrypt the symkeys, goes through the
+        services with group_rekey_next() and group_rekey_put().  Progress
+        is saved by each group_rekey_put(), so it can be interrupted and
+        resumed.  Finally, group_rekey_finish() swaps the keys.
+
+        Returns the caller's current `cryptgroupkey`, the new `pubkey`, the
+        new group key encrypted for the caller (`new_cryptgroupkey`), and
+        the `remaining` and `total` services.
+        """
+        transaction.begin()
+        found, err = self._rekey_group(group_id)
+        if err:
+            return err
+        grp, myug = found
+
+        job = self._rekey_job(grp.id)
+        if not job:
+            ugs = query(UserGroup).filter_by(group_id=grp.id).all()
+            users = query(User).filter(User.id.in_([ug.user_id
+                                                    for ug in ugs])).all()
+            try:
+                newkeys, keys = self._new_group_keypair(users)
+            except CryptoPoolError, e:
+                return vaultMsg(False, str(e))
+            cryptgroupkeys = dict([(str(usr.id), key)
+                                   for usr, key in zip(users, keys)])
+
+            try:
+                meta.Session.execute(grouprekeys_table.insert(),
+                   {'group_id': grp.id,
+                    'pubkey': serial_elgamal_pubkey(elgamal_pubkey(newkeys)),
+                    'cryptgroupkeys': cryptgroupkeys,
+                    'user_id': self.myself_id,
+                    'started_time': datetime.now()})
+                mark_changed(meta.Session())
+                transaction.commit()
+                self.log_i('Re-keying started for group g#%(group_id)s',
+                           {'group_id': grp.id})
+            except IntegrityError:
+                # Started by someone else meanwhile: resume theirs.
+                transaction.abort()
+            job = self._rekey_job(grp.id)
+
+        remaining, total = self._rekey_counts(grp.id)
+        return vaultMsg(True, "Re-keying group %s" % grp.name,
+                        {'group_id': grp.id,
+                         'cryptgroupkey': myug.cryptgroupkey,
+                         'pubkey': job.pubkey,
+                         'new_cryptgroupkey':
+                             job.cryptgroupkeys.get(str(self.myself_id), ''),
+                         'remaining': remaining,
+                         'total': total})
+
+    def group_rekey_next(self, group_id, limit=100):
+        """Return up to `limit` [service_id, cryptsymkey] pairs of the
+        services still encrypted with the old group key"""
+        found, err = self._rekey_group(group_id)
+        if err:
+            return err
+        grp, myug = found
+        if not self._rekey_job(grp.id):
+            return vaultMsg(False, "No re-keying started for this group")
+
+        sel = self._rekey_pending(grp.id)\
+                  .order_by(ServiceGroup.service_id).limit(int(limit))
+        symkeys = [[sid, cryptsymkey]
+                   for sid, cryptsymkey in meta.Session.execute(sel)]
+        return vaultMsg(True, "Here are the symkeys to re-encrypt",
+                        {'symkeys': symkeys})
+
+    def group_rekey_put(self, group_id, symkeys):
+        """Save re-encrypted symkeys.
+
+        symkeys - list of [service_id, sha1 of the old cryptsymkey, new
+                  cryptsymkey].  Those whose cryptsymkey changed meanwhile
+                  are ignored, group_rekey_next() will return them again.
+        """
+        transaction.begin()
+        found, err = self._rekey_group(group_id)
+        if err:
+            return err
+        group_id = found[0].id
+        if not self._rekey_job(group_id):
+            return vaultMsg(False, "No re-keying started for this group")
+
+        symkeys = dict([(int(sid), (oldhash, cryptsymkey))
+                        for sid, oldhash, cryptsymkey in symkeys])
+        sel = sql.select([ServiceGroup.service_id, ServiceGroup.cryptsymkey])\
+                 .where(ServiceGroup.group_id == group_id)\
+                 .where(ServiceGroup.service_id.in_(symkeys.keys()))
+        rows = []
+        for sid, old in meta.Session.execute(sel):
+            oldhash, cryptsymkey = symkeys[sid]
+            if hashlib.sha1(old).hexdigest() != oldhash:
+                continue
+            rows.append({'group_id': group_id, 'service_id': sid,
+                         'old_cryptsymkey': old, 'cryptsymkey': cryptsymkey})
+
+        rk = grouprekeysymkeys_table
+        if rows:
+            meta.Session.execute(rk.delete()\
+                .where(rk.c.group_id == group_id)\
+                .where(rk.c.service_id.in_([x['service_id'] for x in rows])))
+            meta.Session.execute(rk.insert(), rows)
+            mark_changed(meta.Session())
+        remaining, total = self._rekey_counts(group_id)
+        transaction.commit()
+
+        return vaultMsg(True, "Saved %d symkeys" % len(rows),
+                        {'stored': len(rows), 'remaining': remaining,
+                         'total': total})
+
+    def group_rekey_finish(self, group_id, cryptgroupkeys=None):
+        """Replace the group's keys, once all its services were re-keyed.
+
+        cryptgroupkeys - [user_id, cryptgroupkey] pairs for the members who
+                         joined after the re-keying started.  When some are
+                         missing, the error's `missing_users` lists their
+                         [user_id, pubkey].
+        """
+        transaction.begin()
+        found, err = self._rekey_group(group_id)
+        if err:
+            return err
+        grp, myug = found
+        job = self._rekey_job(grp.id)
+        if not job:
+            return vaultMsg(False, "No re-keying started for this group")
+
+        remaining, total = self._rekey_counts(grp.id)
+        if remaining:
+            return vaultMsg(False, "%d services still need to be re-keyed"
+                            % remaining, {'remaining': remaining})
+
+        keys = dict(job.cryptgroupkeys)
+        for uid, cryptgroupkey in cryptgroupkeys or []:
+            keys[str(uid)] = cryptgroupkey
+        ugs = query(UserGroup).filter_by(group_id=grp.id).all()
+        missing = [ug.user_id for ug in ugs if str(ug.user_id) not in keys]
+        if missing:
+            users = query(User).filter(User.id.in_(missing)).all()
+            return vaultMsg(False, "Some members joined during the re-keying",
+                            {'missing_users': [[usr.id, usr.pubkey]
+                                               for usr in users]})
+
+        for ug in ugs:
+            ug.cryptgroupkey = keys[str(ug.user_id)]
+
+        rk = grouprekeysymkeys_table
+        sg = servicegroups_table
+        rows = [{'b_service_id': sid, 'b_old': old, 'b_new': new}
+                for sid, old, new in meta.Session.execute(
+                    sql.select([rk.c.service_id, rk.c.old_cryptsymkey,
+                                rk.c.cryptsymkey])\
+                       .where(rk.c.group_id == grp.id))]
+        if rows:
+            res = meta.Session.execute(sg.update()\
+                .where(sg.c.group_id == grp.id)\
+                .where(sg.c.service_id == sql.bindparam('b_service_id'))\
+                .where(sg.c.cryptsymkey == sql.bindparam('b_old'))\
+                .values(cryptsymkey=sql.bindparam('b_new')), rows)
+            if res.rowcount < total:
+                # A symkey changed since we counted.
+                transaction.abort()
+                return vaultMsg(False, "Services changed during the "
+                                "re-keying, try again", {'remaining': 1})
+
+        grp.pubkey = job.pubkey
+        self._rekey_clear(grp.id)
+        access.refresh(groups=[grp.id])
+        transaction.commit()
+        forget_elgamal(('group', grp.id))
+
+        self.log_i('Re-keying finished for group g#%(group_id)s',
+                   {'group_id': grp.id})
+        return vaultMsg(True, "Group %s re-keyed, %d services re-encrypted"
+                        % (grp.name, total), {'group_id': grp.id,
+                                             'total': total})
+
+
     def customer_del(self, customer_id):
         """Delete a customer from database, bringing along all it's machines
         and services
         """
         # Get customer
-        cust = query(model.Customer).options(model.eagerload('machines'))\
-                                    .get(int(customer_id))
+        cust = query(model.Customer, 'tree').get(int(customer_id))
 
         if not cust:
             return vaultMsg(True, "No such customer: c#%s" % customer_id)
 
         # Get all the services that will be deleted
-        servs = query(model.Service).join('machine', 'customer') \
-                     .filter(model.Customer.id == customer_id) \
-                     .all()
+        servs = [s for m in cust.machines for s in m.services]
         servs_ids = [s.id for s in servs]
 
         # Make sure no service is child of this one
@@ -1047,7 +1557,9 @@ class SFLvaultAccess(object):
         # meta.Session.execute(d3)
         # meta.Session.execute(d4)
 
+        access.refresh(services=servs_ids)
         transaction.commit()
+        self._reindex(customers=[customer_id])
 
         return vaultMsg(True,
                         'Deleted customer c#%s successfully' % customer_id)
@@ -1057,14 +1569,13 @@ class SFLvaultAccess(object):
         """Delete a machine from database, bringing on all child services."""
         transaction.begin()
         # Get machine
-        machine = query(model.Machine).get(int(machine_id))
+        machine = query(model.Machine, 'tree').get(int(machine_id))
 
         if not machine:
             return vaultMsg(True, "No such machine: m#%s" % machine_id)
 
         # Get all the services that will be deleted
-        servs = query(model.Service).join('machine') \
-                     .filter(model.Machine.id == machine_id).all()
+        servs = machine.services
         servs_ids = [s.id for s in servs]
 
         # Make sure no service is child of this one
@@ -1110,7 +1621,9 @@ class SFLvaultAccess(object):
  #       meta.Session.execute(d2)
  #       meta.Session.execute(d3)
 
+        access.refresh(services=servs_ids)
         transaction.commit()
+        self._reindex(machines=[machine_id])
 
         return vaultMsg(True, 'Deleted machine m#%s successfully' % machine_id)
 
@@ -1120,13 +1633,13 @@ class SFLvaultAccess(object):
         # Integerize
         service_id = int(service_id)
         # Get service
-        serv = query(model.Service).get(int(service_id))
+        serv = query(model.Service, 'tree').get(int(service_id))
 
         if not serv:
             return vaultMsg(True, "No such service: s#%s" % service_id)
 
         # Make sure no service is child of this one
-        childs = query(model.Service).filter_by(parent_service_id=service_id).all()
+        childs = serv.children
         if len(childs):
             # There are still some childs left, we can't delete this one.
             retval = []
@@ -1144,14 +1657,16 @@ class SFLvaultAccess(object):
         query(model.ServiceGroup).filter(model.ServiceGroup.service_id == service_id).delete(synchronize_session=False)
         # Delete the service
         query(Service).filter(model.Service.id==service_id).delete(synchronize_session=False)
+        access.refresh(services=[service_id])
         transaction.commit()
+        self._reindex(services=[service_id])
 
         return vaultMsg(True, 'Deleted service s#%s successfully' % service_id)
 
 
 
     def customer_list(self):
-        lst = query(Customer).all()
+        lst = query(Customer, 'minimal').all()
 
         out = []
         for x in lst:
@@ -1186,7 +1701,7 @@ class SFLvaultAccess(object):
 
     def service_list(self, machine_id=None, customer_id=None):
         """Return a simple list of the services"""
-        services = query(Service).join('machine')
+        services = query(Service, 'minimal').join('machine')
 
         # Filter also..
         if machine_id:
@@ -1226,13 +1741,169 @@ class SFLvaultAccess(object):
         # TODO: for traceability, mark the date we changed the password.
         #
 
-        for sg in serv.groups_assoc:
-            eg = [g for g in groups if g.id == sg.group_id][0].elgamal()
-            sg.cryptsymkey = encrypt_longmsg(eg, seckey)
+        groups_by_id = dict([(g.id, g) for g in groups])
+        assocs = serv.groups_assoc
+        try:
+            cryptsymkeys = self._encrypt_for([groups_by_id[sg.group_id]
+                                              for sg in assocs], seckey)
+        except CryptoPoolError, e:
+            transaction.abort()
+            return vaultMsg(False, str(e))
+        for sg, cryptsymkey in zip(assocs, cryptsymkeys):
+            sg.cryptsymkey = cryptsymkey
 
         grouplist = [g.name for g in groups]
+        access.refresh(services=[service_id])
         transaction.commit()
 
 
         return vaultMsg(True, "Password updated for service.", {'service_id': service_id,
                                                  'encrypted_for': grouplist})
+
+
+    def service_passwd_bulk(self, passwords=None, filters=None, policy=None,
+                            chunk_size=None, after_id=0, limit=0):
+        """Change the passwords of many services, committing every
+        `chunk_size` services.
+
+        passwords - list of [service_id, newsecret] pairs, or
+        filters - dict of 'customers', 'machines' and/or 'groups' IDs lists,
+                  selecting the services whose passwords are generated,
+                  following the `policy` (see generate_password())
+        after_id, limit - with filters, rotate at most `limit` services with
+                          an ID above `after_id`, so a client can go
+                          through a large rotation in a few calls.
+
+        Only the services the current user has access to are rotated, the
+        others are returned in 'skipped'.  The generated passwords are
+        returned in 'secrets', as [service_id, newsecret] pairs.
+        """
+        chunk_size = int(chunk_size or self.bulk_chunk_size)
+        if chunk_size < 1:
+            return vaultMsg(False, "chunk_size must be positive")
+
+        if passwords:
+            try:
+                passwords = [(int(sid), secret) for sid, secret in passwords]
+            except (TypeError, ValueError):
+                return vaultMsg(False, "passwords must be a list of "
+                                       "[service_id, newsecret] pairs")
+            generated = False
+            remaining = 0
+        elif filters:
+            sel = sql.select([Service.id],
+                             from_obj=[sql.join(services_table,
+                                                machines_table)\
+                                          .outerjoin(servicegroups_table)],
+                             distinct=True)\
+                     .where(Service.id > int(after_id))
+            try:
+                if filters.get('customers'):
+                    sel = sel.where(Machine.customer_id.in_(
+                        model.get_objects_ids(filters['customers'],
+                                              'customers')))
+                if filters.get('machines'):
+                    sel = sel.where(Machine.id.in_(
+                        model.get_objects_ids(filters['machines'],
+                                              'machines')))
+                if filters.get('groups'):
+                    sel = sel.where(ServiceGroup.group_id.in_(
+                        model.get_objects_ids(filters['groups'], 'groups')))
+                # Only this page's services, the others are counted.
+                page = sel.order_by(Service.id)
+                if limit:
+                    page = page.limit(int(limit))
+                service_ids = [x[0] for x in meta.Session.execute(page)]
+                remaining = 0
+                if limit and len(service_ids) == int(limit):
+                    remaining = meta.Session.execute(
+                        sql.select([sql.func.count()],
+                                   from_obj=[sel.alias()])).scalar() \
+                        - len(service_ids)
+                passwords = [(sid, generate_password(policy))
+                             for sid in service_ids]
+            except ValueError, e:
+                return vaultMsg(False, str(e))
+            generated = True
+        else:
+            return vaultMsg(False, "Specify either passwords or filters")
+
+        # Only rotate what we could decrypt.
+        allowed = set([row.service_id for row in
+                       access.access_list(self.myself_id,
+                                          [x[0] for x in passwords])])
+        skipped = [sid for sid, secret in passwords if sid not in allowed]
+        last_id = max([x[0] for x in passwords] + [0])
+        passwords = [x for x in passwords if x[0] in allowed]
+
+        rotated = []
+        failed = None
+        for start in range(0, len(passwords), chunk_size):
+            chunk = dict(passwords[start:start + chunk_size])
+            committed = len(rotated)
+            transaction.begin()
+            services = query(Service).filter(Service.id.in_(chunk.keys()))\
+                                     .options(eagerload('groups_assoc'))\
+                                     .all()
+            group_ids = set([sg.group_id for serv in services
+                             for sg in serv.groups_assoc])
+            groups = dict([(g.id, g) for g in
+                           query(Group).filter(Group.id.in_(group_ids))])
+
+            secrets = []
+            symkeys = []
+            for serv in services:
+                (seckey, ciphertext) = encrypt_secret(chunk[serv.id])
+                assocs = serv.groups_assoc
+                try:
+                    cryptsymkeys = self._encrypt_for(
+                        [groups[sg.group_id] for sg in assocs], seckey)
+                except CryptoPoolError, e:
+                    failed = e
+                    break
+                secrets.append({'b_id': serv.id, 'b_secret': ciphertext,
+                                'b_modified': datetime.now()})
+                symkeys.extend([{'b_id': sg.id, 'b_cryptsymkey': cryptsymkey}
+                                for sg, cryptsymkey in zip(assocs,
+                                                           cryptsymkeys)])
+                del(seckey)
+                rotated.append(serv.id)
+
+            if failed:
+                # Drop the chunk, the ones before are committed
+                transaction.abort()
+                del rotated[committed:]
+                break
+            # A statement per table for the whole chunk, not one per row.
+            if secrets:
+                meta.Session.execute(services_table.update()\
+                    .where(services_table.c.id == sql.bindparam('b_id'))\
+                    .values(secret=sql.bindparam('b_secret'),
+                            secret_last_modified=sql.bindparam('b_modified')),
+                    secrets)
+            if symkeys:
+                meta.Session.execute(servicegroups_table.update()\
+                    .where(servicegroups_table.c.id == sql.bindparam('b_id'))\
+                    .values(cryptsymkey=sql.bindparam('b_cryptsymkey')),
+                    symkeys)
+            mark_changed(meta.Session())
+            access.refresh(services=chunk.keys())
+            transaction.commit()
+            self.log_i('Bulk password rotation: %(done)d/%(total)d services',
+                       {'done': len(rotated), 'total': len(passwords)})
+
+        ret = {'rotated': rotated,
+               'skipped': skipped,
+               'remaining': remaining,
+               'last_id': last_id}
+        if generated:
+            done = set(rotated)
+            ret['secrets'] = [[sid, secret] for sid, secret in passwords
+                              if sid in done]
+        if failed:
+            # Resume after the last one rotated
+            ret['last_id'] = max(rotated + [int(after_id)])
+            return vaultMsg(False, "%s (passwords updated for %d services)" %
+                            (failed, len(rotated)), ret)
+        return vaultMsg(True, "Passwords updated for %d services." %
+                        len(rotated), ret)
@@ -20,14 +20,18 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from base64 import b64decode, b64encode
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 import re
+import threading
 
 from Crypto.PublicKey import ElGamal
-from sqlalchemy import Column, MetaData, Table, types, ForeignKey
+from sqlalchemy import Column, MetaData, Table, types, ForeignKey, Index
 from sqlalchemy.orm import mapper, relation, backref
 from sqlalchemy.orm import scoped_session, sessionmaker, eagerload, lazyload
-from sqlalchemy.orm import eagerload_all
+from sqlalchemy.orm import eagerload_all, subqueryload_all
+from sqlalchemy.orm.session import Session as BaseSession
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy import sql
 
@@ -40,17 +44,53 @@ from zope.sqlalchemy import ZopeTransactionExtension
 # TODO: add an __all__ statement here, to speed up loading...
 
 
-def init_model(engine):
-    """Call me before using any of the tables or classes in the model."""
+def init_model(engine, replica=None):
+    """Call me before using any of the tables or classes in the model.
+
+    replica - engine of a read-only copy of the database, used for the
+              SELECTs in read_only() blocks
+    """
     sm = sessionmaker(autoflush=True,
                       bind=engine,
                       expire_on_commit=False,
+                      class_=RoutingSession,
                       extension=ZopeTransactionExtension())
 
     meta.engine = engine
+    meta.replica = replica
     meta.Session = scoped_session(sm)
 
 
+_routing = threading.local()
+
+@contextmanager
+def read_only():
+    """Send the SELECTs made in the block, by this thread, to the replica
+    engine, if there is one.  The caller makes sure the replica isn't
+    expected to have rows it might not have received yet."""
+    previous = getattr(_routing, 'read_only', False)
+    _routing.read_only = True
+    try:
+        yield
+    finally:
+        _routing.read_only = previous
+
+
+class RoutingSession(BaseSession):
+    """Session sending the SELECTs of read_only() blocks to meta.replica.
+
+    Everything else, and anything done while flushing, goes to the
+    primary engine.
+    """
+    def get_bind(self, mapper=None, clause=None):
+        if meta.replica is not None and \
+                getattr(_routing, 'read_only', False) and \
+                not self._flushing and \
+                isinstance(clause, sql.expression.Select):
+            return meta.replica
+        return BaseSession.get_bind(self, mapper, clause)
+
+
 users_table = Table("users", metadata,
                     Column('id', types.Integer, primary_key=True),
                     Column('username', types.Unicode(50)),
@@ -146,6 +186,126 @@ services_table = Table('services', metadata,
                        )
 
 
+# XML-RPC sessions, when using the 'sql' session store
+sessions_table = Table('sessions', metadata,
+                       Column('authtok', types.String(64), primary_key=True),
+                       # JSON-encoded session data
+                       Column('data', types.Text),
+                       Column('timeout', types.DateTime, index=True)
+                       )
+
+# Pre-generated group keypairs, see sflvault.lib.keypool
+keypairs_table = Table('keypairs', metadata,
+                       Column('id', types.Integer, primary_key=True),
+                       # AES-encrypted serialized ElGamal keypair
+                       Column('cryptkeypair', types.Text),
+                       Column('created_time', types.DateTime,
+                              default=datetime.now)
+                       )
+
+# Group re-keying jobs, see SFLvaultAccess.group_rekey_start()
+grouprekeys_table = Table('group_rekeys', metadata,
+                          Column('group_id', types.Integer,
+                                 ForeignKey('groups.id'), primary_key=True),
+                          # The group's new ElGamal public key
+                          Column('pubkey', types.Text),
+                          # The new group key, encrypted for each member
+                          # {user_id: cryptgroupkey}
+                          Column('cryptgroupkeys', JSONEncodedDict),
+                          Column('user_id', types.Integer,
+                                 ForeignKey('users.id')),
+                          Column('started_time', types.DateTime,
+                                 default=datetime.now)
+                          )
+
+# Service symkeys already encrypted with the new group key
+grouprekeysymkeys_table = Table('group_rekey_symkeys', metadata,
+                                Column('group_id', types.Integer,
+                                       ForeignKey('groups.id'),
+                                       primary_key=True),
+                                Column('service_id', types.Integer,
+                                       ForeignKey('services.id'),
+                                       primary_key=True),
+                                # The services_groups.cryptsymkey it was
+                                # made from, to spot the ones that changed
+                                # since.
+                                Column('old_cryptsymkey', types.Text),
+                                Column('cryptsymkey', types.Text)
+                                )
+
+# Best group through which each user can read each service, maintained by
+# SFLvaultAccess, see sflvault.lib.access
+useraccess_table = Table('user_service_access', metadata,
+                         Column('user_id', types.Integer,
+                                ForeignKey('users.id'), primary_key=True),
+                         Column('service_id', types.Integer,
+                                ForeignKey('services.id'), primary_key=True,
+                                index=True),
+                         Column('group_id', types.Integer,
+                                ForeignKey('groups.id')),
+                         # Copies of users_groups.cryptgroupkey and
+                         # services_groups.cryptsymkey for that group
+                         Column('cryptgroupkey', types.Text),
+                         Column('cryptsymkey', types.Text)
+                         )
+
+# Applied schema migrations, see sflvault.lib.migrations
+schemaversion_table = Table('schema_version', metadata,
+                            Column('version', types.Integer, primary_key=True),
+                            Column('description', types.Unicode(250)),
+                            Column('applied_time', types.DateTime,
+                                   default=datetime.now)
+                            )
+
+# Lookup indexes.  Vaults created before them get them from the migration
+# 1 in sflvault.lib.migrations.
+Index('ix_services_machine_id', services_table.c.machine_id)
+Index('ix_services_parent_service_id', services_table.c.parent_service_id)
+Index('ix_machines_customer_id', machines_table.c.customer_id)
+Index('ix_services_groups_service_id_group_id',
+      servicegroups_table.c.service_id, servicegroups_table.c.group_id)
+Index('ix_users_groups_user_id_group_id',
+      usergroups_table.c.user_id, usergroups_table.c.group_id)
+Index('ix_users_username', users_table.c.username)
+
+
+# Parsed ElGamal pubkeys, by entity, for the whole process.  See
+# cached_elgamal().
+PUBKEY_CACHE_SIZE = 1024
+_pubkeys = OrderedDict()
+_pubkeys_lock = threading.Lock()
+
+def cached_elgamal(entity, pubkey):
+    """Return the ElGamal object of a serialized pubkey, parsing it only
+    the first time.
+
+    entity - hashable key, like ('user', 12), under which it is cached.  An
+             entry is only used if its pubkey is still `pubkey`.
+
+    The returned object is shared: only use it to encrypt stuff.
+    """
+    with _pubkeys_lock:
+        entry = _pubkeys.pop(entity, None)
+        if entry and entry[0] == pubkey:
+            _pubkeys[entity] = entry
+            return entry[1]
+
+    e = ElGamal.ElGamalobj()
+    (e.p, e.g, e.y) = unserial_elgamal_pubkey(pubkey)
+
+    with _pubkeys_lock:
+        _pubkeys[entity] = (pubkey, e)
+        while len(_pubkeys) > PUBKEY_CACHE_SIZE:
+            _pubkeys.popitem(last=False)
+    return e
+
+def forget_elgamal(entity):
+    """Drop the cached ElGamal object of an entity whose pubkey changed,
+    or which was deleted"""
+    with _pubkeys_lock:
+        _pubkeys.pop(entity, None)
+
+
 class Service(object):
     def __repr__(self):
         return "<Service s#%d: %s>" % (self.id, self.url)
@@ -164,9 +324,7 @@ class User(object):
 
     def elgamal(self):
         """Return the ElGamal object, ready to encrypt stuff."""
-        e = ElGamal.ElGamalobj()
-        (e.p, e.g, e.y) = unserial_elgamal_pubkey(self.pubkey)
-        return e
+        return cached_elgamal(('user', self.id), self.pubkey)
     
     def __repr__(self):
         return "<User u#%d: %s>" % (self.id, self.username)
@@ -195,9 +353,7 @@ class Group(object):
     
     def elgamal(self):
         """Return the ElGamal object, ready to encrypt stuff."""
-        e = ElGamal.ElGamalobj()
-        (e.p, e.g, e.y) = unserial_elgamal_pubkey(self.pubkey)
-        return e
+        return cached_elgamal(('group', self.id), self.pubkey)
 
 class Customer(object):
     def __repr__(self):
@@ -226,7 +382,7 @@ class Customer(object):
 mapper(User, users_table, {
     # Quick access to services...
     'services': relation(Service,
-                         secondary=usergroups_table.join(servicegroups_table, usergroups_table.c.group_id==servicegroups_table.c.group_id),
+                         secondary=useraccess_table,
                          backref='users',
                          viewonly=True,
                          ),
@@ -250,7 +406,6 @@ mapper(ServiceGroup, servicegroups_table, {
 
 mapper(Service, services_table, {
     'children': relation(Service,
-                         lazy=False,
                          backref=backref('parent', uselist=False,
                                          remote_side=[services_table.c.id]),
                          primaryjoin=services_table.c.parent_service_id==services_table.c.id)
@@ -258,17 +413,33 @@ mapper(Service, services_table, {
 Service.groups = association_proxy('groups_assoc', 'group')
 
 mapper(Machine, machines_table, {
-    'services': relation(Service, backref='machine', lazy=False)
+    'services': relation(Service, backref='machine')
     })
 mapper(Customer, customers_table, {
-    'machines': relation(Machine, backref='customer', lazy=False)
+    'machines': relation(Machine, backref='customer')
     })
 
+# Relations loaded up-front by each loading profile of query().  All the
+# relations are lazy otherwise, so that loading a customer doesn't bring
+# its whole subtree along.
+LOADING_PROFILES = {
+    # The objects alone, for lists and single-object calls.
+    'minimal': {},
+    # Each object's subtree, for deletes and exports.
+    'tree': {Customer: ['machines.services'],
+             Machine: ['services'],
+             Service: ['children']},
+    }
+
 ################ Helper functions ################
 
-def query(cls):
-    """Shortcut to meta.Session.query(cls)"""
-    return meta.Session.query(cls)
+def query(cls, profile='minimal'):
+    """Shortcut to meta.Session.query(cls), loading the relations of
+    the given LOADING_PROFILES profile"""
+    q = meta.Session.query(cls)
+    for path in LOADING_PROFILES[profile].get(cls, []):
+        q = q.options(subqueryload_all(path))
+    return q
 
 
 def get_user(user, eagerload_all_=None):
@@ -295,7 +466,7 @@ def get_objects_ids(objects_ids, object_type):
     """Return a list of valid IDs for certain object types.
 
     objects_ids - Must be a list of str or ints
-    object_type - One of 'groups', 'machines', 'customers
+    object_type - One of 'groups', 'machines', 'customers', 'users'
     """
     return get_objects_list(objects_ids, object_type, return_objects=False)[1]
 
@@ -306,13 +477,14 @@ def get_objects_list(objects_ids, object_type, eagerload_all_=None,
     sure we return a list of integers as IDs.
 
     object_type - the type of object to be returned. It must be one of
-                ['groups', 'machines', 'customers']
+                ['groups', 'machines', 'customers', 'users']
     return_objects - whether to return the actual objects or not.
     """
 
     objects_types_assoc = {'groups': Group,
                            'machines': Machine,
-                           'customers': Customer}
+                           'customers': Customer,
+                           'users': User}
 
     # Check if object_type is valid
     if object_type not in objects_types_assoc:
@@ -349,7 +521,33 @@ def get_objects_list(objects_ids, object_type, eagerload_all_=None,
     return (objects if return_objects else None, objects_ids)
 
 
-def search_query(swords, filters=None, verbose=False):
+# Above this number of matches, search_query() scans the tables instead of
+# using the search index.
+SEARCH_INDEX_MAX_ROWS = 1000
+
+# Fields to search in..
+search_textfields = [customers_table.c.name,
+                     machines_table.c.name,
+                     machines_table.c.fqdn,
+                     machines_table.c.ip,
+                     machines_table.c.location,
+                     machines_table.c.notes,
+                     services_table.c.url,
+                     services_table.c.notes]
+
+
+def search_query(swords, filters=None, verbose=False, index=None,
+                 limit=None, after=None):
+    """Return the rows of the customers/machines/services join matching
+    all the words in `swords`.
+
+    index - a search index (see sflvault.lib.search), used to find the
+            matching rows instead of scanning the whole join.
+    limit - return a page of at most `limit` rows, ordered by customer,
+            machine and service IDs.
+    after - with `limit`, start after the row with these (customer_id,
+            machine_id, service_id), 0 standing for no machine/service.
+    """
 
     # Create the join..
     sel = sql.outerjoin(customers_table, machines_table).outerjoin(services_table)
@@ -377,34 +575,71 @@ def search_query(swords, filters=None, verbose=False):
         if 'customers' in filters:
             sel = sel.where(Customer.id.in_(filters['customers']))
 
-    # Fields to search in..
-    textfields = [Customer.name,
-                  Machine.name,
-                  Machine.fqdn,
-                  Machine.ip,
-                  Machine.location,
-                  Machine.notes,
-                  Service.url,
-                  Service.notes]
-    numfields = [Customer.id,
-                 Machine.id,
-                 Service.id]
-    
-    # TODO: distinguish between INTEGER fields and STRINGS and search
-    # differently (check only ==, and only if word can be converted to int())
-
-    andlist = []
-    for word in swords:
-        orlist = [field.ilike('%%%s%%' % word) for field in textfields]
-        if word.isdigit():
-            # Search numeric fields too
-            orlist += [field == int(word) for field in numfields]
-        orword = sql.or_(*orlist)
-        andlist.append(orword)
-
-    sel = sel.where(sql.and_(*andlist))
-
-    sel = sel.order_by(Machine.name, Service.url)
+    keys = index.search(swords) if index else None
+
+    if keys is not None and len(keys) > SEARCH_INDEX_MAX_ROWS:
+        # Picking that many rows by ID is slower than scanning.
+        keys = None
+
+    if keys is not None:
+        # The index found the rows, pick them by their primary keys.
+        sids = [k[2] for k in keys if k[2] is not None]
+        mids = [k[1] for k in keys if k[2] is None and k[1] is not None]
+        cids = [k[0] for k in keys if k[1] is None]
+        orlist = []
+        if sids:
+            orlist.append(Service.id.in_(sids))
+        if mids:
+            orlist.append(sql.and_(Machine.id.in_(mids), Service.id == None))
+        if cids:
+            orlist.append(sql.and_(Customer.id.in_(cids), Machine.id == None))
+        if not orlist:
+            # Nothing matched
+            orlist.append(Customer.id == None)
+        sel = sel.where(sql.or_(*orlist))
+        # Redundant, but lets the database start the join from the matches.
+        if keys:
+            sel = sel.where(Customer.id.in_(set([k[0] for k in keys])))
+            allmids = set([k[1] for k in keys if k[1] is not None])
+            if allmids:
+                sel = sel.where(sql.or_(Machine.id.in_(allmids),
+                                        Machine.id == None))
+    else:
+        numfields = [Customer.id,
+                     Machine.id,
+                     Service.id]
+
+        # TODO: distinguish between INTEGER fields and STRINGS and search
+        # differently (check only ==, and only if word can be converted to
+        # int())
+
+        andlist = []
+        for word in swords:
+            orlist = [field.ilike('%%%s%%' % word)
+                      for field in search_textfields]
+            if word.isdigit():
+                # Search numeric fields too
+                orlist += [field == int(word) for field in numfields]
+            orword = sql.or_(*orlist)
+            andlist.append(orword)
+
+        sel = sel.where(sql.and_(*andlist))
+
+    if limit:
+        pkeys = [Customer.id,
+                 sql.func.coalesce(Machine.id, 0),
+                 sql.func.coalesce(Service.id, 0)]
+        if after:
+            (cid, mid, sid) = after
+            sel = sel.where(sql.or_(pkeys[0] > cid,
+                                    sql.and_(pkeys[0] == cid,
+                                             pkeys[1] > mid),
+                                    sql.and_(pkeys[0] == cid,
+                                             pkeys[1] == mid,
+                                             pkeys[2] > sid)))
+        sel = sel.order_by(*pkeys).limit(limit)
+    else:
+        sel = sel.order_by(Machine.name, Service.url)
 
     return meta.Session.execute(sel)
 
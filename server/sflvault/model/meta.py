@@ -22,11 +22,15 @@
 """SQLAlchemy Metadata and Session object"""
 from sqlalchemy import MetaData
 
-__all__ = ['engine', 'metadata', 'Session']
+__all__ = ['engine', 'replica', 'metadata', 'Session']
 
 # SQLAlchemy database engine.  Updated by model.init_model().
 engine = None
 
+# Engine of the read-only copy of the database, or None.  Updated by
+# model.init_model().
+replica = None
+
 # SQLAlchemy session manager.  Updated by model.init_model().
 Session = None
 
@@ -19,15 +19,59 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from sflvault.tests import TestController
+from sflvault.tests import TestController, tracefile
 from sflvault.common.crypto import *
-from sflvault.client.client import authenticate
+from sflvault.client.client import authenticate, vaultReply
+from sflvault.common import VaultError
 from sflvault.client.client import SFLvaultConfig, SFLvaultClient
+from sflvault.client.transport import ConnectionPool, PooledTransport
+from sflvault.lib.vault import SFLvaultAccess, vaultMsg
+from sflvault.lib.search import TrigramIndex
+from sflvault.lib.sessions import MemorySessionStore, SQLSessionStore
+from sflvault.lib.sessions import FileSessionStore
+from sflvault.lib.keypool import KeypairPool
+from sflvault.lib.cryptopool import CryptoPool, encrypt_for_pubkeys
+from sflvault.lib.cryptopool import CryptoPoolError, CryptoPoolBusy
+from sflvault.lib.cryptopool import CryptoPoolTimeout
+from sflvault.lib import access as access_index
+from sflvault.lib import migrations
+from sflvault.lib import metrics
+from sflvault.lib import tracing
+from sflvault import model
+from sflvault import views
+from sflvault.tests.bench_groups import QueryCounter
+from sflvault.tests import bench_budgets
+from sflvault.tests.benchmark import generator, runner, load
+from base64 import b64encode
+from sqlalchemy import create_engine
+from sqlalchemy.engine.reflection import Inspector
+from datetime import datetime, timedelta
+import tempfile
+import os
+import re
+import transaction
+import time
+import xmlrpclib
+import json
+import socket
+import urllib2
+import shutil
 import logging
+import threading
 import random
+import multiprocessing
 
 log = logging.getLogger('tester')
 
+
+def _gated(events):
+    """Crypto pool job setting the first event, then holding its worker
+    until the second is set"""
+    started, gate = events
+    started.set()
+    gate.wait()
+    return True
+
 class TestVaultController(TestController):
     
 
@@ -57,8 +101,15 @@ class TestVaultController(TestController):
                                'secret') 
         
 
+    def _access(self, user_id=1):
+        """Returns the server-side vault, acting as user_id"""
+        access = SFLvaultAccess()
+        access.myself_id = user_id
+        return access
+
     def setUp(self):
         self.vault = self.getVault()
+        self.access = self._access()
 
     def test_customer_add(self):
         """testing add a new customer to the vault"""
@@ -188,6 +239,958 @@ class TestVaultController(TestController):
         self.assertEqual("Password updated for service.", pres['message'])
         self.assertEqual(sres['service_id'], pres['service_id'])
 
+    def test_groupkey_cache(self):
+        """testing the group key is decrypted only once per group"""
+        gres = self._add_new_group()
+        grp = self.vault.group_get(gres['group_id'])
+        cache = self.vault.groupkeys
+        cache.wipe()
+        misses, hits = cache.misses, cache.hits
+        eg1 = cache.get(self.vault.privkey, grp['id'], grp['cryptgroupkey'])
+        eg2 = cache.get(self.vault.privkey, grp['id'], grp['cryptgroupkey'])
+        self.assertTrue(eg1 is eg2)
+        self.assertEqual(cache.misses, misses + 1)
+        self.assertEqual(cache.hits, hits + 1)
+        cache.wipe()
+        self.assertEqual(len(cache), 0)
+
+    def test_service_get_many(self):
+        """testing fetching many service trees at once"""
+        sres = self._add_new_service()
+        parent_id = sres['service_id']
+        mid = self._add_new_machine()['machine_id']
+        gid = self._add_new_group()['group_id']
+        cres = self.vault.service_add(mid, parent_id, 'ssh://child', [gid],
+                                      'child secret')
+        child_id = cres['service_id']
+
+        res = self.access.service_get_many([child_id, parent_id], True)
+        self.assertFalse(res['error'])
+        trees = res['services']
+        self.assertEqual([x['id'] for x in trees[0]], [parent_id, child_id])
+        self.assertEqual([x['id'] for x in trees[1]], [parent_id])
+        self.assertTrue(trees[0][1]['cryptsymkey'])
+        self.assertEqual(trees[0][1]['groups_list'][0][0], gid)
+
+        res = self.access.service_get_many([child_id, 999999])
+        self.assertTrue(res['error'])
+
+    def test_service_passwd_bulk(self):
+        """testing the bulk password rotation"""
+        mid = self._add_new_machine()['machine_id']
+        gid = self._add_new_group()['group_id']
+        sids = [self.vault.service_add(mid, 0, 'ssh://bulk%d' % x, [gid],
+                                       'old secret')['service_id']
+                for x in range(3)]
+        # Nobody can decrypt this one
+        orphan = self.vault.service_add(mid, 0, 'ssh://orphan', [],
+                                        'old secret')['service_id']
+
+        def plaintext(sid):
+            serv = self.access.service_get(sid)['service']
+            self.vault._decrypt_service(serv)
+            return serv['plaintext']
+
+        steps = []
+        res = self.vault.service_passwd_bulk(filters={'machines': [mid]},
+                                       policy={'length': 20, 'charset': 'hex'},
+                                       chunk_size=2,
+                                       progress=lambda *x: steps.append(x))
+        self.assertEqual(sorted(res['rotated']), sorted(sids))
+        self.assertEqual(res['skipped'], [orphan])
+        self.assertEqual(steps, [(2, 4), (4, 4)])
+        for sid, secret in res['secrets']:
+            self.assertEqual(len(secret), 20)
+            self.assertEqual(plaintext(sid), secret)
+
+        res = self.vault.service_passwd_bulk([(sids[0], 'new one'),
+                                              (orphan, 'nope')])
+        self.assertEqual(res['rotated'], [sids[0]])
+        self.assertEqual(res['secrets'], [])
+        self.assertEqual(plaintext(sids[0]), 'new one')
+
+        # Pages of the filtered services
+        res = self.access.service_passwd_bulk(filters={'machines': [mid]},
+                                         limit=3)
+        self.assertEqual((sorted(res['rotated']), res['remaining']),
+                         (sorted(sids), 1))
+        self.assertEqual(res['skipped'], [])
+        res = self.access.service_passwd_bulk(filters={'machines': [mid]},
+                                         after_id=res['last_id'], limit=3)
+        self.assertEqual((res['rotated'], res['remaining']), ([], 0))
+        self.assertEqual(res['skipped'], [orphan])
+
+        res = self.access.service_passwd_bulk(filters={'machines': [mid]},
+                                         policy={'length': 0})
+        self.assertTrue(res['error'])
+
+    def test_group_rekey(self):
+        """testing the re-keying of a group"""
+        mid = self._add_new_machine()['machine_id']
+        gid = self._add_new_group()['group_id']
+        sids = [self.vault.service_add(mid, 0, 'ssh://rekey%d' % x, [gid],
+                                       'secret %d' % x)['service_id']
+                for x in range(3)]
+
+        def plaintext(sid):
+            serv = self.access.service_get(sid, gid)['service']
+            self.vault._decrypt_service(serv)
+            return serv['plaintext']
+
+        oldcryptgroupkey = self.access.group_get(gid)['group']['cryptgroupkey']
+        res = self.access.group_rekey_start(gid)
+        self.assertFalse(res['error'])
+        self.assertEqual((res['remaining'], res['total']), (3, 3))
+        newpubkey = res['pubkey']
+        # Starting again resumes the same job
+        self.assertEqual(self.access.group_rekey_start(gid)['pubkey'],
+                         newpubkey)
+        # Also when started by someone else in the meantime
+        racing = self._access()
+        missed = []
+        def missed_job(group_id):
+            if not missed:
+                missed.append(group_id)
+                return None
+            return SFLvaultAccess._rekey_job(racing, group_id)
+        racing._rekey_job = missed_job
+        self.assertEqual(racing.group_rekey_start(gid)['pubkey'], newpubkey)
+        self.assertEqual(missed, [gid])
+        for junk in ['junk', None, 999999]:
+            self.assertTrue(self.access.group_rekey_start(junk)['error'])
+        self.assertTrue(self.access.group_rekey_finish(gid)['error'])
+
+        # A symkey that changed since it was read is not saved
+        sid, cryptsymkey = self.access.group_rekey_next(gid, 1)['symkeys'][0]
+        res = self.access.group_rekey_put(gid, [[sid, 'stale', 'junk']])
+        self.assertEqual((res['stored'], res['remaining']), (0, 3))
+
+        steps = []
+        self.vault.group_rekey(gid, batch_size=2,
+                               progress=lambda *x: steps.append(x))
+        self.assertEqual(steps, [(2, 3), (3, 3)])
+        self.assertNotEqual(
+            self.access.group_get(gid)['group']['cryptgroupkey'],
+            oldcryptgroupkey)
+        for x, sid in enumerate(sids):
+            self.assertEqual(plaintext(sid), 'secret %d' % x)
+
+        res = self.access.group_rekey_next(gid, 10)
+        self.assertTrue(res['error'])
+
+    def test_access_index(self):
+        """testing the user/service access index follows the groups"""
+        mid = self._add_new_machine()['machine_id']
+        g1 = self._add_new_group()['group_id']
+        g2 = self._add_new_group()['group_id']
+        sid = self.vault.service_add(mid, 0, 'ssh://indexed', [g2],
+                                     'secret')['service_id']
+
+        def index_ok():
+            diff = access_index.check()
+            return not (diff['missing'] or diff['extra'] or diff['stale'])
+
+        self.assertEqual(access_index.access_get(1, sid).group_id, g2)
+        self.assertTrue(index_ok())
+        # The lowest group ID is used
+        self.vault.group_add_service(g1, sid)
+        self.assertEqual(access_index.access_get(1, sid).group_id, g1)
+        self.assertTrue(index_ok())
+        self.vault.group_del_service(g1, sid)
+        self.assertEqual(access_index.access_get(1, sid).group_id, g2)
+        old = access_index.access_get(1, sid).cryptsymkey
+        self.vault.service_passwd(sid, 'new secret')
+        self.assertNotEqual(access_index.access_get(1, sid).cryptsymkey, old)
+        self.assertTrue(index_ok())
+        serv = self.vault.service_get(sid)
+        self.assertEqual(serv['plaintext'], 'new secret')
+
+        model.meta.Session.execute(model.useraccess_table.delete()\
+                                   .where(model.useraccess_table.c.service_id
+                                          == sid))
+        self.assertEqual(access_index.check()['missing'], [(1, sid)])
+        access_index.rebuild()
+        transaction.commit()
+        self.assertTrue(index_ok())
+
+        self.vault.service_del(sid)
+        self.assertEqual(access_index.access_get(1, sid), None)
+        self.assertTrue(index_ok())
+
+    def test_access_index_concurrent(self):
+        """testing concurrent grants to a group all reach the access index"""
+        gid = self._add_new_group()['group_id']
+        sid = self._add_new_service()['service_id']
+        self.assertFalse(self.access.user_add(u'concurrent', False)['error'])
+        uid = model.get_user(u'concurrent').id
+        model.meta.Session.remove()
+
+        # Adding u to g, then s to g while the first isn't committed.
+        refreshed = threading.Event()
+        started = threading.Event()
+        refresh = access_index.refresh
+        def paused_refresh(*args, **kwargs):
+            refresh(*args, **kwargs)
+            if threading.current_thread().name == 'add-user':
+                refreshed.set()
+                started.wait(10)
+        res = {}
+        def add_user():
+            res['user'] = self.access.group_add_user(gid, uid, False,
+                                                b64encode('k' * 400))
+            model.meta.Session.remove()
+        def add_service():
+            refreshed.wait(10)
+            started.set()
+            res['service'] = self.access.group_add_service(gid, sid, 'symkey')
+            model.meta.Session.remove()
+        access_index.refresh = paused_refresh
+        try:
+            threads = [threading.Thread(target=add_user, name='add-user'),
+                       threading.Thread(target=add_service)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            access_index.refresh = refresh
+        self.assertFalse(res['user']['error'])
+        self.assertFalse(res['service']['error'])
+        self.assertEqual(access_index.access_get(uid, sid).group_id, gid)
+        diff = access_index.check()
+        self.assertFalse(diff['missing'] or diff['extra'] or diff['stale'])
+        self.assertFalse(self.access.user_del(uid)['error'])
+
+    def test_group_user_lists(self):
+        """testing the filters of user_list and group_list"""
+        g1 = self._add_new_group()['group_id']
+        g2 = self._add_new_group()['group_id']
+
+        res = self.access.user_list(True, group_ids=[g1])
+        self.assertEqual([x['id'] for x in res['list']], [1])
+        self.assertTrue(g1 in [x['id'] for x in res['list'][0]['groups']])
+        everyone = self.access.user_list(True)['list']
+        self.assertEqual([x for x in everyone if x['id'] == 1], res['list'])
+
+        res = self.access.group_list(group_ids=[g1, g2])
+        self.assertEqual([x['id'] for x in res['list']], [g1, g2])
+        for grp in res['list']:
+            self.assertTrue(grp['member'] and grp['admin'])
+            self.assertTrue(grp['cryptgroupkey'])
+            self.assertEqual([x[0] for x in grp['members']], [1])
+        mine = self.access.group_list(user_ids=[1])['list']
+        self.assertTrue(set([g1, g2]) <= set([x['id'] for x in mine]))
+        self.assertTrue(self.access.group_list(group_ids=[999999])['error'])
+
+    def test_loading_profiles(self):
+        """testing lists load the objects alone, and deletes their tree"""
+        cid = self.vault.customer_add(u"Profiled")['customer_id']
+        mid = self.vault.machine_add(cid, "profiled-box")['machine_id']
+        self.vault.service_add(mid, 0, 'ssh://profiled', [], 'secret')
+        counter = QueryCounter(model.meta.engine)
+
+        def tables(call):
+            """Return the tables read by each query of call()"""
+            model.meta.Session.remove()
+            counter.reset()
+            call()
+            return [sorted(re.findall(r'(?:FROM|JOIN) (\w+)', x))
+                    for x in counter.statements]
+
+        self.assertEqual(tables(self.access.customer_list), [['customers']])
+        self.assertEqual(tables(lambda: self.access.customer_get(cid)),
+                         [['customers']])
+        self.assertEqual(tables(lambda: self.access.machine_get(mid)),
+                         [['machines']])
+
+        def tree():
+            cust = model.query(model.Customer, 'tree').get(cid)
+            self.assertEqual([s.url for m in cust.machines
+                              for s in m.services], ['ssh://profiled'])
+        self.assertEqual(len(tables(tree)), 3)
+
+        self.assertFalse(self.access.customer_del(cid)['error'])
+
+    def test_replica_routing(self):
+        """testing the read-only calls go to the replica"""
+        primary = QueryCounter(model.meta.engine)
+        replica = create_engine(str(model.meta.engine.url))
+        on_replica = QueryCounter(replica)
+        model.meta.replica = replica
+        try:
+            model.meta.Session.remove()
+            with model.read_only():
+                self.assertFalse(self.access.customer_list()['error'])
+                cid = self.access.customer_add(u"Replicated")['customer_id']
+            self.assertTrue(on_replica.count)
+            self.assertTrue([x for x in on_replica.statements
+                             if x.startswith('SELECT')])
+            self.assertFalse([x for x in on_replica.statements
+                              if not x.startswith('SELECT')])
+            self.assertTrue([x for x in primary.statements
+                             if x.startswith('INSERT INTO customers')])
+
+            on_replica.reset()
+            self.access.customer_get(cid)
+            self.assertEqual(on_replica.count, 0)
+
+            # Reads go to the primary right after the user's own writes,
+            # from any of their sessions.
+            class Request(object):
+                def __init__(self, method, user_id=42):
+                    self.rpc_method = method
+                    self.vault_session = {'user_id': user_id}
+            def view(request):
+                return model._routing.read_only
+            def failing(request):
+                return vaultMsg(False, "Nope")
+            self.assertTrue(views._routed(view, Request('sflvault.search')))
+            views._routed(failing, Request('sflvault.customer_add'))
+            self.assertTrue(views._routed(view, Request('sflvault.search')))
+            self.assertFalse(views._routed(view,
+                                           Request('sflvault.customer_add')))
+            self.assertFalse(views._routed(view, Request('sflvault.search')))
+            self.assertTrue(views._routed(view,
+                                          Request('sflvault.search', 43)))
+            # The writes aren't in the session store
+            self.assertEqual(views.last_writes.keys(), [42])
+            self.assertFalse([k for k in views.vaultSessions.sessions
+                              if 'last_write' in k])
+            views.replica_lag = -1
+            self.assertTrue(views._routed(view, Request('sflvault.search')))
+
+            # Without a session, everything goes to the primary.
+            request = Request('sflvault.search')
+            del request.vault_session
+            self.assertFalse(views._routed(view, request))
+
+            # Only the sessions made by authenticate are accepted
+            views.vaultSessions.set('not-a-session', {
+                    'timeout': datetime.now() + timedelta(0, 60)})
+            self.assertRaises(views.SessionNotFoundError, views.get_session,
+                              'not-a-session', {'REMOTE_ADDR': '127.0.0.1'})
+        finally:
+            views.replica_lag = 5
+            views.last_writes.clear()
+            views.vaultSessions.delete('not-a-session')
+            model.meta.replica = None
+            model.meta.Session.remove()
+
+    def test_schema_migrations(self):
+        """testing the migrations bring an old vault to the latest version"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            def indexes(engine):
+                inspector = Inspector.from_engine(engine)
+                return set([x['name'] for t in inspector.get_table_names()
+                            for x in inspector.get_indexes(t)])
+
+            def old_vault(name):
+                """A vault created before the indexes and schema_version"""
+                old = create_engine('sqlite:///%s/%s' % (tmpdir, name))
+                model.metadata.create_all(old)
+                for t in model.metadata.sorted_tables:
+                    for index in t.indexes:
+                        if index.name in migrations.LOOKUP_INDEXES:
+                            index.drop(old)
+                model.schemaversion_table.drop(old)
+                return old
+
+            new = create_engine('sqlite:///%s/new.db' % tmpdir)
+            self.assertEqual(migrations.upgrade(new), [migrations.LATEST])
+            self.assertTrue('ix_services_machine_id' in indexes(new))
+
+            old = old_vault('old.db')
+            self.assertFalse('ix_users_username' in indexes(old))
+            self.assertEqual(migrations.upgrade(old), [1])
+            self.assertEqual(indexes(old), indexes(new))
+            self.assertEqual(migrations.version(old.connect()),
+                             migrations.LATEST)
+            self.assertEqual(migrations.upgrade(old), [])
+
+            # Another server process applies the migration while we do.
+            racing = old_vault('racing.db')
+            other = create_engine('sqlite:///%s/racing.db' % tmpdir)
+            (ver, description, migrate) = migrations.MIGRATIONS[0]
+            others = []
+            def concurrent(conn):
+                if not others:
+                    others.append(None)
+                    others.append(migrations.upgrade(other))
+                migrate(conn)
+            migrations.MIGRATIONS[0] = (ver, description, concurrent)
+            try:
+                self.assertEqual(migrations.upgrade(racing), [])
+            finally:
+                migrations.MIGRATIONS[0] = (ver, description, migrate)
+            self.assertEqual(others[1], [1])
+            self.assertEqual(indexes(racing), indexes(new))
+            self.assertEqual(migrations.version(racing.connect()),
+                             migrations.LATEST)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_metrics(self):
+        """testing the /metrics endpoint"""
+        calls = metrics.rpc_calls.get(('sflvault.customer_add',))
+        self.assertFalse(self.vault.customer_add(u"metrics")['error'])
+        self.assertEqual(metrics.rpc_calls.get(('sflvault.customer_add',)),
+                         calls + 1)
+
+        text = urllib2.urlopen('http://localhost:6555/metrics').read()
+        for line in ['# TYPE sflvault_rpc_duration_seconds histogram',
+                     'sflvault_rpc_calls_total{method="sflvault.customer_add"}',
+                     'sflvault_rpc_duration_seconds_bucket{method="sflvault.'
+                     'customer_add",le="+Inf"}',
+                     'sflvault_db_queries_total{method="sflvault.customer_add"}',
+                     'sflvault_crypto_operations_total{operation="elgamal_'
+                     'encrypt"}',
+                     'sflvault_sessions ']:
+            self.assertTrue(line in text, line)
+
+        hist = metrics.Histogram('test_seconds', 'Test', ('x',),
+                                 buckets=(0.1, 1.0))
+        hist.observe(('a',), 0.5)
+        hist.observe(('a',), 2)
+        self.assertEqual(hist.get(('a',)), (2, 2.5))
+        self.assertEqual([x[2] for x in hist.samples()], [0, 1, 2, 2.5, 2])
+
+    def test_traces(self):
+        """testing the request traces"""
+        sres = self._add_new_service()
+        self.assertFalse(sres['error'])
+
+        traces = [json.loads(line) for line in open(tracefile)]
+        trace = [t for t in traces if t['method'] == 'sflvault.service_add'][-1]
+        spans = trace['spans']
+        names = [s['name'] for s in spans]
+        for name in ['request', 'rpc.parse', 'sflvault.service_add',
+                     'rpc.marshal', 'authenticated_user', 'get_session',
+                     'SFLvaultAccess.service_add', 'sql',
+                     'crypto.encrypt_longmsg']:
+            self.assertTrue(name in names, name)
+
+        def ancestors(span):
+            while span['parent'] is not None:
+                span = spans[span['parent']]
+                yield span['name']
+        method = spans[names.index('SFLvaultAccess.service_add')]
+        self.assertEqual(list(ancestors(method)),
+                         ['sflvault.service_add', 'request'])
+        crypto = spans[names.index('crypto.encrypt_longmsg')]
+        self.assertTrue('SFLvaultAccess.service_add' in ancestors(crypto))
+        for span in spans:
+            self.assertTrue(0 <= span['duration_ms'] <= trace['duration_ms'])
+
+        res = tracing.summarize(open(tracefile))
+        self.assertEqual(res['sflvault.service_add'][0],
+                         names.count('sflvault.service_add') *
+                         len([t for t in traces
+                              if t['method'] == 'sflvault.service_add']))
+        count, total, own, top = res['request']
+        self.assertTrue(own < total)
+
+        # Only the sampled or slow requests are written.
+        tracer = tracing.Tracer(os.devnull, sample_rate=0, slow_ms=100)
+        trace = tracing.Trace()
+        trace.open('request', start=1.0)
+        trace.close(end=1.05)
+        self.assertFalse(tracer.keep(trace))
+        trace.spans[0][3] = 1.2
+        self.assertTrue(tracer.keep(trace))
+
+    def test_benchmark_generator(self):
+        """testing the generated benchmark vaults"""
+        counts = {'customers': 2, 'machines': 4, 'services': 12,
+                  'groups': 3, 'users': 2}
+        engine = model.meta.engine
+        try:
+            model.init_model(create_engine('sqlite://'))
+            migrations.upgrade(model.meta.engine)
+            gen = generator.generate(counts, seed=1)
+            access = self._access(gen.admin_id)
+            sid = [s for s in gen.services if s not in
+                   set(gen.parents.values())][0]
+            res = access.service_get_tree(sid, True)
+        finally:
+            model.meta.Session.remove()
+            model.init_model(engine)
+
+        for name in counts:
+            self.assertEqual(len(getattr(gen, name)), counts[name], name)
+        self.assertEqual(max([gen.depth(s) for s in gen.services]), 3)
+        self.assertEqual(len(gen.leaves()), 4)
+        self.assertFalse(res['error'])
+        self.assertEqual([s['id'] for s in res['services']][-1], sid)
+
+        # The admin, in every group, can decrypt the secrets.
+        service = res['services'][-1]
+        groupkey = decrypt_longmsg(gen.keys[generator.ADMIN],
+                                   service['cryptgroupkey'])
+        groupeg = ElGamal.ElGamalobj()
+        (groupeg.p, groupeg.x, groupeg.g, groupeg.y) = \
+            unserial_elgamal_privkey(groupkey)
+        symkey = decrypt_longmsg(groupeg, service['cryptsymkey'])
+        self.assertEqual(decrypt_secret(symkey, service['secret']),
+                         'secret-%d' % (gen.services.index(service['id'])))
+
+        def results(**medians):
+            return {'sizes': {'small': {'calls': dict(
+                            [(k, {'median_ms': v})
+                             for k, v in medians.items()])}}}
+        baseline = results(login=20.0, search=2.0)
+        self.assertEqual(runner.compare(results(login=29.0, search=3.9),
+                                        baseline), [])
+        self.assertEqual(runner.compare(results(login=32.0, search=2.0,
+                                                user_list=100.0), baseline),
+                         ['small, login: 32.0 ms, baseline is 20.0 ms'])
+
+    def test_load_stats(self):
+        """testing the load test's measures of the RPC calls"""
+        class Proxy(object):
+            def search(self, authtok):
+                if authtok == 'old':
+                    return {'error': True, 'message': "Permission denied "
+                            "(session expired)"}
+                return {'error': False, 'message': "Here are the results"}
+
+            def login(self, username):
+                if username == 'down':
+                    raise IOError("Connection refused")
+                return {'error': False, 'message': "Here's your token"}
+
+            def authenticate(self, username, cryptok):
+                if cryptok == 'old':
+                    return {'error': True, 'message': "Authentication failed"}
+                return {'error': False, 'message': "Welcome"}
+
+        stats = load.Stats()
+        proxy = load.TimedProxy(Proxy(), stats)
+        for x in range(3):
+            proxy.search('tok')
+        proxy.search('old')
+        self.assertRaises(IOError, proxy.login, 'down')
+        stats.step_failed('login', 'IOError: Connection refused')
+        # The probe of the previous session isn't an error, after that it is
+        proxy.login('user')
+        proxy.authenticate('user', 'old')
+        proxy.authenticate('user', 'new')
+        proxy.authenticate('user', 'old')
+
+        res = stats.report(4.5)
+        self.assertEqual(res['calls'], 9)
+        self.assertEqual(res['calls_per_second'], 2.0)
+        self.assertEqual(res['error_rate'], 3 / 9.0)
+        self.assertEqual(res['expired_rate'], 1 / 9.0)
+        self.assertEqual(res['probe_errors'], 1)
+        self.assertEqual(res['failed_steps'], {'login': 1})
+        self.assertEqual(res['methods']['search']['calls'], 4)
+        self.assertEqual(res['methods']['search']['errors'], 1)
+        self.assertEqual(res['methods']['login']['errors'], 1)
+        self.assertEqual(res['methods']['authenticate']['calls'], 3)
+        self.assertEqual(res['methods']['authenticate']['errors'], 1)
+        self.assertEqual(load.percentile([1, 2, 3, 4, 5], 0.5), 3)
+        self.assertEqual(load.percentile(range(101), 0.99), 99)
+        self.assertEqual(load.percentile([], 0.99), 0.0)
+
+    def test_request_identity(self):
+        """testing concurrent requests never see each other's identity"""
+        users = [u'stress-%d' % i for i in range(8)]
+        for i, username in enumerate(users):
+            views.vaultSessions.set('stress-tok-%d' % i, {
+                    'timeout': datetime.now() + timedelta(0, 300),
+                    'remote_addr': '127.0.0.1', 'is_admin': False,
+                    'user_id': 1000 + i, 'username': username})
+        failures = []
+
+        def work(i):
+            server = xmlrpclib.ServerProxy('http://localhost:6555/vault/rpc')
+            try:
+                for j in range(15):
+                    res = server.sflvault.customer_add('stress-tok-%d' % i,
+                                                       u'%s-%d' % (users[i], j))
+                    if res['error']:
+                        failures.append(res['message'])
+            except Exception, e:
+                failures.append(repr(e))
+        try:
+            threads = [threading.Thread(target=work, args=(i,))
+                       for i in range(len(users))]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            for i in range(len(users)):
+                views.vaultSessions.delete('stress-tok-%d' % i)
+        self.assertEqual(failures, [])
+
+        customers = model.meta.Session.query(model.Customer) \
+            .filter(model.Customer.name.like(u'stress-%')).all()
+        self.assertEqual(len(customers), 15 * len(users))
+        for c in customers:
+            self.assertEqual(c.created_user, c.name.rsplit('-', 1)[0])
+        # The shared vault is left alone.
+        self.assertEqual(views.vault.myself_id, None)
+        self.assertEqual(views.vault.myself_username, None)
+
+    def test_query_budgets(self):
+        """testing the methods stay in their query budgets as the vault grows"""
+        engine = model.meta.engine
+        try:
+            small = bench_budgets.run(100, repeat=1)
+            large = bench_budgets.run(1000, repeat=1)
+        finally:
+            model.init_model(engine)
+        self.assertEqual(bench_budgets.unbudgeted(), [])
+        self.assertEqual(bench_budgets.over_budget(small), [])
+        self.assertEqual(bench_budgets.over_budget(large), [])
+        for name in bench_budgets.BUDGETS:
+            self.assertEqual(small[name][0], large[name][0], name)
+
+    def test_search_pages(self):
+        """testing the paginated search"""
+        cid = self.vault.customer_add(u"Paged customer")['customer_id']
+        mids = [self.vault.machine_add(cid, "paged-%d" % x)['machine_id']
+                for x in range(2)]
+        sids = [self.vault.service_add(mids[x % 2], 0, 'ssh://paged%d' % x,
+                                       [], 'secret')['service_id']
+                for x in range(5)]
+
+        def services(results):
+            return [int(sid) for c in results.values()
+                    for m in c['machines'].values()
+                    for sid in m['services']]
+
+        res = self.access.search(['paged'], {'customers': [cid]})
+        self.assertEqual(sorted(services(res['results'])), sids)
+        self.assertEqual(res['next'], '')
+
+        found = []
+        token = ''
+        while True:
+            res = self.access.search(['paged'], {'customers': [cid]}, False, 2,
+                                token)
+            self.assertTrue(len(services(res['results'])) <= 2)
+            found.extend(services(res['results']))
+            token = res['next']
+            if not token:
+                break
+        self.assertEqual(sorted(found), sids)
+        self.assertTrue(self.access.search(['paged'], None, False, 2,
+                                      'junk')['error'])
+
+        pages = list(self.vault.search_pages(['paged'],
+                                             {'customers': [cid]}, limit=2))
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(sorted(sum([services(x) for x in pages], [])), sids)
+
+    def test_authtok_reuse(self):
+        """testing the client skips the login while its authtok is fresh"""
+        logins = []
+        login = self.vault.vault.login
+        def counting_login(*args):
+            logins.append(args)
+            return login(*args)
+        self.vault.vault.login = counting_login
+        try:
+            self.vault.authtok_expires = 0
+            self.vault.customer_add(u"Fresh token")
+            self.assertEqual(len(logins), 1)
+            self.assertTrue(self.vault._authtok_fresh())
+            for i in range(3):
+                self.vault.customer_add(u"Fresh token %d" % i)
+            self.assertEqual(len(logins), 1)
+
+            # The vault forgot about our session: login again and retry
+            self.vault.authtok = 'forgotten'
+            res = self.vault.customer_add(u"Lost token")
+            self.assertTrue(res['customer_id'])
+            self.assertEqual(len(logins), 2)
+            self.assertNotEqual(self.vault.authtok, 'forgotten')
+
+            # Also when it's the first page of a generator
+            self.vault.authtok = 'forgotten'
+            pages = list(self.vault.search_pages(['Lost'], limit=1))
+            self.assertTrue(pages[0])
+            self.assertEqual(len(logins), 3)
+
+            # But not when some of the requests went through
+            calls = []
+            @authenticate()
+            def two_steps(client):
+                calls.append(client)
+                vaultReply(client.vault.customer_add(client.authtok,
+                                                     u"Step 1"))
+                client.authtok = 'forgotten'
+                vaultReply(client.vault.customer_add(client.authtok,
+                                                     u"Step 2"))
+            self.assertRaises(VaultError, two_steps, self.vault)
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(len(logins), 3)
+        finally:
+            del self.vault.vault.login
+            self.vault.authtok_expires = 0
+
+    def test_jsonrpc(self):
+        """testing the JSON-RPC endpoint gives the same as XML-RPC"""
+        self.vault.customer_add(u"JSON customér")
+        self.assertEqual(self.vault.vault_protocol, 'jsonrpc')
+
+        xml = xmlrpclib.Server(self.vault.vault_url, allow_none=True).sflvault
+        stamps = []
+        for call, args in [('user_list', (True,)), ('customer_list', ())]:
+            bjson = getattr(self.vault.vault, call)(self.vault.authtok, *args)
+            bxml = getattr(xml, call)(self.vault.authtok, *args)
+            self.assertFalse(bjson['error'])
+            self.assertEqual(bjson, bxml)
+            stamps.extend([x['created_stamp'] for x in bjson['list']
+                           if 'created_stamp' in x])
+        self.assertTrue(stamps)
+        for stamp in stamps:
+            self.assertTrue(isinstance(stamp, xmlrpclib.DateTime))
+
+    def test_keepalive(self):
+        """testing the client reuses its connections to the vault"""
+        pool = ConnectionPool(size=2, idle_timeout=60)
+        vault = xmlrpclib.Server(self.vault.vault_url, allow_none=True,
+                        transport=PooledTransport(pool)).sflvault
+        for i in range(5):
+            self.assertFalse(vault.customer_list(self.vault.authtok)['error'])
+        self.assertEqual(pool.stats()['created'], 1)
+        self.assertEqual(pool.stats()['reused'], 4)
+
+        # The test server drops idle connections after a second
+        time.sleep(1.5)
+        self.assertFalse(vault.customer_list(self.vault.authtok)['error'])
+        self.assertEqual(pool.stats()['created'], 2)
+        self.assertEqual(pool.stats()['retried'], 1)
+
+        # Connections older than idle_timeout aren't even tried
+        pool.idle_timeout = 0
+        self.assertFalse(vault.customer_list(self.vault.authtok)['error'])
+        self.assertEqual(pool.stats()['created'], 3)
+        self.assertEqual(pool.stats()['retried'], 1)
+        pool.clear()
+        self.assertEqual(pool.stats()['idle'], 0)
+
+        # A reused connection failing once the request was sent isn't
+        # retried: the vault may have processed it.
+        class TimingOut(object):
+            def request(self, *args):
+                pass
+            def getresponse(self):
+                raise socket.timeout('timed out')
+            def close(self):
+                pass
+        pool._get = lambda scheme, host: (TimingOut(), True)
+        self.assertRaises(socket.timeout, pool.post, self.vault.vault_url,
+                          '', {})
+        self.assertEqual(pool.stats()['retried'], 1)
+
+    def test_search_index(self):
+        """testing the trigram index finds the same as the table scan"""
+        cres = self.vault.customer_add(u"Trigram Customér")
+        mres = self.vault.machine_add(cres['customer_id'], "trigram-box",
+                                      "trigram.example.com", '10.9.8.7',
+                                      None, None)
+        self.vault.service_add(mres['machine_id'], 0, 'ssh://root@trigram',
+                               [], 'secret')
+        self.vault.machine_add(cres['customer_id'], "lonely-box")
+
+        index = TrigramIndex()
+        index.build()
+
+        def check(words):
+            self.access.search_index = None
+            scan = self.access.search(words)['results']
+            self.access.search_index = index
+            indexed = self.access.search(words)['results']
+            self.assertEqual(scan, indexed)
+            return indexed
+
+        self.assertTrue(check(['TRIGRAM', 'root']))
+        self.assertTrue(check([u'customér', 'lonely']))
+        self.assertTrue(check(['8.7', str(mres['machine_id'])]))
+        self.assertFalse(check(['trigram', 'nowhere-to-be-found']))
+        check(['x'])
+
+        self.access.machine_put(mres['machine_id'], {'name': 'renamed-box'})
+        self.assertFalse(check(['trigram-box']))
+        self.assertTrue(check(['renamed-box', 'root']))
+
+        self.access.machine_del(mres['machine_id'])
+        self.assertFalse(check(['renamed-box']))
+
+        # Other processes' changes would be missed
+        import sflvault
+        self.assertRaises(ValueError, sflvault.main, {},
+                          **{'sqlalchemy.url': 'sqlite://',
+                             'sflvault.search_index': 'trigram',
+                             'sflvault.vault.session_store': 'sql'})
+
+    def test_session_stores(self):
+        """testing the memory, sql and file session stores"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for store in [MemorySessionStore(), SQLSessionStore(),
+                          FileSessionStore(tmpdir)]:
+                store.sweep(datetime.now() + timedelta(1))
+                now = datetime.now()
+                store.set('tok/1+=', {'user_id': 1, 'remote_addr': None,
+                                      'timeout': now + timedelta(0, 60)})
+                store.set('tok2', {'user_id': 2, 'remote_addr': '1.2.3.4',
+                                   'timeout': now - timedelta(0, 60)})
+                self.assertEqual(len(store), 2)
+                self.assertEqual(store.get('tok/1+=')['user_id'], 1)
+                self.assertTrue(store.get('tok/1+=')['timeout'] > now)
+                self.assertEqual(store.get('nope'), None)
+
+                self.assertEqual(store.sweep(), 1)
+                self.assertEqual(store.get('tok2'), None)
+
+                store.delete('tok/1+=')
+                self.assertEqual(store.get('tok/1+='), None)
+                self.assertEqual(len(store), 0)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_keypool(self):
+        """testing the pool of pre-generated keypairs"""
+        pool = KeypairPool(b64encode(randfunc(32)), 1, 2)
+        while pool.take():
+            pass
+        pool.fill()
+        self.assertEqual(len(pool), 2)
+        eg = pool.take()
+        self.assertEqual(eg.decrypt(eg.encrypt('pooled', randfunc(32))),
+                         'pooled')
+        self.assertEqual(len(pool), 1)
+        pool.take()
+        self.assertEqual(pool.take(), None)
+        stats = pool.stats()
+        self.assertEqual(stats['taken'], 2)
+        self.assertEqual(stats['generated'], 2)
+        self.assertTrue(stats['empty'] >= 1)
+        self.assertTrue(pool.wanted.is_set())
+
+        self.access.keypool = pool
+        pool.fill()
+        res = self.access.group_add(u'pooled group')
+        self.assertFalse(res['error'])
+        self.assertEqual(len(pool), 1)
+
+    def test_cryptopool(self):
+        """testing the per-group encryptions on worker processes"""
+        keys = [generate_elgamal_keypair() for x in range(4)]
+        pubkeys = [serial_elgamal_pubkey(elgamal_pubkey(eg)) for eg in keys]
+        seckey = randfunc(32)
+
+        pool = CryptoPool(2, min_jobs=1)
+        try:
+            ciphers = pool.encrypt(pubkeys, seckey)
+            challenge = pool.encrypt_challenge(pubkeys[0], seckey)
+            eg = pool.generate_keypair()
+            keypool = KeypairPool(b64encode(randfunc(32)), 1, 1,
+                                  cryptopool=pool)
+            while keypool.take():
+                pass
+            keypool.fill()
+            pooled = keypool.take()
+        finally:
+            pool.close()
+        inline = encrypt_for_pubkeys(pubkeys, seckey)
+
+        self.assertEqual(len(ciphers), 4)
+        for key, cipher, cipher2 in zip(keys, ciphers, inline):
+            self.assertEqual(cipher.count('&'), cipher2.count('&'))
+            self.assertEqual(decrypt_longmsg(key, cipher), seckey)
+        self.assertEqual(keys[0].decrypt(unserial_elgamal_msg(challenge)),
+                         seckey)
+        self.assertEqual(eg.decrypt(eg.encrypt(seckey, randfunc(32))), seckey)
+        self.assertEqual(pooled.decrypt(pooled.encrypt(seckey, randfunc(32))),
+                         seckey)
+
+    def test_cryptopool_backpressure(self):
+        """testing the crypto pool's bounded queue and job timeouts"""
+        pool = CryptoPool(1, max_pending=1, queue_timeout=0.1)
+        manager = multiprocessing.Manager()
+        # Kept here: the manager forgets the events without a reference
+        started = [manager.Event() for x in range(3)]
+        gates = [manager.Event() for x in range(3)]
+        self.access.cryptopool = pool
+        gid = self._add_new_group()['group_id']
+        sid = self._add_new_service()['service_id']
+        try:
+            # A job holds the only slot: the others are refused
+            holder = threading.Thread(target=pool.run,
+                                      args=(_gated, (started[0], gates[0])))
+            holder.start()
+            started[0].wait(10)
+            self.assertEqual(len(pool), 1)
+            self.assertRaises(CryptoPoolBusy, pool.run, int, '1')
+            self.assertRaises(CryptoPoolBusy, pool.map, int, ['1'])
+            for res in [self.access.group_add(u'busy group'),
+                        self.access.group_add_service(gid, sid, 'symkey'),
+                        self.access.group_rekey_start(gid)]:
+                self.assertTrue(res['error'])
+                self.assertTrue('busy' in res['message'])
+            gates[0].set()
+            holder.join()
+            self.assertEqual(len(pool), 0)
+
+            # A job too slow times out, and gives up its slot, as do the
+            # jobs of a map() refused half-way.
+            pool.job_timeout = 0.2
+            self.assertRaises(CryptoPoolTimeout, pool.run, _gated,
+                              (started[1], gates[1]))
+            self.assertEqual(len(pool), 0)
+            self.assertRaises(CryptoPoolBusy, pool.map, _gated,
+                              [(started[2], gates[2])] * 2)
+            self.assertEqual(len(pool), 0)
+            gates[1].set()
+            gates[2].set()
+            pool.job_timeout = 30
+            self.assertEqual(pool.run(int, '2'), 2)
+
+            self.assertRaises(CryptoPoolError, pool.run, int, 'x')
+            self.assertEqual(len(pool), 0)
+            res = self.access.group_add(u'pooled group')
+            self.assertFalse(res['error'])
+            me = model.query(model.UserGroup).filter_by(
+                group_id=res['group_id'], user_id=1).one()
+            self.assertEqual(res['cryptgroupkey'], me.cryptgroupkey)
+            self.assertFalse(self.access.group_del(res['group_id'])['error'])
+            self.assertFalse(self.access.group_add_service(gid, sid,
+                                                      'symkey')['error'])
+            self.assertFalse(self.access.group_rekey_start(gid)['error'])
+        finally:
+            for gate in gates:
+                gate.set()
+            pool.close()
+            manager.shutdown()
+
+    def test_cached_elgamal(self):
+        """testing the cache of parsed pubkeys"""
+        from sflvault.model import cached_elgamal, forget_elgamal
+        eg1 = eg2 = generate_elgamal_keypair()
+        # Test mode has only two keypairs to pick from
+        while eg2.y == eg1.y:
+            eg2 = generate_elgamal_keypair()
+        pub1 = serial_elgamal_pubkey(elgamal_pubkey(eg1))
+        pub2 = serial_elgamal_pubkey(elgamal_pubkey(eg2))
+
+        e = cached_elgamal(('user', -1), pub1)
+        self.assertEqual(elgamal_pubkey(e), elgamal_pubkey(eg1))
+        self.assertTrue(cached_elgamal(('user', -1), pub1) is e)
+        # A changed pubkey is parsed again
+        self.assertFalse(cached_elgamal(('user', -1), pub2) is e)
+        self.assertEqual(elgamal_pubkey(cached_elgamal(('user', -1), pub2)),
+                         elgamal_pubkey(eg2))
+        e = cached_elgamal(('user', -1), pub2)
+        forget_elgamal(('user', -1))
+        self.assertFalse(cached_elgamal(('user', -1), pub2) is e)
+
     def test_machine_del(self):
         """testing delete a machine from the vault"""
         cres = self.vault.customer_add(u"Testing é les autres")
@@ -39,6 +39,7 @@ import threading
 import paste.fixture
 from paste.deploy import loadapp
 from paste.httpserver import serve
+from sflvault.lib.httpserver import WSGIHandler
 from sflvault.client import SFLvaultClient
 from sflvault.lib.vault import SFLvaultAccess
 import logging
@@ -56,12 +57,15 @@ pkg_resources.require('PasteScript')
 dbfile = os.path.join(conf_dir, 'test-database.db')
 confile = os.path.join(conf_dir, 'test-config')
 userconfile = os.path.join(conf_dir, 'test-config-user')
+tracefile = os.path.join(conf_dir, 'test-traces.jsonl')
 test_file = os.path.join(conf_dir, 'test.ini')
 globs = {}
 
 def tearDown():
     """Close the SFLVault server"""
     globs['server'].server_close()
+    if os.path.exists(tracefile):
+        os.unlink(tracefile)
 
 
 def getConfFileAdmin():
@@ -78,11 +82,14 @@ def setUp():
     # Remove the test config on each run
     if os.path.exists(confile):
         os.unlink(confile)
+    if os.path.exists(tracefile):
+        os.unlink(tracefile)
     os.environ['SFLVAULT_IN_TEST'] = 'true'
     wsgiapp = loadapp('config:test.ini', relative_to=conf_dir)
     app = paste.fixture.TestApp(wsgiapp)
     server = serve(wsgiapp, 'localhost', '6555', socket_timeout=1, start_loop=False,
-        use_threadpool=True, threadpool_workers=40)
+        use_threadpool=True, threadpool_workers=20, handler=WSGIHandler,
+        protocol_version='HTTP/1.1')
     globs['server'] = server
     t = threading.Thread(target=server.serve_forever)
     t.setDaemon(True)
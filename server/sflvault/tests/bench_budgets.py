@@ -0,0 +1,405 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Query budgets of the SFLvaultAccess methods.
+
+Usage: python -m sflvault.tests.bench_budgets [services] [scales]
+
+Seeds an in-memory SQLite vault of `services` services (100 by default)
+with its machines, customers, users and groups, then runs each method of
+BUDGETS and counts the queries, the rows fetched and the wall time.  This
+is done again on vaults `scales` times larger ("10,100" by default), to
+show how each cost grows with the vault.
+
+A method fails when it sends more queries than its budget, at any size,
+or fetches more rows than its row budget, when it has one (the lists
+have none, they return rows in proportion to the vault).  Every public
+method of SFLvaultAccess needs a budget, except those of NO_QUERIES.  The
+exit status is 1 if any method failed, or has no budget.
+
+The methods deleting or changing what they're given get fresh objects
+from their SETUPS, which aren't measured.  The group keypairs all come
+from a single keypair, generated once: the budgets don't measure the key
+generation (about half a minute, outside of the tests).
+"""
+
+import sys
+import time
+import random
+import hashlib
+import itertools
+from base64 import b64encode
+
+import transaction
+from sqlalchemy import create_engine, event
+
+from sflvault import model
+from sflvault.model import meta
+from sflvault.lib import access
+from sflvault.lib.vault import SFLvaultAccess
+from sflvault.common.crypto import generate_elgamal_keypair, elgamal_pubkey
+from sflvault.common.crypto import serial_elgamal_pubkey
+from sflvault.tests import bench_search, bench_groups
+
+
+_names = itertools.count()
+
+def _new(prefix):
+    """Return a name not used yet"""
+    return u'%s-%d' % (prefix, _names.next())
+
+
+_keypair = []
+
+def keypair():
+    """Return the keypair of the seeded users and groups"""
+    if not _keypair:
+        _keypair.append(generate_elgamal_keypair())
+    return _keypair[0]
+
+
+def pubkey():
+    """Return the serialized public key of keypair()"""
+    return serial_elgamal_pubkey(elgamal_pubkey(keypair()))
+
+
+class SameKeypair(object):
+    """Stands for the vault's KeypairPool, always giving keypair()"""
+    def take(self):
+        return keypair()
+
+
+def _user(v):
+    """Add a user waiting for its setup, returns its name"""
+    name = _new(u'user')
+    v.user_add(name, False)
+    return name
+
+
+def _service(v, machine_id=1):
+    """Add a service in g#1, returns its ID"""
+    return v.service_add(machine_id, 0, 'ssh://%s' % _new(u'new'), [1],
+                         'secret', '', '')['service_id']
+
+
+def _machine(v, customer_id=None):
+    """Add a machine with a service, to a new customer by default.
+    Returns its ID."""
+    if not customer_id:
+        customer_id = v.customer_add(_new(u'customer'))['customer_id']
+    mid = v.machine_add(customer_id, _new(u'machine'), '', '', '',
+                        '')['machine_id']
+    _service(v, mid)
+    return mid
+
+
+def _customer(v):
+    """Add a customer with a machine and its service, returns its ID"""
+    cid = v.customer_add(_new(u'customer'))['customer_id']
+    _machine(v, cid)
+    return cid
+
+
+def _group(v, service_id=None, user=None):
+    """Add a group, of which I'm admin, with the service and the user if
+    given.  Returns its ID."""
+    gid = v.group_add(_new(u'group'))['group_id']
+    if service_id:
+        v.group_add_service(gid, service_id, 'symkey')
+    if user:
+        v.group_add_user(gid, user, False, b64encode('k' * 400))
+    return gid
+
+
+def _group_service(v):
+    """Add a service in g#1 and a new group.  Returns their IDs."""
+    sid = _service(v)
+    return (_group(v, sid), sid)
+
+
+def _rekeying(v):
+    """Start re-keying a new group with a new service.  Returns its ID and
+    the new symkeys for group_rekey_put()"""
+    gid = _group(v, _service(v))
+    v.group_rekey_start(gid)
+    return (gid, [[sid, hashlib.sha1(old).hexdigest(), 'new']
+                  for sid, old in v.group_rekey_next(gid)['symkeys']])
+
+
+def _rekeyed(v):
+    """Re-key all the services of a new group, but don't finish"""
+    (gid, symkeys) = _rekeying(v)
+    v.group_rekey_put(gid, symkeys)
+    return gid
+
+
+# method: (call, max queries, max rows or None).  The calls get the vault,
+# the size of the seeded vault, in services, and the arguments returned by
+# their setup, if they have one.
+BUDGETS = {
+    'customer_list': (lambda v, n: v.customer_list(), 1, None),
+    'customer_get': (lambda v, n: v.customer_get(n / 100), 1, 1),
+    'customer_put': (lambda v, n: v.customer_put(1, {'name': u'c'}), 2, 1),
+    'machine_list': (lambda v, n: v.machine_list(), 1, None),
+    'machine_list(customer)': (lambda v, n: v.machine_list(1), 1, None),
+    'machine_get': (lambda v, n: v.machine_get(n / 10), 1, 1),
+    'machine_put': (lambda v, n: v.machine_put(1, {'notes': u'm'}), 2, 1),
+    'service_list': (lambda v, n: v.service_list(), 1, None),
+    'service_list(machine)': (lambda v, n: v.service_list(1), 1, None),
+    'service_get': (lambda v, n: v.service_get(n), 2, 2),
+    'service_get(group)': (lambda v, n: v.service_get(n, 1), 2, 2),
+    # s#n is the child of s#n-1: 3 queries per level.
+    'service_get_tree': (lambda v, n: v.service_get_tree(n, True), 6, 30),
+    'show': (lambda v, n: v.show(n, True), 6, 30),
+    # 10 children of a service: a query per level of parents, the
+    # services, their access and their groups.
+    'service_get_many': (lambda v, n: v.service_get_many(range(5, n, n / 10),
+                                                         True), 5, 100),
+    'service_put': (lambda v, n: v.service_put(1, {'notes': u's'}), 2, 1),
+    'search': (lambda v, n: v.search(['alpha'], limit=20), 1, 21),
+    'search(customers)': (lambda v, n: v.search(['alpha'],
+                                                {'customers': [1]}), 2, None),
+    'user_list': (lambda v, n: v.user_list(), 1, None),
+    'user_list(groups)': (lambda v, n: v.user_list(True), 2, None),
+    'group_list': (lambda v, n: v.group_list(), 4, None),
+    'group_list(users)': (lambda v, n: v.group_list(True, True), 4, None),
+    'group_get': (lambda v, n: v.group_get(2), 2, 2),
+    # The writes, on new objects when they change them (see SETUPS).  The
+    # access index refresh reads a row per member of the groups of the
+    # services, or per service of the user's groups: they have no row
+    # budget.
+    'user_add': (lambda v, n: v.user_add(_new(u'user'), False), 2, 0),
+    'user_setup': (lambda v, n, name: v.user_setup(name, pubkey()), 2, 1),
+    'user_del': (lambda v, n, name: v.user_del(name), 7, 1),
+    'customer_add': (lambda v, n: v.customer_add(_new(u'customer')), 1, 0),
+    'customer_del': (lambda v, n, cid: v.customer_del(cid), 9, 3),
+    'machine_add': (lambda v, n: v.machine_add(1, _new(u'machine'), '', '',
+                                               '', ''), 1, 0),
+    'machine_del': (lambda v, n, mid: v.machine_del(mid), 8, 2),
+    'service_add': (lambda v, n: _service(v), 6, None),
+    'service_del': (lambda v, n, sid: v.service_del(sid), 6, 1),
+    # s#n is in two groups: a query to load and to update each.
+    'service_passwd': (lambda v, n: v.service_passwd(n, 'new'), 10, None),
+    # 10 services, in one chunk.
+    'service_passwd_bulk': (lambda v, n: v.service_passwd_bulk(
+                [[sid, 'new'] for sid in range(n - 9, n + 1)]), 8, None),
+    'service_passwd_bulk(filters)': (lambda v, n: v.service_passwd_bulk(
+                filters={'customers': [1]}, limit=10), 11, None),
+    'group_add': (lambda v, n: v.group_add(_new(u'group')), 4, 2),
+    'group_put': (lambda v, n, gid: v.group_put(gid, {'name': _new(u'g')}),
+                  3, 2),
+    'group_del': (lambda v, n, gid: v.group_del(gid), 6, 1),
+    'group_add_service': (lambda v, n, gid, sid: v.group_add_service(
+                gid, sid, 'symkey'), 6, None),
+    'group_del_service': (lambda v, n, gid, sid: v.group_del_service(gid,
+                                                                     sid),
+                          6, None),
+    'group_add_user': (lambda v, n, gid: v.group_add_user(
+                gid, 2, False, b64encode('k' * 400)), 8, None),
+    'group_del_user': (lambda v, n, gid: v.group_del_user(gid, 2), 8, None),
+    'group_rekey_start': (lambda v, n, gid: v.group_rekey_start(gid), 9, 7),
+    'group_rekey_next': (lambda v, n, gid, symkeys: v.group_rekey_next(gid),
+                         4, 4),
+    'group_rekey_put': (lambda v, n, gid, symkeys: v.group_rekey_put(
+                gid, symkeys), 8, 6),
+    'group_rekey_finish': (lambda v, n, gid: v.group_rekey_finish(gid),
+                           16, None),
+    }
+
+
+# method: setup(vault), run before each call, which gets the arguments it
+# returns.  Each gets new objects, not to change what the others measure.
+SETUPS = {
+    'user_setup': lambda v: (_user(v),),
+    'user_del': lambda v: (_user(v),),
+    'customer_del': lambda v: (_customer(v),),
+    'machine_del': lambda v: (_machine(v),),
+    'service_del': lambda v: (_service(v),),
+    'group_put': lambda v: (_group(v),),
+    'group_del': lambda v: (_group(v),),
+    'group_add_service': lambda v: (_group(v), _service(v)),
+    'group_del_service': _group_service,
+    'group_add_user': lambda v: (_group(v),),
+    'group_del_user': lambda v: (_group(v, user=2),),
+    'group_rekey_start': lambda v: (_group(v, _service(v)),),
+    'group_rekey_next': _rekeying,
+    'group_rekey_put': _rekeying,
+    'group_rekey_finish': lambda v: (_rekeyed(v),),
+    }
+
+# The public methods that don't query the vault.
+NO_QUERIES = ['as_user', 'log_e', 'log_i', 'log_w']
+
+
+def unbudgeted():
+    """Return the public methods of SFLvaultAccess without a budget"""
+    budgeted = set([name.split('(')[0] for name in BUDGETS] + NO_QUERIES)
+    return sorted([name for name in dir(SFLvaultAccess)
+                   if not name.startswith('_') and name not in budgeted and
+                   callable(getattr(SFLvaultAccess, name))])
+
+
+class Probe(object):
+    """Count the queries, the rows fetched and the time spent on an engine.
+
+    The rows are counted through the sqlite3 connections' row_factory, so
+    only on SQLite, and for the connections opened after the Probe.
+    """
+    def __init__(self, engine):
+        self.reset()
+        event.listen(engine, 'before_cursor_execute', self.executed)
+        event.listen(engine, 'connect', self.connected)
+
+    def reset(self):
+        self.queries = 0
+        self.rows = 0
+
+    def executed(self, conn, cursor, statement, *args):
+        self.queries += 1
+
+    def connected(self, dbapi_conn, record):
+        def count_row(cursor, row):
+            self.rows += 1
+            return row
+        if hasattr(dbapi_conn, 'row_factory'):
+            dbapi_conn.row_factory = count_row
+
+    def measure(self, call, repeat=3, setup=None):
+        """Run call(), with an empty identity map as a new request would,
+        and return the (queries, rows) of the first run and the best time
+        in seconds.  With a `setup`, call(*setup()) is measured instead."""
+        best = counts = None
+        for x in range(repeat):
+            args = ()
+            if setup:
+                args = setup()
+            meta.Session.remove()
+            self.reset()
+            start = time.time()
+            res = call(*args)
+            spent = time.time() - start
+            best = spent if best is None else min(best, spent)
+            counts = counts or (self.queries, self.rows)
+            if isinstance(res, dict) and res.get('error'):
+                raise AssertionError(res['message'])
+        return counts + (best,)
+
+
+def seed(services, rnd, parents=True):
+    """Fill the current (empty) vault with `services` services, on
+    services/10 machines and services/100 customers, and services/20
+    users in services/50 groups.  Every fifth service is the child of
+    the previous one, unless `parents` is False, every service is in one
+    or two groups."""
+    bench_search.populate(services, rnd)
+    groups = max(services / 50, 2)
+    bench_groups.populate(max(services / 20, 2), groups, min(groups, 5), rnd)
+    conn = meta.engine.connect()
+    for table in [model.users_table, model.groups_table]:
+        conn.execute(table.update().values(pubkey=pubkey()))
+    if parents:
+        conn.execute(model.services_table.update()\
+                         .where(model.services_table.c.id % 5 == 0)\
+                         .values(parent_service_id=
+                                 model.services_table.c.id - 1))
+    conn.execute(model.servicegroups_table.insert(),
+                 [{'service_id': i + 1, 'group_id': g,
+                   'cryptsymkey': 's' * 400}
+                  for i in range(services)
+                  for g in rnd.sample(range(1, groups + 1),
+                                      rnd.choice([1, 2]))])
+    conn.close()
+    access.rebuild()
+    transaction.commit()
+
+
+def run(services, names=None, repeat=3):
+    """Seed a new in-memory vault and measure the methods of BUDGETS, or
+    those in `names`.  Returns {method: (queries, rows, seconds)}.
+
+    This binds the model to the new vault, call init_model() again to
+    get back to another one.
+    """
+    model.init_model(create_engine('sqlite://'))
+    probe = Probe(meta.engine)
+    meta.metadata.create_all(meta.engine)
+    seed(services, random.Random(42))
+
+    vault = SFLvaultAccess()
+    vault.myself_id = 1
+    vault.myself_username = u'user-0'
+    vault.keypool = SameKeypair()
+    out = {}
+    for name in sorted(names or BUDGETS):
+        call = BUDGETS[name][0]
+        setup = SETUPS.get(name)
+        out[name] = probe.measure(
+            lambda *args: call(vault, services, *args), repeat,
+            setup and (lambda: setup(vault)))
+    meta.Session.remove()
+    return out
+
+
+def over_budget(results):
+    """Return the messages for the results going over their budget"""
+    out = []
+    for name, (queries, rows, spent) in sorted(results.items()):
+        call, max_queries, max_rows = BUDGETS[name]
+        if queries > max_queries:
+            out.append("%s: %d queries, budget is %d" % (name, queries,
+                                                         max_queries))
+        if max_rows is not None and rows > max_rows:
+            out.append("%s: %d rows, budget is %d" % (name, rows, max_rows))
+    return out
+
+
+def main(argv):
+    services = int(argv[1]) if len(argv) > 1 else 100
+    scales = [1] + [int(x) for x in (argv[2] if len(argv) > 2
+                                     else '10,100').split(',')]
+    sizes = [services * x for x in scales]
+    results = [run(n) for n in sizes]
+
+    print "%-30s" % 'method' + ''.join(["%22s" % ('%d services' % n)
+                                        for n in sizes])
+    # growth: the time on the largest vault over the time on the smallest.
+    print "%-30s" % '' + "%22s" % 'queries rows ms' * len(sizes) \
+        + "   growth"
+    for name in sorted(BUDGETS):
+        cols = [res[name] for res in results]
+        growth = cols[-1][2] / max(cols[0][2], 1e-6)
+        print "%-30s" % name + ''.join(["%8d %6d %6.1f" % (q, r, s * 1000)
+                                        for q, r, s in cols]) \
+            + "   x%.0f" % growth
+
+    failed = []
+    for n, res in zip(sizes, results):
+        failed.extend(["%d services, %s" % (n, x) for x in over_budget(res)])
+    for msg in failed:
+        print "OVER BUDGET: %s" % msg
+    for name in unbudgeted():
+        failed.append(name)
+        print "NO BUDGET: %s" % name
+    return failed and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,71 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compare the inline and the process pool per-group encryptions.
+
+Usage: python -m sflvault.tests.bench_crypto [workers]
+
+Times the encryption of a service's symmetric key for 1 to 50 groups, as
+service_add() and service_passwd() do, with and without a CryptoPool of
+`workers` processes (the number of CPUs by default).  Set SFLVAULT_IN_TEST
+in the environment to skip the generation of the group keypairs.
+"""
+
+import sys
+import time
+import multiprocessing
+
+from sflvault.common.crypto import *
+from sflvault.lib.cryptopool import CryptoPool, encrypt_for_pubkeys
+
+
+GROUPS = [1, 2, 5, 10, 20, 50]
+
+
+def timeit(func, repeat=3):
+    best = None
+    for x in range(repeat):
+        start = time.time()
+        func()
+        spent = time.time() - start
+        best = spent if best is None else min(best, spent)
+    return best
+
+
+def main(argv):
+    workers = int(argv[1]) if len(argv) > 1 else multiprocessing.cpu_count()
+    pubkeys = [serial_elgamal_pubkey(elgamal_pubkey(generate_elgamal_keypair()))
+               for x in range(max(GROUPS))]
+    seckey = randfunc(32)
+    pool = CryptoPool(workers, min_jobs=1)
+
+    print "%d workers" % workers
+    print "%-8s %12s %12s" % ('groups', 'inline (ms)', 'pool (ms)')
+    for count in GROUPS:
+        keys = pubkeys[:count]
+        inline = timeit(lambda: encrypt_for_pubkeys(keys, seckey))
+        pooled = timeit(lambda: pool.encrypt(keys, seckey))
+        print "%-8d %12.1f %12.1f" % (count, inline * 1000, pooled * 1000)
+    pool.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,141 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Count the queries and time user_list and group_list.
+
+Usage: python -m sflvault.tests.bench_groups [users] [groups] [groups/user]
+
+Fills an in-memory SQLite vault with users and groups (500 users, 200
+groups, each user in 20 groups by default), and compares user_list(True)
+and group_list() with the ORM loops they used before, which lazy-loaded
+each membership.
+"""
+
+import sys
+import random
+from base64 import b64encode
+from datetime import datetime
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import eagerload_all
+
+from sflvault import model
+from sflvault.model import meta, query, User, Group
+from sflvault.lib.vault import SFLvaultAccess
+from sflvault.tests.bench_search import timeit
+
+
+class QueryCounter(object):
+    """Count, and keep, the statements sent to the database"""
+    def __init__(self, engine):
+        self.reset()
+        event.listen(engine, 'before_cursor_execute', self.executed)
+
+    def reset(self):
+        self.count = 0
+        self.statements = []
+
+    def executed(self, conn, cursor, statement, *args):
+        self.count += 1
+        self.statements.append(statement)
+
+
+def populate(users, groups, per_user, rnd):
+    conn = meta.engine.connect()
+    conn.execute(model.groups_table.insert(),
+                 [{'id': i + 1, 'name': u'group-%d' % i,
+                   'hidden': i % 10 == 0}
+                  for i in range(groups)])
+    conn.execute(model.users_table.insert(),
+                 [{'id': i + 1, 'username': u'user-%d' % i,
+                   'created_time': datetime.now(), 'is_admin': i == 0}
+                  for i in range(users)])
+    conn.execute(model.usergroups_table.insert(),
+                 [{'user_id': i + 1, 'group_id': g,
+                   'is_admin': rnd.random() < 0.1,
+                   'cryptgroupkey': b64encode('k' * 400)}
+                  for i in range(users)
+                  for g in rnd.sample(range(1, groups + 1), per_user)])
+    conn.close()
+
+
+def orm_user_list():
+    """user_list(True), as it was"""
+    out = []
+    for x in query(User).all():
+        out.append({'id': x.id, 'username': x.username,
+                    'groups': [{'is_admin': ug.is_admin,
+                                'name': ug.group.name,
+                                'id': ug.group_id}
+                               for ug in x.groups_assoc]})
+    return out
+
+
+def orm_group_list(myself_id):
+    """group_list(), as it was"""
+    groups = query(Group).options(eagerload_all('users_assoc.user')).all()
+    me = query(User).get(myself_id)
+    out = []
+    for grp in groups:
+        myug = [ug for ug in grp.users_assoc if ug.user_id == me.id]
+        res = {'id': grp.id, 'name': grp.name, 'member': me in grp.users}
+        if myug:
+            res['cryptgroupkey'] = myug[0].cryptgroupkey
+        res['members'] = [(u.user_id, u.user.username, u.is_admin)
+                          for u in grp.users_assoc]
+        out.append(res)
+    return out
+
+
+def main(argv):
+    users = int(argv[1]) if len(argv) > 1 else 500
+    groups = int(argv[2]) if len(argv) > 2 else 200
+    per_user = int(argv[3]) if len(argv) > 3 else 20
+    model.init_model(create_engine('sqlite://'))
+    meta.metadata.create_all(meta.engine)
+    populate(users, groups, per_user, random.Random(42))
+    counter = QueryCounter(meta.engine)
+
+    vault = SFLvaultAccess()
+    vault.myself_id = 1
+    calls = [('user_list', 'orm', orm_user_list),
+             ('user_list', 'set-based', lambda: vault.user_list(True)),
+             ('group_list', 'orm', lambda: orm_group_list(1)),
+             ('group_list', 'set-based', lambda: vault.group_list())]
+
+    print "%d users, %d groups, %d groups per user" % (users, groups,
+                                                       per_user)
+    print "%-12s %-10s %8s %10s" % ('call', 'version', 'queries', 'time (ms)')
+    for name, version, call in calls:
+        def run():
+            # Start with an empty identity map, as a new request would.
+            meta.Session.remove()
+            return call()
+        counter.reset()
+        run()
+        queries = counter.count
+        spent, res = timeit(run)
+        print "%-12s %-10s %8d %10.1f" % (name, version, queries,
+                                          spent * 1000)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
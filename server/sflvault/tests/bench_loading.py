@@ -0,0 +1,94 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Check what the customer and machine calls load, on a large vault.
+
+Usage: python -m sflvault.tests.bench_loading [number of services]
+
+Fills an in-memory SQLite vault like bench_search (50k services by
+default), then counts the queries and the rows of each table loaded by
+customer_list, customer_get, machine_get and a 'tree' load of one
+customer.  Fails if the lists load anything else than their own table.
+"""
+
+import sys
+import random
+
+from sqlalchemy import create_engine, event
+
+from sflvault import model
+from sflvault.model import meta
+from sflvault.lib.vault import SFLvaultAccess
+from sflvault.tests.bench_search import populate, timeit
+from sflvault.tests.bench_groups import QueryCounter
+
+
+class LoadCounter(object):
+    """Count the objects loaded by the ORM, per class"""
+    def __init__(self, *classes):
+        self.reset()
+        for cls in classes:
+            event.listen(cls, 'load', self.loaded)
+
+    def reset(self):
+        self.loads = {}
+
+    def loaded(self, target, context):
+        name = type(target).__name__
+        self.loads[name] = self.loads.get(name, 0) + 1
+
+
+def main(argv):
+    services = int(argv[1]) if len(argv) > 1 else 50000
+    model.init_model(create_engine('sqlite://'))
+    meta.metadata.create_all(meta.engine)
+    populate(services, random.Random(42))
+    queries = QueryCounter(meta.engine)
+    loads = LoadCounter(model.Customer, model.Machine, model.Service)
+
+    vault = SFLvaultAccess()
+    calls = [('customer_list', vault.customer_list, ['Customer']),
+             ('customer_get', lambda: vault.customer_get(1), ['Customer']),
+             ('machine_get', lambda: vault.machine_get(1), ['Machine']),
+             ('customer tree',
+              lambda: model.query(model.Customer, 'tree').get(1), None)]
+
+    print "Vault of %d services" % services
+    print "%-14s %8s %10s  %s" % ('call', 'queries', 'time (ms)', 'loaded')
+    for name, call, expected in calls:
+        def run():
+            meta.Session.remove()
+            return call()
+        queries.reset()
+        loads.reset()
+        run()
+        count, loaded = queries.count, dict(loads.loads)
+        spent, res = timeit(run)
+        print "%-14s %8d %10.1f  %s" % (name, count, spent * 1000,
+                                        ', '.join(['%s: %d' % x for x in
+                                                   sorted(loaded.items())]))
+        if expected is not None:
+            assert count == 1, "%s: %d queries" % (name, count)
+            assert sorted(loaded) == expected, "%s loaded %s" % (name, loaded)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,134 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure the overhead of the metrics collection.
+
+Usage: python -m sflvault.tests.bench_metrics [number of calls]
+
+Seeds a temporary SQLite vault like bench_budgets (1000 services), and
+times XML-RPC requests for the cheapest vault calls, through the
+server's WSGI application.  Timing them again without the metrics is
+lost in the noise, so this times what the metrics add instead: the
+metrics.rpc_call wrapper around a view that does nothing, and the engine
+events of metrics.watch_engine() for one statement.  The overhead of a
+request is then the wrapper plus the events of each of its statements.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import xmlrpclib
+from datetime import datetime, timedelta
+
+import paste.fixture
+from sqlalchemy import create_engine
+
+import sflvault
+from sflvault import model
+from sflvault.model import meta
+from sflvault.lib import metrics
+from sflvault.tests.bench_budgets import seed
+
+
+def run(calls, func):
+    """Return the best time of func(), in seconds"""
+    best = None
+    for x in range(3):
+        start = time.time()
+        for i in range(calls):
+            func()
+        spent = (time.time() - start) / calls
+        best = spent if best is None else min(best, spent)
+    return best
+
+
+def main(argv):
+    calls = int(argv[1]) if len(argv) > 1 else 200
+    tmpdir = tempfile.mkdtemp()
+    try:
+        url = 'sqlite:///%s' % os.path.join(tmpdir, 'vault.db')
+        model.init_model(create_engine(url))
+        meta.metadata.create_all(meta.engine)
+        seed(1000, random.Random(42))
+        app = paste.fixture.TestApp(sflvault.main(
+                {}, **{'sqlalchemy.url': url,
+                       'sflvault.vault.session_timeout': '3600',
+                       'sflvault.metrics': 'true'}))
+        bench(app, calls)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench(app, calls):
+    from sflvault import views
+    views.vaultSessions.set('bench', {
+            'timeout': datetime.now() + timedelta(0, 3600),
+            'remote_addr': '127.0.0.1', 'is_admin': True, 'user_id': 1,
+            'username': u'user-0'})
+    requests = [('customer_get', (1,)),
+                ('machine_get', (1,)),
+                ('machine_list', (1,)),
+                ('group_get', (2,)),
+                ('search', (['alpha'], None, False, None, 20))]
+
+    class Request(object):
+        rpc_method = 'sflvault.bench'
+    noop = metrics.rpc_call(lambda request: None)
+    wrapper = run(calls * 500, lambda: noop(Request())) \
+        - run(calls * 500, lambda: Request())
+    engine = create_engine('sqlite://')
+    metrics.watch_engine(engine)
+    metrics._current.db = [0, 0.0]
+    statement = run(calls * 500, lambda: (
+            engine.dispatch.before_cursor_execute(None, None, '', (), None,
+                                                  False),
+            engine.dispatch.after_cursor_execute(None, None, '', (), None,
+                                                 False)))
+    metrics._current.db = None
+
+    print "rpc_call: %.1f us, per statement: %.1f us" % (wrapper * 1e6,
+                                                         statement * 1e6)
+    print "%-14s %8s %10s %14s %10s" % ('request', 'queries', 'time (us)',
+                                        'overhead (us)', 'overhead')
+    for method, args in requests:
+        method = 'sflvault.' + method
+        body = xmlrpclib.dumps(('bench',) + args, method, allow_none=True)
+        def post():
+            res = app.post('/vault/rpc', body,
+                           headers={'Content-Type': 'text/xml'},
+                           extra_environ={'REMOTE_ADDR': '127.0.0.1'})
+            assert not xmlrpclib.loads(res.body)[0][0]['error'], res.body
+        queries = metrics.db_queries.get((method,))
+        post()
+        queries = metrics.db_queries.get((method,)) - queries
+        spent = run(calls, post)
+        overhead = wrapper + queries * statement
+        print "%-14s %8d %10.1f %14.1f %9.2f%%" % (method[9:], queries,
+                                                   spent * 1e6,
+                                                   overhead * 1e6,
+                                                   overhead / spent * 100)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,102 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time login, search and machine_del before and after the migrations.
+
+Usage: python -m sflvault.tests.bench_migrations [number of services]
+
+Fills an in-memory SQLite vault as bench_budgets does (50k services by
+default), without the indexes the migrations add, as on a vault created
+before them.  Then times the sflvault.login view, a few searches and
+machine_del, applies the migrations and times them again.  The login
+includes the encryption of its challenge, which doesn't change.
+"""
+
+import sys
+import random
+
+from sqlalchemy import create_engine
+
+from sflvault import model
+from sflvault import views
+from sflvault.model import meta
+from sflvault.lib import migrations
+from sflvault.lib.vault import SFLvaultAccess
+from sflvault.tests.bench_search import timeit
+from sflvault.tests.bench_budgets import seed
+
+
+def drop_indexes():
+    """Drop the indexes created by the migrations, and forget them"""
+    for table in model.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in migrations.LOOKUP_INDEXES:
+                index.drop(meta.engine)
+    meta.engine.execute(model.schemaversion_table.delete())
+
+
+def main(argv):
+    services = int(argv[1]) if len(argv) > 1 else 50000
+    model.init_model(create_engine('sqlite://'))
+    migrations.upgrade(meta.engine)
+    drop_indexes()
+    seed(services, random.Random(42), parents=False)
+    users = max(services / 20, 2)
+    machines = max(services / 10, 1)
+
+    vault = SFLvaultAccess()
+    vault.myself_id = 1
+    deleted = iter(range(1, machines + 1))
+
+    class Request(object):
+        rpc_method = 'sflvault.login'
+
+    def login():
+        meta.Session.remove()
+        for x in range(0, users, max(users / 50, 1)):
+            res = views.sflvault_login(Request(), u'user-%d' % x,
+                                       views.MINIMAL_CLIENT_VERSION.vstring)
+            assert not res['error'], res['message']
+
+    def machine_del():
+        res = vault.machine_del(deleted.next())
+        assert not res['error'], res['message']
+
+    calls = [('login (50 users)', login),
+             ('search', lambda: vault.search(['alpha'])),
+             ('search (machines)',
+              lambda: vault.search(['alpha'], {'machines': [machines / 2]})),
+             ('search (customers)',
+              lambda: vault.search(['sierra'], {'customers': [1, 2, 3]})),
+             ('machine_del', machine_del)]
+
+    print "Vault of %d services" % services
+    before = [timeit(call)[0] for name, call in calls]
+    applied = migrations.upgrade(meta.engine)
+    after = [timeit(call)[0] for name, call in calls]
+    print "Migrations applied: %s" % applied
+    print "%-20s %12s %12s" % ('call', 'before (ms)', 'after (ms)')
+    for (name, call), b, a in zip(calls, before, after):
+        print "%-20s %12.1f %12.1f" % (name, b * 1000, a * 1000)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
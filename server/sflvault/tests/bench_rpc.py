@@ -0,0 +1,105 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compare the XML-RPC and JSON-RPC encodings of large responses.
+
+Usage: python -m sflvault.tests.bench_rpc [number of services]
+
+Fills an in-memory SQLite vault like bench_search (10k services by
+default, with ciphertexts), then times the encoding and decoding, and
+measures the size, of the search, service_list and user_list responses
+with both protocols.
+"""
+
+import sys
+import json
+import time
+import random
+import xmlrpclib
+from base64 import b64encode
+from datetime import datetime
+
+from sqlalchemy import create_engine
+
+from sflvault import model
+from sflvault.model import meta
+from sflvault.lib.vault import SFLvaultAccess
+from sflvault.lib.jsonrpc import dumps
+from sflvault.tests.bench_search import populate, timeit
+
+
+def add_secrets_and_users(services, rnd):
+    conn = meta.engine.connect()
+    conn.execute(model.services_table.update().values(
+        secret=b64encode('x' * 96),
+        secret_last_modified=datetime.now()))
+    groups = max(services / 1000, 1)
+    conn.execute(model.groups_table.insert(),
+                 [{'id': i + 1, 'name': u'group-%d' % i} for i in range(groups)])
+    users = max(services / 100, 1)
+    conn.execute(model.users_table.insert(),
+                 [{'id': i + 1, 'username': u'user-%d' % i,
+                   'created_time': datetime.now(), 'is_admin': False}
+                  for i in range(users)])
+    conn.execute(model.usergroups_table.insert(),
+                 [{'user_id': i + 1, 'group_id': rnd.randint(1, groups),
+                   'cryptgroupkey': b64encode('k' * 400)}
+                  for i in range(users)])
+    conn.close()
+
+
+def main(argv):
+    services = int(argv[1]) if len(argv) > 1 else 10000
+    model.init_model(create_engine('sqlite://'))
+    meta.metadata.create_all(meta.engine)
+    rnd = random.Random(42)
+    populate(services, rnd)
+    add_secrets_and_users(services, rnd)
+
+    vault = SFLvaultAccess()
+    calls = [('search', lambda: vault.search([u'.'])),
+             ('service_list', lambda: vault.service_list()),
+             ('user_list', lambda: vault.user_list(True))]
+
+    print "Vault of %d services" % services
+    print "%-14s %-8s %10s %12s %12s" % ('call', 'format', 'size (kB)',
+                                         'encode (ms)', 'decode (ms)')
+    for name, call in calls:
+        result = call()
+        encode, xml = timeit(lambda: xmlrpclib.dumps((result,),
+                                                     methodresponse=True,
+                                                     allow_none=True))
+        decode, res = timeit(lambda: xmlrpclib.loads(xml))
+        print "%-14s %-8s %10.1f %12.1f %12.1f" % (name, 'xmlrpc',
+                                                   len(xml) / 1024.,
+                                                   encode * 1000,
+                                                   decode * 1000)
+        encode, js = timeit(lambda: dumps({'jsonrpc': '2.0', 'id': 1,
+                                           'result': result}))
+        decode, res = timeit(lambda: json.loads(js))
+        print "%-14s %-8s %10.1f %12.1f %12.1f" % (name, 'jsonrpc',
+                                                   len(js) / 1024.,
+                                                   encode * 1000,
+                                                   decode * 1000)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,107 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compare the table scan and the trigram index search paths.
+
+Usage: python -m sflvault.tests.bench_search [number of services]
+
+Fills an in-memory SQLite vault with synthetic customers, machines and
+services (100k services by default) and times the same searches with
+both methods.
+"""
+
+import sys
+import time
+import random
+
+from sqlalchemy import create_engine
+
+from sflvault import model
+from sflvault.model import meta
+from sflvault.lib.search import TrigramIndex
+
+
+WORDS = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf',
+         'hotel', 'india', 'juliet', 'kilo', 'lima', 'mike', 'november',
+         'oscar', 'papa', 'quebec', 'romeo', 'sierra', 'tango', 'uniform',
+         'victor', 'whiskey', 'xray', 'yankee', 'zulu']
+
+QUERIES = [['alpha'], ['zulu-42'], ['sierra', 'tango'], ['web7.example'],
+           ['nomatch-at-all'], ['10.0.3']]
+
+
+def populate(services, rnd):
+    """Insert `services` services, on services/10 machines and
+    services/100 customers"""
+    machines = max(services / 10, 1)
+    customers = max(services / 100, 1)
+    conn = meta.engine.connect()
+    conn.execute(model.customers_table.insert(),
+                 [{'id': i + 1, 'name': u'%s-%d' % (rnd.choice(WORDS), i)}
+                  for i in range(customers)])
+    conn.execute(model.machines_table.insert(),
+                 [{'id': i + 1, 'customer_id': i % customers + 1,
+                   'name': u'%s-%d' % (rnd.choice(WORDS), i),
+                   'fqdn': u'web%d.example.com' % i,
+                   'ip': '10.0.%d.%d' % (i / 256 % 256, i % 256),
+                   'location': u'', 'notes': u''}
+                  for i in range(machines)])
+    conn.execute(model.services_table.insert(),
+                 [{'id': i + 1, 'machine_id': i % machines + 1,
+                   'url': 'ssh://%s@%s-%d' % (rnd.choice(WORDS),
+                                              rnd.choice(WORDS), i),
+                   'notes': ' '.join(rnd.sample(WORDS, 3))}
+                  for i in range(services)])
+    conn.close()
+
+
+def timeit(func, repeat=3):
+    best = None
+    for x in range(repeat):
+        start = time.time()
+        res = func()
+        spent = time.time() - start
+        best = spent if best is None else min(best, spent)
+    return best, res
+
+
+def main(argv):
+    services = int(argv[1]) if len(argv) > 1 else 100000
+    model.init_model(create_engine('sqlite://'))
+    meta.metadata.create_all(meta.engine)
+    populate(services, random.Random(42))
+
+    index = TrigramIndex()
+    spent, res = timeit(index.build, 1)
+    print "Vault of %d services, index built in %.2fs" % (services, spent)
+    print "%-20s %8s %12s %12s" % ('query', 'rows', 'scan (ms)',
+                                   'index (ms)')
+    for words in QUERIES:
+        scan, rows = timeit(lambda: list(model.search_query(words)))
+        indexed, rows2 = timeit(lambda: list(model.search_query(words,
+                                                                index=index)))
+        assert len(rows) == len(rows2)
+        print "%-20s %8d %12.1f %12.1f" % (' '.join(words), len(rows),
+                                           scan * 1000, indexed * 1000)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
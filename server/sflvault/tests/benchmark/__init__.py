@@ -0,0 +1,32 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""End-to-end benchmarks of the vault, on generated vaults.
+
+generator -- builds a vault of a given size through SFLvaultAccess, with
+             the test-mode keypairs, from a seed.
+runner    -- times the RPC calls on generated vaults of several sizes,
+             through the server's WSGI application, writes the results
+             as JSON and compares them with a baseline (baseline.json).
+
+Usage: python -m sflvault.tests.benchmark.runner --help
+"""
@@ -0,0 +1,200 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Deterministic generator of large vaults.
+
+generate() fills an empty vault through SFLvaultAccess, as the clients
+would: users set up with their pubkey, groups whose keys are given to
+their members, services encrypted for their groups.  The keypairs are
+the test-mode ones of generate_elgamal_keypair() (SFLVAULT_IN_TEST), so
+that building a vault doesn't wait for the key generation.
+
+For a given seed, the vault is the same on each run (names, groups,
+parents and ids), only the ciphertexts differ.
+"""
+
+import os
+import sys
+import random
+from contextlib import contextmanager
+
+from sflvault.common.crypto import *
+from sflvault.lib.vault import SFLvaultAccess
+from sflvault.tests.bench_search import WORDS
+
+
+__all__ = ['SIZES', 'GeneratedVault', 'generate', 'quiet']
+
+
+# Number of each object, by size
+SIZES = {
+    'small': {'customers': 10, 'machines': 50, 'services': 250,
+              'groups': 5, 'users': 10},
+    'medium': {'customers': 50, 'machines': 250, 'services': 1250,
+               'groups': 20, 'users': 50},
+    'large': {'customers': 200, 'machines': 1000, 'services': 5000,
+              'groups': 50, 'users': 200},
+    }
+
+ADMIN = u'bench-admin'
+
+
+@contextmanager
+def quiet():
+    """Send stdout to /dev/null in the block: the test-mode keypairs and
+    main() print on each call"""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+class GeneratedVault(object):
+    """What generate() created.
+
+    keys          -- ElGamal keypair of each user, by username
+    admin_id      -- id of the ADMIN user
+    customers, machines, services, groups, users -- ids, in creation order
+    machine_customer, service_machine, parents -- customer of each
+                     machine, machine and parent (or None) of each service
+    """
+    def __init__(self):
+        self.keys = {}
+        self.admin_id = None
+        self.customers = []
+        self.machines = []
+        self.services = []
+        self.groups = []
+        self.users = []
+        self.machine_customer = {}
+        self.service_machine = {}
+        self.parents = {}
+
+    def depth(self, service_id):
+        depth = 1
+        while self.parents[service_id]:
+            service_id = self.parents[service_id]
+            depth += 1
+        return depth
+
+    def leaves(self):
+        """The services without children"""
+        parents = set(self.parents.values())
+        return [s for s in self.services if s not in parents]
+
+
+def _check(res):
+    if res['error']:
+        raise AssertionError(res['message'])
+    return res
+
+
+def _add_user(vault, out, username, is_admin):
+    uid = _check(vault.user_add(username, is_admin))['user_id']
+    eg = generate_elgamal_keypair()
+    _check(vault.user_setup(username,
+                            serial_elgamal_pubkey(elgamal_pubkey(eg))))
+    out.keys[username] = eg
+    return uid
+
+
+def generate(counts, seed=0):
+    """Fill the current (empty) vault with counts['customers'] customers,
+    counts['machines'] machines, counts['services'] services,
+    counts['groups'] groups and counts['users'] users, plus the admin
+    user (ADMIN) who is in every group.
+
+    Machines go round-robin to the customers, services to the machines.
+    On each machine, services come in chains of three (the second is the
+    child of the first, the third of the second), and each service is in
+    one or two groups.  Each user is in one to three groups.
+    """
+    rnd = random.Random(seed)
+    # generate_elgamal_keypair() picks a test keypair with `random`.
+    random.seed(seed)
+    in_test = os.environ.get('SFLVAULT_IN_TEST')
+    os.environ['SFLVAULT_IN_TEST'] = 'true'
+    out = GeneratedVault()
+    vault = SFLvaultAccess()
+    try:
+        with quiet():
+            vault.myself_id = out.admin_id = _add_user(vault, out, ADMIN,
+                                                       True)
+            vault.myself_username = ADMIN
+            admin = out.keys[ADMIN]
+
+            groupkeys = {}
+            for i in range(counts['groups']):
+                res = _check(vault.group_add(u'group-%d' % i))
+                out.groups.append(res['group_id'])
+                groupkeys[res['group_id']] = decrypt_longmsg(
+                    admin, res['cryptgroupkey'])
+
+            for i in range(counts['users']):
+                username = u'user-%d' % i
+                uid = _add_user(vault, out, username, False)
+                out.users.append(uid)
+                eg = out.keys[username]
+                for gid in rnd.sample(out.groups,
+                                      min(rnd.randint(1, 3), len(out.groups))):
+                    _check(vault.group_add_user(
+                            gid, uid, False,
+                            encrypt_longmsg(eg, groupkeys[gid])))
+
+            for i in range(counts['customers']):
+                res = _check(vault.customer_add(u'%s-%d' % (rnd.choice(WORDS),
+                                                            i)))
+                out.customers.append(res['customer_id'])
+
+            for i in range(counts['machines']):
+                cid = out.customers[i % len(out.customers)]
+                res = _check(vault.machine_add(
+                        cid, u'%s-%d' % (rnd.choice(WORDS), i),
+                        u'web%d.example.com' % i,
+                        '10.0.%d.%d' % (i / 256 % 256, i % 256), u'', u''))
+                out.machines.append(res['machine_id'])
+                out.machine_customer[res['machine_id']] = cid
+
+            last = {}
+            for i in range(counts['services']):
+                mid = out.machines[i % len(out.machines)]
+                parent = None
+                if i / len(out.machines) % 3:
+                    parent = last[mid]
+                res = _check(vault.service_add(
+                        mid, parent or 0,
+                        'ssh://%s@%s-%d' % (rnd.choice(WORDS),
+                                            rnd.choice(WORDS), i),
+                        rnd.sample(out.groups, min(rnd.randint(1, 2),
+                                                   len(out.groups))),
+                        'secret-%d' % i, ' '.join(rnd.sample(WORDS, 3)), {}))
+                sid = last[mid] = res['service_id']
+                out.services.append(sid)
+                out.service_machine[sid] = mid
+                out.parents[sid] = parent
+    finally:
+        if in_test is None:
+            del os.environ['SFLVAULT_IN_TEST']
+    return out
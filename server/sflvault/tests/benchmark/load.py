@@ -0,0 +1,385 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Load test: many operators working on the vault at the same time.
+
+Usage: python -m sflvault.tests.benchmark.load [options]
+
+Generates a vault (see generator), in a temporary SQLite database or in
+an empty database given with --db (e.g. a local PostgreSQL), and serves
+it with sflvault.main() and the paste HTTP server in a child process.
+
+Then, for each level of concurrency (--users 1,5,10,20), as many
+SFLvaultClient objects as users, each in its thread, run their SCRIPTS
+(--script) in a loop for --duration seconds.  The default script is an
+operator's: log in, search, show two services, change a password.  The
+clients keep their private key, as in the `sflvault shell`, and log in
+again at the start of each loop.
+
+For each level, this reports the throughput, the p50/p95/p99 latency of
+each RPC method, as seen by the clients, and the rates of errors and of
+expired sessions (set a short --session-timeout to see them).  On
+each login, the client first tries its previous session, which the vault
+refuses unless its session_trust is enabled: these refused probes are
+counted apart (probe_errors), not as errors.  The clients share the
+harness' process:
+with many users, check that it isn't the one running out of CPU.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import tempfile
+import threading
+import multiprocessing
+from datetime import datetime
+from optparse import OptionParser
+
+from sqlalchemy import create_engine
+from paste.httpserver import serve
+from Crypto import Random
+
+import sflvault
+from sflvault import model
+from sflvault.model import meta
+from sflvault.common.crypto import *
+from sflvault.lib import migrations
+from sflvault.lib.httpserver import WSGIHandler
+from sflvault.client.client import SFLvaultClient
+from sflvault.tests.bench_search import WORDS
+from sflvault.tests.benchmark.generator import SIZES, ADMIN, generate, quiet
+
+
+__all__ = ['SCRIPTS', 'Stats', 'TimedProxy', 'LoadClient', 'run', 'main']
+
+
+# The steps of the simulated users, run in a loop
+SCRIPTS = {
+    'operator': ['login', 'search', 'show', 'show', 'passwd'],
+    'read': ['login', 'search', 'show', 'show', 'show'],
+    'write': ['login', 'search', 'passwd', 'passwd'],
+    }
+
+PASSPHRASE = 'load-test'
+
+
+def percentile(values, q):
+    """Return the `q` (0 to 1) percentile of the sorted `values`"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+class Stats(object):
+    """The RPC calls made by the clients, and the failed steps"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = {}
+        self.errors = {}
+        self.expired = 0
+        # The refused authenticate calls trying the previous session
+        self.probe_errors = 0
+        self.failed = {}
+        # The last exception of each failed step
+        self.reasons = {}
+        self.loops = 0
+
+    def record(self, method, seconds, error=False, expired=False,
+               probe=False):
+        with self.lock:
+            self.times.setdefault(method, []).append(seconds)
+            if error and probe:
+                self.probe_errors += 1
+            elif error:
+                self.errors[method] = self.errors.get(method, 0) + 1
+            if expired:
+                self.expired += 1
+
+    def step_failed(self, step, reason):
+        with self.lock:
+            self.failed[step] = self.failed.get(step, 0) + 1
+            self.reasons[step] = reason
+
+    def report(self, duration):
+        """Return the results as a dict, for JSON"""
+        calls = sum([len(x) for x in self.times.values()])
+        methods = {}
+        for method, times in self.times.items():
+            times = sorted(times)
+            methods[method] = {'calls': len(times),
+                               'errors': self.errors.get(method, 0),
+                               'p50_ms': percentile(times, 0.5) * 1000,
+                               'p95_ms': percentile(times, 0.95) * 1000,
+                               'p99_ms': percentile(times, 0.99) * 1000}
+        return {'calls': calls,
+                'calls_per_second': calls / duration,
+                'loops_per_second': self.loops / duration,
+                'error_rate': float(sum(self.errors.values())) /
+                              max(calls, 1),
+                'expired_rate': float(self.expired) / max(calls, 1),
+                'probe_errors': self.probe_errors,
+                'failed_steps': self.failed,
+                'failed_reasons': self.reasons,
+                'methods': methods}
+
+
+class TimedProxy(object):
+    """Wrap the client's server proxy, to time each RPC call.
+
+    The authenticate call right after a login is the client's probe of
+    its previous session."""
+    def __init__(self, proxy, stats):
+        self._proxy = proxy
+        self._stats = stats
+        self.after_login = False
+
+    def __getattr__(self, name):
+        method = getattr(self._proxy, name)
+
+        def call(*args):
+            probe = name == 'authenticate' and self.after_login
+            self.after_login = name == 'login'
+            start = time.time()
+            try:
+                ret = method(*args)
+            except Exception:
+                self._stats.record(name, time.time() - start, error=True)
+                raise
+            error = isinstance(ret, dict) and ret.get('error')
+            self._stats.record(name, time.time() - start, bool(error),
+                               bool(error) and 'Permission denied (session'
+                               in ret.get('message', ''), probe)
+            return ret
+        return call
+
+
+class LoadClient(SFLvaultClient):
+    """SFLvaultClient timing its calls to the vault"""
+    def __init__(self, config, stats):
+        self.stats = stats
+        SFLvaultClient.__init__(self, config, shell=True)
+        self.set_getpassfunc(lambda: PASSPHRASE)
+
+    def _get_vault(self):
+        return self._vault
+
+    def _set_timed_vault(self, proxy):
+        timed = TimedProxy(proxy, self.stats)
+        # The client switches to JSON-RPC between login and authenticate
+        timed.after_login = getattr(self, '_vault', timed).after_login
+        self._vault = timed
+
+    # Set by _set_vault() and _use_jsonrpc()
+    vault = property(_get_vault, _set_timed_vault)
+
+
+def write_config(path, username, url, eg):
+    """Write the client configuration of `username`"""
+    fp = open(path, 'w')
+    fp.write("[SFLvault]\nusername = %s\nurl = %s\nkey = %s\n" % (
+            username, url,
+            encrypt_privkey(serial_elgamal_privkey(elgamal_bothkeys(eg)),
+                            PASSPHRASE)))
+    fp.close()
+    os.chmod(path, 0600)
+
+
+def _login(client, rnd, state):
+    # The next call logs in and authenticates
+    client.authtok_expires = 0
+
+
+def _search(client, rnd, state):
+    res = client.search([rnd.choice(WORDS)])
+    state['found'] = [int(s) for c in res['results'].values()
+                      for m in c['machines'].values()
+                      for s in m['services']] or state['found']
+
+
+def _show(client, rnd, state):
+    client.show(rnd.choice(state['found']))
+
+
+def _passwd(client, rnd, state):
+    client.service_passwd(rnd.choice(state['found']),
+                          'pw-%d' % rnd.randint(0, 10 ** 9))
+
+STEPS = {'login': _login, 'search': _search, 'show': _show,
+         'passwd': _passwd}
+
+
+def simulate(client, script, rnd, services, stop, stats):
+    """Run the `script` steps with `client` until `stop` is set"""
+    state = {'found': services}
+    while not stop.is_set():
+        for step in script:
+            try:
+                STEPS[step](client, rnd, state)
+            except Exception, e:
+                stats.step_failed(step, '%s: %s' % (type(e).__name__,
+                                                    repr(str(e))[1:100]))
+            if stop.is_set():
+                break
+        else:
+            with stats.lock:
+                stats.loops += 1
+
+
+def _serve(settings, workers, queue):
+    """Run the vault's HTTP server, in the child process"""
+    Random.atfork()
+    with quiet():
+        app = sflvault.main({}, **settings)
+        server = serve(app, '127.0.0.1', '0', start_loop=False,
+                       use_threadpool=True, threadpool_workers=workers,
+                       handler=WSGIHandler, protocol_version='HTTP/1.1',
+                       socket_timeout=30)
+        queue.put(server.server_port)
+        server.serve_forever()
+
+
+def run(users, script='operator', duration=10, size='small', url=None,
+        session_timeout=3600, seed=0, crypto_workers=0):
+    """Serve a generated vault and load it with each number of `users`.
+    Returns {users: Stats.report()}"""
+    tmpdir = tempfile.mkdtemp()
+    server = None
+    try:
+        url = url or 'sqlite:///%s' % os.path.join(tmpdir, 'vault.db')
+        model.init_model(create_engine(url))
+        migrations.upgrade(meta.engine)
+        counts = dict(SIZES[size], users=max(users))
+        gen = generate(counts, seed)
+        meta.Session.remove()
+        meta.engine.dispose()
+
+        queue = multiprocessing.Queue()
+        server = multiprocessing.Process(target=_serve, args=(
+                {'sqlalchemy.url': url,
+                 'sflvault.vault.session_timeout': str(session_timeout),
+                 'sflvault.vault.crypto_workers': str(crypto_workers)},
+                max(10, max(users)), queue))
+        server.start()
+        vault_url = 'http://127.0.0.1:%d/vault/rpc' % queue.get(timeout=60)
+
+        configs = []
+        for i in range(max(users)):
+            username = u'user-%d' % i
+            path = os.path.join(tmpdir, 'config-%d' % i)
+            write_config(path, username, vault_url, gen.keys[username])
+            configs.append(path)
+
+        out = {}
+        rnd = random.Random(seed)
+        for n in users:
+            stats = Stats()
+            stop = threading.Event()
+            with quiet():
+                threads = [threading.Thread(target=simulate, args=(
+                            LoadClient(configs[i], stats), SCRIPTS[script],
+                            random.Random(rnd.random()), gen.services, stop,
+                            stats))
+                           for i in range(n)]
+                start = time.time()
+                for t in threads:
+                    t.start()
+                time.sleep(duration)
+                stop.set()
+                for t in threads:
+                    t.join()
+            out[n] = stats.report(time.time() - start)
+        return out
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+        shutil.rmtree(tmpdir)
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]",
+                          description="Load a local vault with simulated "
+                          "operators.")
+    parser.add_option('-u', '--users', default='1,5,10,20',
+                      help="Numbers of simultaneous users (1,5,10,20)")
+    parser.add_option('-d', '--duration', type='float', default=10,
+                      help="Seconds of load, for each number of users (10)")
+    parser.add_option('-s', '--script', default='operator',
+                      help="Steps of each user, among %s (operator)" %
+                      ', '.join(sorted(SCRIPTS)))
+    parser.add_option('--size', default='small',
+                      help="Size of the vault, among %s (small)" %
+                      ', '.join(sorted(SIZES)))
+    parser.add_option('--db', help="Empty database to fill and serve, "
+                      "instead of a temporary SQLite file")
+    parser.add_option('--session-timeout', type='int', default=3600,
+                      help="Seconds before the sessions expire (3600)")
+    parser.add_option('--crypto-workers', type='int', default=0,
+                      help="Worker processes of the server's crypto pool (0)")
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('-o', '--output', help="Write the results to OUTPUT")
+    opts, args = parser.parse_args(argv)
+    logging.basicConfig()
+    if opts.script not in SCRIPTS:
+        parser.error("Unknown script: %s" % opts.script)
+    if opts.size not in SIZES:
+        parser.error("Unknown size: %s" % opts.size)
+    users = [int(x) for x in opts.users.split(',')]
+
+    res = run(users, opts.script, opts.duration, opts.size, opts.db,
+              opts.session_timeout, opts.seed, opts.crypto_workers)
+
+    print "%-6s %10s %10s %8s %9s" % ('users', 'calls/s', 'loops/s',
+                                      'errors', 'expired')
+    for n in users:
+        r = res[n]
+        print "%-6d %10.1f %10.2f %7.2f%% %8.2f%%" % (
+            n, r['calls_per_second'], r['loops_per_second'],
+            r['error_rate'] * 100, r['expired_rate'] * 100)
+    print
+    print "%-6s %-18s %8s %8s %10s %10s %10s" % ('users', 'method', 'calls',
+                                                 'errors', 'p50 (ms)',
+                                                 'p95 (ms)', 'p99 (ms)')
+    for n in users:
+        for method, m in sorted(res[n]['methods'].items()):
+            print "%-6d %-18s %8d %8d %10.1f %10.1f %10.1f" % (
+                n, method, m['calls'], m['errors'], m['p50_ms'],
+                m['p95_ms'], m['p99_ms'])
+        if res[n]['failed_steps']:
+            for step, count in sorted(res[n]['failed_steps'].items()):
+                print "%-6d %-18s %8d failed, last: %s" % (
+                    n, step, count, res[n]['failed_reasons'][step])
+
+    if opts.output:
+        json.dump({'date': datetime.now().isoformat(),
+                   'script': opts.script, 'size': opts.size,
+                   'duration': opts.duration,
+                   'levels': dict([(str(k), v) for k, v in res.items()])},
+                  open(opts.output, 'w'), indent=2, sort_keys=True,
+                  separators=(',', ': '))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,278 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Time the RPC calls on generated vaults of several sizes.
+
+Usage: python -m sflvault.tests.benchmark.runner [options]
+
+For each size (see generator.SIZES), generates a vault in a temporary
+SQLite database, serves it with sflvault.main() and times each call of
+CALLS `repeat` times, as JSON-RPC requests through the WSGI application
+(without the HTTP server).  The deletions run last, each on other
+services, machines or customers.
+
+The results are written as JSON (--output), and compared with the
+baseline (baseline.json next to this file, or --baseline): a call
+regresses when its median time is more than `tolerance` (50%) above the
+baseline's, plus 1 ms for the noise on the fastest calls.  The exit
+status is 1 if any call regressed.  --save-baseline replaces the
+baseline with the results, to be committed along with the change that
+made them differ.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import shutil
+import tempfile
+from base64 import b64encode
+from datetime import datetime
+from optparse import OptionParser
+
+from webob import Request
+from sqlalchemy import create_engine
+
+import sflvault
+from sflvault import model
+from sflvault.model import meta
+from sflvault.common.crypto import unserial_elgamal_msg
+from sflvault.lib import migrations
+from sflvault.tests.benchmark.generator import SIZES, ADMIN, generate, quiet
+
+
+__all__ = ['CALLS', 'BASELINE', 'run', 'compare', 'main']
+
+
+CALLS = ['login', 'authenticate', 'search', 'service_get_tree', 'group_list',
+         'user_list', 'service_add', 'service_del', 'machine_del',
+         'customer_del']
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+CLIENT_VERSION = '0.8.0'
+
+
+class Client(object):
+    """Send JSON-RPC calls to the application, as the client does once it
+    logged in"""
+    def __init__(self, app):
+        self.app = app
+        self.id = 0
+
+    def __call__(self, method, *args):
+        self.id += 1
+        body = json.dumps({'jsonrpc': '2.0', 'id': self.id,
+                           'method': 'sflvault.' + method,
+                           'params': list(args)})
+        req = Request.blank('/vault/json', method='POST', body=body,
+                            content_type='application/json',
+                            remote_addr='127.0.0.1')
+        res = json.loads(req.get_response(self.app).body)
+        if res.get('error') or res['result']['error']:
+            raise AssertionError("%s: %s" % (method, res.get('error') or
+                                              res['result']['message']))
+        return res['result']
+
+
+def measure(func, repeat):
+    """Return the times of `repeat` calls to func(i), in seconds"""
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func(i)
+        times.append(time.time() - start)
+    return times
+
+
+def _targets(gen, repeat):
+    """Pick the customers, machines and services deleted, none of them in
+    the others"""
+    customers = gen.customers[-repeat:]
+    machines = [m for m in gen.machines
+                if gen.machine_customer[m] not in customers]
+    deleted = machines[-repeat:]
+    services = [s for s in gen.leaves()
+                if gen.service_machine[s] in machines and
+                gen.service_machine[s] not in deleted]
+    return customers, deleted, services[:repeat]
+
+
+def run(counts, repeat=5, seed=0):
+    """Generate a vault of `counts`, and time each call of CALLS on it.
+    Returns {call: [seconds, ...]}"""
+    if repeat > counts['customers'] / 2:
+        raise ValueError("Can't delete %d customers out of %d" %
+                         (repeat, counts['customers']))
+    tmpdir = tempfile.mkdtemp()
+    try:
+        url = 'sqlite:///%s' % os.path.join(tmpdir, 'vault.db')
+        model.init_model(create_engine(url))
+        migrations.upgrade(meta.engine)
+        gen = generate(counts, seed)
+        meta.Session.remove()
+        settings = {'sqlalchemy.url': url,
+                    'sflvault.vault.session_timeout': '3600',
+                    'sflvault.vault.session_trust': 'false'}
+        # main() prints its settings, the search view its results.
+        with quiet():
+            app = sflvault.main({}, **settings)
+            return _run_calls(Client(app), gen, repeat)
+    finally:
+        meta.Session.remove()
+        shutil.rmtree(tmpdir)
+
+
+def _run_calls(call, gen, repeat):
+    admin = gen.keys[ADMIN]
+    state = {}
+
+    def login(i):
+        ret = call('login', ADMIN, CLIENT_VERSION)
+        state['cryptok'] = admin.decrypt(
+            unserial_elgamal_msg(str(ret['cryptok'])))
+
+    def authenticate(i):
+        ret = call('authenticate', ADMIN, b64encode(state['cryptok']))
+        state['authtok'] = ret['authtok']
+
+    out = {}
+    out['login'] = measure(login, repeat)
+    out['authenticate'] = measure(authenticate, repeat)
+    authtok = state['authtok']
+
+    deepest = max(gen.services, key=gen.depth)
+    customers, machines, services = _targets(gen, repeat)
+    calls = {
+        'search': lambda i: call('search', authtok, ['alpha'], None, False,
+                                 None, 20),
+        'service_get_tree': lambda i: call('service_get_tree', authtok,
+                                           deepest, True),
+        'group_list': lambda i: call('group_list', authtok, True),
+        'user_list': lambda i: call('user_list', authtok, True),
+        'service_add': lambda i: call('service_add', authtok,
+                                      gen.machines[0], 0,
+                                      'ssh://bench@added-%d' % i,
+                                      gen.groups[:2], 'secret', '', {}),
+        'service_del': lambda i: call('service_del', authtok, services[i]),
+        'machine_del': lambda i: call('machine_del', authtok, machines[i]),
+        'customer_del': lambda i: call('customer_del', authtok,
+                                       customers[i]),
+        }
+    for name in CALLS:
+        if name in calls:
+            out[name] = measure(calls[name], repeat)
+    return out
+
+
+def summary(times):
+    times = sorted(times)
+    return {'median_ms': times[len(times) / 2] * 1000,
+            'min_ms': times[0] * 1000, 'max_ms': times[-1] * 1000}
+
+
+def compare(results, baseline, tolerance=0.5, slack_ms=1.0):
+    """Return the messages for the calls of `results` slower than in
+    `baseline` (both as written by main())"""
+    out = []
+    for size, res in sorted(results['sizes'].items()):
+        base = baseline['sizes'].get(size, {}).get('calls', {})
+        for name in CALLS:
+            if name not in res['calls'] or name not in base:
+                continue
+            now = res['calls'][name]['median_ms']
+            before = base[name]['median_ms']
+            if now > before * (1 + tolerance) + slack_ms:
+                out.append("%s, %s: %.1f ms, baseline is %.1f ms" %
+                           (size, name, now, before))
+    return out
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]",
+                          description="Time the vault's calls on generated "
+                          "vaults, and compare with the baseline.")
+    parser.add_option('--sizes', default='small,medium',
+                      help="Sizes of vaults, among %s (small,medium)" %
+                      ', '.join(sorted(SIZES)))
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help="Calls timed, for each call (5)")
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('-o', '--output', help="Write the results to OUTPUT")
+    parser.add_option('-b', '--baseline', default=BASELINE,
+                      help="Baseline to compare with (%default)")
+    parser.add_option('-t', '--tolerance', type='float', default=0.5,
+                      help="Slowdown allowed, from the baseline (0.5)")
+    parser.add_option('--save-baseline', action='store_true',
+                      help="Write the results to the baseline")
+    opts, args = parser.parse_args(argv)
+    logging.basicConfig()
+
+    sizes = opts.sizes.split(',')
+    for size in sizes:
+        if size not in SIZES:
+            parser.error("Unknown size: %s" % size)
+
+    results = {'date': datetime.now().isoformat(), 'repeat': opts.repeat,
+               'seed': opts.seed, 'sizes': {}}
+    for size in sizes:
+        times = run(SIZES[size], opts.repeat, opts.seed)
+        results['sizes'][size] = {
+            'counts': SIZES[size],
+            'calls': dict([(k, summary(v)) for k, v in times.items()])}
+
+    baseline = None
+    if not opts.save_baseline and os.path.exists(opts.baseline):
+        baseline = json.load(open(opts.baseline))
+
+    print "%-8s %-18s %12s %10s %10s %14s" % ('size', 'call', 'median (ms)',
+                                             'min (ms)', 'max (ms)',
+                                             'baseline (ms)')
+    for size in sizes:
+        calls = results['sizes'][size]['calls']
+        base = baseline and baseline['sizes'].get(size, {}).get('calls', {})
+        for name in CALLS:
+            res = calls[name]
+            before = base and name in base and \
+                "%14.1f" % base[name]['median_ms'] or "%14s" % '-'
+            print "%-8s %-18s %12.1f %10.1f %10.1f %s" % (
+                size, name, res['median_ms'], res['min_ms'], res['max_ms'],
+                before)
+
+    if opts.output:
+        json.dump(results, open(opts.output, 'w'), indent=2, sort_keys=True,
+                  separators=(',', ': '))
+    if opts.save_baseline:
+        json.dump(results, open(opts.baseline, 'w'), indent=2,
+                  sort_keys=True, separators=(',', ': '))
+        print "Baseline written to %s" % opts.baseline
+        return 0
+
+    failed = baseline and compare(results, baseline, opts.tolerance) or []
+    for msg in failed:
+        print "REGRESSION: %s" % msg
+    return failed and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
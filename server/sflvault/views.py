@@ -22,12 +22,20 @@
 import logging
 import transaction
 from pyramid_rpc.xmlrpc import xmlrpc_method
+from pyramid_rpc.jsonrpc import jsonrpc_method
 from pyramid.response import Response
 from pyramid.threadlocal import get_current_registry
 from sflvault.common.crypto import *
 from sflvault.lib.vault import SFLvaultAccess, vaultMsg
+from sflvault.lib.sessions import MemorySessionStore
+from sflvault.lib.cryptopool import CryptoPoolError
+from sflvault.lib.jsonrpc import ascii_args
+from sflvault.lib import metrics
+from sflvault.lib import tracing
 from sflvault.model import *
 import datetime
+import time
+import threading
 from decorator import decorator
 from datetime import datetime, timedelta
 from distutils.version import LooseVersion
@@ -35,11 +43,47 @@ from distutils.version import LooseVersion
 log = logging.getLogger(__name__)
 
 MINIMAL_CLIENT_VERSION = LooseVersion('0.7.6')
+
+# URL of the JSON-RPC endpoint, relative to the XML-RPC one, announced at
+# login.
+JSONRPC_URL = 'json'
+
+
+def rpc_method(method):
+    """Serve the view as `method` on both the XML-RPC (/vault/rpc) and the
+    JSON-RPC (/vault/json) endpoints"""
+    def wrap(func):
+        func = tracing.rpc_view(metrics.rpc_call(func))
+        xmlrpc_method(endpoint='sflvault', method=method)(func)
+        return jsonrpc_method(endpoint='sflvault-json', method=method,
+                              decorator=ascii_args)(func)
+    return wrap
+
 # Permissions decorators for XML-RPC calls
 #
 
-vaultSessions = {}
+# Replaced in main() by the configured session store.
+vaultSessions = MemorySessionStore()
+# The settings shared by the requests, set in main().  The views get a
+# copy acting for the authenticated user as request.vault.
 vault = SFLvaultAccess()
+
+# Calls that only read the vault.  When a replica is configured (see
+# sqlalchemy.replica.* in the .ini), their queries go to it, unless the
+# user wrote to the vault in the last `replica_lag` seconds: the replica
+# might not have their changes yet.  Set in main().
+READ_ONLY_METHODS = set(['sflvault.user_list', 'sflvault.machine_get',
+                         'sflvault.machine_list', 'sflvault.service_get',
+                         'sflvault.service_get_tree',
+                         'sflvault.service_get_many', 'sflvault.service_list',
+                         'sflvault.search', 'sflvault.customer_get',
+                         'sflvault.customer_list', 'sflvault.group_get',
+                         'sflvault.group_list'])
+replica_lag = 5
+# {user_id: time of their last write}, younger than replica_lag
+last_writes = {}
+last_writes_lock = threading.Lock()
+
 def test_group_admin(request, group_id):
     if not query(Group).filter_by(id=group_id).first():
         return vaultMsg(False, "Group not found: %s" % str(e))
@@ -65,11 +109,44 @@ def authenticated_user(func, request, *args, **kwargs):
              (should be authtok)
     """
     cryptok = request.rpc_args[0]
-    ret = _authenticated_user_first(request, cryptok)
+    with tracing.span('authenticated_user'):
+        ret = _authenticated_user_first(request, cryptok)
     if ret:
         return ret
 
-    return func(request, *args, **kwargs)
+    return _routed(func, request, *args, **kwargs)
+
+def _routed(func, request, *args, **kwargs):
+    """Call the view, on the replica if it's read-only and the user didn't
+    write recently.  Otherwise, remember when they last wrote.
+
+    The time of the last write is kept per user, in last_writes, so that
+    it's seen from all of the user's sessions on this server process.  It
+    expires with the replica lag."""
+    if meta.replica is None:
+        return func(request, *args, **kwargs)
+
+    sess = getattr(request, 'vault_session', None)
+    if not sess:
+        # Unknown user, stay on the primary.
+        return func(request, *args, **kwargs)
+
+    user_id = sess['user_id']
+    if request.rpc_method in READ_ONLY_METHODS:
+        if time.time() - last_writes.get(user_id, 0) > replica_lag:
+            with read_only():
+                return func(request, *args, **kwargs)
+        return func(request, *args, **kwargs)
+
+    res = func(request, *args, **kwargs)
+    if not (isinstance(res, dict) and res.get('error')):
+        now = time.time()
+        with last_writes_lock:
+            for uid, stamp in last_writes.items():
+                if now - stamp > replica_lag:
+                    del last_writes[uid]
+            last_writes[user_id] = now
+    return res
 
 def _authenticated_user_first(request, cryptok):
     """DRYed authenticated_user to skip repetition in authenticated_admin"""
@@ -81,6 +158,9 @@ def _authenticated_user_first(request, cryptok):
     except SessionExpiredError:
         s = None
         error_msg = 'session expired'
+    except SessionSourceAddressMismatchError:
+        s = None
+        error_msg = 'session source address mismatch'
 
 
     if not s:
@@ -88,10 +168,10 @@ def _authenticated_user_first(request, cryptok):
 
     sess = s
 
-    if 'user_id' in sess:
-        vault.myself_id = sess['user_id']
-    if 'username' in sess:
-        vault.myself_username = sess['username']
+    # The session, and the caller's vault, for the view (the shared vault
+    # is never changed)
+    request.vault_session = sess
+    request.vault = vault.as_user(sess.get('user_id'), sess.get('username'))
 
 @decorator
 def authenticated_admin(func, request, *args, **kwargs):
@@ -100,22 +180,17 @@ def authenticated_admin(func, request, *args, **kwargs):
     Check authenticated_user , everything written then applies here as well.
     """
     cryptok = request.rpc_args[0]
-    ret = _authenticated_user_first(request, cryptok)
-    if ret:
-        return ret
-    try:
-        sess = get_session(cryptok, request)
-    except SessionNotFoundError:
-        sess = None
-
-    if sess:
-        if not sess['userobj'].is_admin:
+    with tracing.span('authenticated_admin'):
+        ret = _authenticated_user_first(request, cryptok)
+        if ret:
+            return ret
+        if not request.vault_session['is_admin']:
             return vaultMsg(False, "Permission denied, admin priv. required")
 
-    return func(request, *args, **kwargs)
+    return _routed(func, request, *args, **kwargs)
 
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.authenticate')
+@rpc_method('sflvault.authenticate')
 def sflvault_authenticate(request, username, cryptok):
     """Receive the *decrypted* cryptok, b64 encoded"""
     settings = get_current_registry().settings
@@ -133,9 +208,15 @@ def sflvault_authenticate(request, username, cryptok):
             except SessionExpiredError:
                 sess = None
                 print "Session expired... "
+            except SessionSourceAddressMismatchError:
+                sess = None
 
             if sess:
-                return vaultMsg(True, 'Authentication successful (cached)', {'authtok': cryptok})
+                remaining = sess['timeout'] - datetime.now()
+                return vaultMsg(True, 'Authentication successful (cached)',
+                                {'authtok': cryptok,
+                                 'timeout': remaining.days * 86400 +
+                                            remaining.seconds})
     except KeyError:
         pass
     
@@ -156,16 +237,19 @@ def sflvault_authenticate(request, username, cryptok):
         return vaultMsg(False, 'Authentication failed')
     else:
         newtok = b64encode(randfunc(32))
+        timeout = int(settings['sflvault.vault.session_timeout'])
         set_session(newtok, {'username': username,
-                                'timeout': datetime.now() + timedelta(0, int(settings['sflvault.vault.session_timeout'])),
+                                'timeout': datetime.now() + timedelta(0, timeout),
                                 'remote_addr': request.get('REMOTE_ADDR', None),
-                                'userobj': u,
+                                'is_admin': bool(u.is_admin),
                                 'user_id': u.id
                                 })
-        return vaultMsg(True, 'Authentication successful', {'authtok': newtok})
+        # The client can skip the login until the session times out
+        return vaultMsg(True, 'Authentication successful', {'authtok': newtok,
+                                                            'timeout': timeout})
 
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.login')
+@rpc_method('sflvault.login')
 def sflvault_login(request, username, version):
     # Require minimal client version.        
     user_version = LooseVersion(version)
@@ -186,51 +270,64 @@ def sflvault_login(request, username, version):
     # TODO: implement throttling ?
 
     rnd = randfunc(32)
+    # The client decrypts it to a number, which would lose leading NULs.
+    while rnd.startswith('\x00'):
+        rnd = randfunc(32)
     # 15 seconds to complete login/authenticate round-trip.
     u.logging_timeout = datetime.now() + timedelta(0, 15)
     u.logging_token = b64encode(rnd)
     
     #a = meta.Session.query(User).filter_by(username=username).one()
-    e = u.elgamal()
-    cryptok = serial_elgamal_msg(e.encrypt(rnd, randfunc(32)))
+    with metrics.timed('elgamal_encrypt'):
+        if vault.cryptopool:
+            try:
+                cryptok = vault.cryptopool.encrypt_challenge(u.pubkey, rnd)
+            except CryptoPoolError, e:
+                transaction.abort()
+                return vaultMsg(False, str(e))
+        else:
+            e = u.elgamal()
+            cryptok = serial_elgamal_msg(e.encrypt(rnd, randfunc(32)))
     
     transaction.commit()
     #meta.Session.close()
-    return vaultMsg(True, 'Authenticate please', {'cryptok': cryptok})
+    return vaultMsg(True, 'Authenticate please', {'cryptok': cryptok,
+                                                  'jsonrpc': JSONRPC_URL})
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.user_add')
+@rpc_method('sflvault.user_add')
 @authenticated_admin
 def user_add(request, authtok, username, is_admin):
-    return vault.user_add(username, is_admin)
+    return request.vault.user_add(username, is_admin)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.user_setup')
+@rpc_method('sflvault.user_setup')
 def user_setup(request, username, pubkey):
     return vault.user_setup(username, pubkey)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.user_del')
+@rpc_method('sflvault.user_del')
 @authenticated_admin
 def sflvault_user_del(request, authtok, user):
-    return vault.user_del(user)
+    return request.vault.user_del(user)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.user_list')
+@rpc_method('sflvault.user_list')
 @authenticated_user
-def sflvault_user_list(request, authtok, groups):
-    return vault.user_list(groups)
+def sflvault_user_list(request, authtok, groups, user_ids=None,
+                       group_ids=None):
+    return request.vault.user_list(groups, user_ids, group_ids)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.machine_get')
+@rpc_method('sflvault.machine_get')
 @authenticated_user
 def sflvault_machine_get(request, authtok, machine_id):
-    return vault.machine_get(machine_id)
+    return request.vault.machine_get(machine_id)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.machine_put')
+@rpc_method('sflvault.machine_put')
 @authenticated_user
 def sflvault_machine_put(request, authtok, machine_id, data):
-    return vault.machine_put(machine_id, data)
+    return request.vault.machine_put(machine_id, data)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.service_get')
+@rpc_method('sflvault.service_get')
 @authenticated_user
 def sflvault_service_get(request, authtok, service_id, group_id=None):
-    return vault.service_get(service_id, group_id)
+    return request.vault.service_get(service_id, group_id)
 
 
 # si ça arrive via /jsonrpc .. on convertie en JSON en sortant
@@ -241,12 +338,17 @@ def sflvault_service_get(request, authtok, service_id, group_id=None):
 #@rpc_view(method='sflvault.service_get', skip_first=False)
 #def sflvault_service_get(authtok, service_id, group_id=None):
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.service_get_tree')
+@rpc_method('sflvault.service_get_tree')
 @authenticated_user
 def sflvault_service_get_tree(request, authtok, service_id, with_groups):
-    return vault.service_get_tree(service_id, with_groups)
+    return request.vault.service_get_tree(service_id, with_groups)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.service_put')
+@rpc_method('sflvault.service_get_many')
+@authenticated_user
+def sflvault_service_get_many(request, authtok, service_ids, with_groups):
+    return request.vault.service_get_many(service_ids, with_groups)
+
+@rpc_method('sflvault.service_put')
 @authenticated_user
 def sflvault_service_put(request, authtok, service_id, data):
     # 'user_id' required in session.
@@ -262,168 +364,209 @@ def sflvault_service_put(request, authtok, service_id, data):
     if not res:
         return vaultMsg(False, "You don't have access to that service.")
     else:
-        return vault.service_put(service_id, data)
+        return request.vault.service_put(service_id, data)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.search')
+@rpc_method('sflvault.search')
 @authenticated_user
-def sflvault_search(request, authtok, search_query, group_ids, verbose, filters):
+def sflvault_search(request, authtok, search_query, group_ids, verbose, filters,
+                    limit=0, token=''):
     if group_ids and not filters:
         filters = {'groups': group_ids}
     if group_ids and isinstance(filters, dict) and 'groups' not in filters:
         # Please don't do that, use filters instead.
         filters['groups'] = group_ids
 
-    result = vault.search(search_query, filters, verbose)
+    result = request.vault.search(search_query, filters, verbose, limit, token)
     print 'foo', repr(result)
     return result
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.service_add')
+@rpc_method('sflvault.service_add')
 @authenticated_user
 def sflvault_service_add(request, authtok, machine_id, parent_service_id, url, group_ids, secret,
         notes, metadata):
-    return vault.service_add(machine_id, parent_service_id, url, group_ids, secret, notes,
+    return request.vault.service_add(machine_id, parent_service_id, url, group_ids, secret, notes,
         metadata)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.service_del')
+@rpc_method('sflvault.service_del')
 @authenticated_admin
 def sflvault_service_del(request, authtok, service_id):
-    return vault.service_del(service_id)
+    return request.vault.service_del(service_id)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.service_list')
+@rpc_method('sflvault.service_list')
 @authenticated_user
 def sflvault_service_list(request, authtok, machine_id=None, customer_id=None):
-    return vault.service_list(machine_id, customer_id)
+    return request.vault.service_list(machine_id, customer_id)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.machine_add')
+@rpc_method('sflvault.machine_add')
 @authenticated_user
 def sflvault_machine_add(request, authtok, customer_id, name, fqdn, ip, location, notes):
-    return vault.machine_add(customer_id, name, fqdn, ip, location, notes)
+    return request.vault.machine_add(customer_id, name, fqdn, ip, location,
+                                     notes)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.machine_del')
+@rpc_method('sflvault.machine_del')
 @authenticated_admin
 def sflvault_machine_del(request, authtok, machine_id):
-    return vault.machine_del(machine_id)
+    return request.vault.machine_del(machine_id)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.machine_list')
+@rpc_method('sflvault.machine_list')
 @authenticated_user
 def sflvault_machine_list(request, authtok, customer_id=None):
-    return vault.machine_list(customer_id)
+    return request.vault.machine_list(customer_id)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.customer_get')
+@rpc_method('sflvault.customer_get')
 @authenticated_user
 def sflvault_customer_get(request, authtok, customer_id):
-    return vault.customer_get(customer_id)
+    return request.vault.customer_get(customer_id)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.customer_put')
+@rpc_method('sflvault.customer_put')
 @authenticated_user
 def sflvault_customer_put(request, authtok, customer_id, data):
-    return vault.customer_put(customer_id, data)
+    return request.vault.customer_put(customer_id, data)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.customer_add')
+@rpc_method('sflvault.customer_add')
 @authenticated_user
 def sflvault_customer_add(request, authtok, customer_name):
-    return vault.customer_add(customer_name)
+    return request.vault.customer_add(customer_name)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.customer_del')
+@rpc_method('sflvault.customer_del')
 @authenticated_admin
 def sflvault_customer_del(request, authtok, customer_id):
-    return vault.customer_del(customer_id)
+    return request.vault.customer_del(customer_id)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.customer_list')
+@rpc_method('sflvault.customer_list')
 @authenticated_user
 def sflvault_customer_list(request, authtok):
-    return vault.customer_list()
+    return request.vault.customer_list()
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.group_get')
+@rpc_method('sflvault.group_get')
 @authenticated_user
 def sflvault_group_get(request, authtok, group_id):
-    return vault.group_get(group_id)
+    return request.vault.group_get(group_id)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.group_put')
+@rpc_method('sflvault.group_put')
 @authenticated_user
 def sflvault_group_put(request, authtok, group_id, data):
-    return vault.group_put(group_id, data)
+    return request.vault.group_put(group_id, data)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.group_add')
+@rpc_method('sflvault.group_add')
 @authenticated_user
 def sflvault_group_add(request, authtok, group_name):
-    return vault.group_add(group_name)
+    return request.vault.group_add(group_name)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.group_del')
+@rpc_method('sflvault.group_del')
 @authenticated_admin
 def sflvault_group_del(request, authtok, group_id):
-    return vault.group_del(group_id)
+    return request.vault.group_del(group_id)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.group_add_service')
+@rpc_method('sflvault.group_add_service')
 @authenticated_user
 def sflvault_group_add_service(request, authtok, group_id, service_id, symkey):
-    return vault.group_add_service(group_id, service_id, symkey)
+    return request.vault.group_add_service(group_id, service_id, symkey)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.group_del_service')
+@rpc_method('sflvault.group_del_service')
 @authenticated_user
 def sflvault_group_del_service(request, authtok, group_id, service_id):
     fail = test_group_admin(request, group_id)
     if fail:
         return fail
-    return vault.group_del_service(group_id, service_id)
+    return request.vault.group_del_service(group_id, service_id)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.group_add_user')
+@rpc_method('sflvault.group_add_user')
 @authenticated_user
 def sflvault_group_add_user(request, authtok, group_id, user, is_admin=False, cryptgroupkey=None):
-    return vault.group_add_user(group_id, user, is_admin, cryptgroupkey)
+    return request.vault.group_add_user(group_id, user, is_admin,
+                                        cryptgroupkey)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.group_del_user')
+@rpc_method('sflvault.group_del_user')
 @authenticated_user
 def sflvault_group_del_user(request, authtok, group_id, user):
     fail = test_group_admin(request, group_id)
     if fail:
         return fail
-    return vault.group_del_user(group_id, user)
+    return request.vault.group_del_user(group_id, user)
+
+@rpc_method('sflvault.group_rekey_start')
+@authenticated_user
+def sflvault_group_rekey_start(request, authtok, group_id):
+    fail = test_group_admin(request, group_id)
+    if fail:
+        return fail
+    return request.vault.group_rekey_start(group_id)
+
+@rpc_method('sflvault.group_rekey_next')
+@authenticated_user
+def sflvault_group_rekey_next(request, authtok, group_id, limit):
+    fail = test_group_admin(request, group_id)
+    if fail:
+        return fail
+    return request.vault.group_rekey_next(group_id, limit)
+
+@rpc_method('sflvault.group_rekey_put')
+@authenticated_user
+def sflvault_group_rekey_put(request, authtok, group_id, symkeys):
+    fail = test_group_admin(request, group_id)
+    if fail:
+        return fail
+    return request.vault.group_rekey_put(group_id, symkeys)
+
+@rpc_method('sflvault.group_rekey_finish')
+@authenticated_user
+def sflvault_group_rekey_finish(request, authtok, group_id, cryptgroupkeys):
+    fail = test_group_admin(request, group_id)
+    if fail:
+        return fail
+    return request.vault.group_rekey_finish(group_id, cryptgroupkeys)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.group_list')
+@rpc_method('sflvault.group_list')
 @authenticated_user
-def sflvault_group_list(request, authtok, list_users=False):
-    return vault.group_list(False, list_users)
+def sflvault_group_list(request, authtok, list_users=False, group_ids=None,
+                        user_ids=None):
+    return request.vault.group_list(False, list_users, group_ids, user_ids)
 
-@xmlrpc_method(endpoint='sflvault', method='sflvault.service_passwd')
+@rpc_method('sflvault.service_passwd')
 @authenticated_user
 def sflvault_service_passwd(request, authtok, service_id, newsecret):
-    return vault.service_passwd(service_id, newsecret)
+    return request.vault.service_passwd(service_id, newsecret)
+
+@rpc_method('sflvault.service_passwd_bulk')
+@authenticated_user
+def sflvault_service_passwd_bulk(request, authtok, passwords, filters, policy,
+                                 chunk_size, after_id=0, limit=0):
+    return request.vault.service_passwd_bulk(passwords, filters, policy,
+                                             chunk_size, after_id, limit)
+
+def sflvault_metrics(request):
+    """Serve /metrics, see sflvault.lib.metrics"""
+    return Response(body=metrics.render(),
+                    content_type='text/plain; version=0.0.4')
 
-#def _setup_sessions():
-#    """DRY out set_session and get_session"""
-#    if not hasattr(, 'vaultSessions'):
-#        .vaultSessions = {}
 def set_session(authtok, value):
-    """Sets in 'g.vaultSessions':
+    """Saves in the session store (see sflvault.lib.sessions):
     {authtok1: {'username':  , 'timeout': datetime}, authtok2: {}..}
     
     """
- #   _setup_sessions();
-    vaultSessions[authtok] = value;
+    vaultSessions.set(authtok, value)
 
 def get_session(authtok, request):
-    """Return the values associated with a session"""
-    #_setup_sessions();
-    
-    if not vaultSessions.has_key(authtok):
-        raise SessionNotFoundError
-        return None
+    """Return the values associated with a session
 
-    if not vaultSessions[authtok].has_key('timeout'):
-        vaultSessions[authtok]['timeout'] = datetime.now() + timedelta(0, SESSION_TIMEOUT)
+    Expired sessions are left to the SessionSweeper.
+    """
+    with tracing.span('get_session'):
+        sess = vaultSessions.get(authtok)
+
+    # Only the sessions made by authenticate have a remote_addr
+    if sess is None or 'remote_addr' not in sess:
+        raise SessionNotFoundError
 
-    if vaultSessions[authtok]['timeout'] < datetime.now():
-        del(vaultSessions[authtok])
+    if sess['timeout'] < datetime.now():
         raise SessionExpiredError
-        return None
 
-    if vaultSessions[authtok]['remote_addr'] != request.get('REMOTE_ADDR', 'gibberish'):
-        del(vaultSessions[authtok])
-        SessionSourceAddressMismatchError
-        return None
+    if sess['remote_addr'] != request.get('REMOTE_ADDR', 'gibberish'):
+        vaultSessions.delete(authtok)
+        raise SessionSourceAddressMismatchError
 
-    return vaultSessions[authtok]
+    return sess
 
 class SessionNotFoundError(Exception):
     pass